@@ -1,6 +1,10 @@
 import re
 from ast import literal_eval as leval
 import struct
+import sys
+import itertools
+import time
+from collections import OrderedDict
 
 class Type(object):
 
@@ -10,21 +14,22 @@ class Type(object):
         if align == 0 or ((align & (align-1)) != 0):
             raise ValueError('align should be power of 2')
         self.name = name
-        self.size = size 
+        # bytes used by the members, size() adds the tail padding
+        self.length = size
         self.align = align
         self.packed = packed
         self.members = {}
         self.offsets = {}
 
     def addMember(self, name, tp):
-        offset = self.size
+        offset = self.length
         if not self.packed:
             offset = (offset + (tp.align-1)) & (-tp.align)
         self.members[name] = tp
         self.offsets[name] = offset
 
         # update size of the structure
-        self.size = offset + tp.size()
+        self.length = offset + tp.size()
 
         # update align of the structure
         if tp.align > self.align:
@@ -32,50 +37,74 @@ class Type(object):
 
     def size(self):
         if self.packed:
-            return self.size
+            return self.length
         else:
-            return (self.size + (self.align-1)) & (-self.align)
+            return (self.length + (self.align-1)) & (-self.align)
 
     def member(self, name):
-        if not self.members[name]:
-            raise ValueError
-        return members[name]
+        if name not in self.members:
+            raise ValueError('no member {} in {}'.format(name, self.name))
+        return self.members[name]
+
+    def flatten(self):
+        """
+        member path -> (offset, type) of all the members, the members of
+        nested types too, as {'tape': (0, ptr), 'pos.x': (8, int32)}
+        """
+        paths = {}
+        for name, tp in self.members.items():
+            offset = self.offsets[name]
+            paths[name] = (offset, tp)
+            for path, (o, t) in tp.flatten().items():
+                paths[name + '.' + path] = (offset + o, t)
+        return paths
 
 
 class TypeManager(object):
 
     def __init__(self):
         self.alltypes = {}
+        # full path -> (offset, type), 'state.tape' -> (0, ptr), filled
+        # when a type is registered so lookups do not walk the members
+        self.paths = {}
         self.registerType(Type('.byte', 1))
         self.registerType(Type('.int16', 2, 2))
         self.registerType(Type('.int32', 4, 4))
         self.registerType(Type('.int64', 8, 8))
         self.registerType(Type('.float', 4, 4))
         self.registerType(Type('.double', 8, 8))
+        self.registerType(Type('.ptr', 8, 8))
 
     def offsetof(self, fullname):
-        namelist = fullname.split('.')
-        offset = 0
-        tp = self.alltypes[ns[0]]
-        if not tp: raise ValueError
-        for name in namelist[1:]:
-            m = tp.members[name]
-            if not m: 
-                raise ValueError
-            offset += tp.offsets[name]
-            tp = m
-        return offset
+        return self.pathof(fullname)[0]
+
+    def pathof(self, fullname):
+        # (offset, type) of a type name or a member path like state.tape
+        if fullname not in self.paths:
+            raise ValueError('no type or member {}'.format(fullname))
+        return self.paths[fullname]
 
     def typeof(self, tpname):
-        tp = self.alltypes[tpname]
-        if not tp: raise ValueError
-        return tp
+        if tpname not in self.alltypes:
+            raise ValueError('no type {}'.format(tpname))
+        return self.alltypes[tpname]
 
     def registerType(self, tp):
+        """
+        register tp, a type of the same name registered before is replaced
+        unless it is builtin. types having the old one as member keep its
+        layout.
+        """
         name = tp.name
         if name in self.alltypes:
-            raise ValueError('reregister type {}'.format(name))
+            if name.startswith('.'):
+                raise ValueError('reregister type {}'.format(name))
+            prefix = name + '.'
+            self.paths = {k: v for k, v in self.paths.items() if not k.startswith(prefix)}
         self.alltypes[name] = tp
+        self.paths[name] = (0, tp)
+        for path, value in tp.flatten().items():
+            self.paths[name + '.' + path] = value
 
 
 class Packer:
@@ -87,63 +116,362 @@ class Packer:
             'I16': 'H',
             'i32': 'i',
             'I32': 'I',
-            'i64': 'l',
-            'I64': 'L',
+            'i64': 'q',
+            'I64': 'Q',
             'f32': 'f',
             'f64': 'd',
             }
 
-    def pack(f, n):
-        return struct.pack(_pack_formats[f], n)
+    def pack(self, f, n):
+        return struct.pack('<' + self.formats[f], n)
 
 
-class AS:
-        """
-        features:
-            # no .include
-            # it can be handled in python
+class Template(object):
+    """
+    compiled instruction template
 
-            # .byte
-            # handle string/hex/oct/float
-            # .byte 0, 0x10, 'ab"c\n', "a\nb'c", 'a'
+        [prefix]:[rex]:opcode:[modrm]/[operands]
 
-            # .type
-            # working
+    the hex fields are decoded and the operands are split only once,
+    when the template is created. see AS.dotemplateone for the syntax.
+    """
 
-            # .define
-            # TBD
-            # no define now
-            #defines = {}
+    def __init__(self, text):
+        m = re.fullmatch(r'([0-9A-Fa-f]*):([0-9A-Fa-f]*):([0-9A-Fa-f]+):([0-9A-Fa-f]*)/([a-zA-Z0-9]*)', text)
+        if not m: raise ValueError('invalid template {}'.format(text))
+        self.text = text
+        self.prefix = bytes.fromhex(m.group(1))
+        self.rex = bytes.fromhex(m.group(2))
+        self.opcode = bytes.fromhex(m.group(3))
+        self.modrm = bytes.fromhex(m.group(4))
 
-            # .macro
-            # TBD
-            #macros = {}
-        """
+        # [(o, n, sn)], e.g. 'b64i8' -> [('b', 64, '64'), ('i', 8, '8')]
+        self.operands = []
+        for (o, sn) in re.findall(r'([a-zA-Z])([0-9]*)', m.group(5)):
+            n = 0 if len(sn) == 0 else int(sn)
+            if o in 'rBb' and n not in (8, 16, 32, 64):
+                raise ValueError('invalid template {}'.format(text))
+            if o == 'j' and n not in (8, 32):
+                raise ValueError('invalid template {}'.format(text))
+            self.operands.append((o, n, sn))
+
+    def __repr__(self):
+        return 'Template({!r})'.format(self.text)
+
+
+class Hole(object):
+    """
+    an immediate operand whose value is patched in after encoding,
+    see AS.encode. offset and format (struct format) locate the field.
+    a hole in a memory operand is its displacement, const + sign * value,
+    see AS.parsememory, offset is None if it is encoded with no field.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.offset = None
+        self.format = None
+        self.sign = None
+        self.const = None
+
+
+class Label(object):
+    """
+    a label at address pos, before relaxing, with nbranches branches
+    before it. addr is its address once those branches are laid out,
+    see AS.newlabel and AS.layoutbranches.
+    """
+    __slots__ = ('pos', 'nbranches', 'addr')
+
+    def __init__(self, pos, nbranches):
+        self.pos = pos
+        self.nbranches = nbranches
+        self.addr = None
+
+
+class Branch(object):
+    """
+    a branch to a label at address pos, before relaxing. short and near
+    are (code, offset, format) of the j8/j32 forms, the displacement is
+    packed at offset. target is the Label, set when it is defined.
+    """
+    __slots__ = ('pos', 'short', 'near', 'target')
+
+    def __init__(self, pos):
+        self.pos = pos
+        self.short = None
+        self.near = None
+        self.target = None
+
+
+class Macro(object):
+    """
+    a macro, params are the names of its operands, lines are the
+    MacroLines of its body
+    """
+    __slots__ = ('name', 'params', 'lines')
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.lines = []
+
+
+class MacroLine(object):
+    """
+    a line of a macro body, split and dispatched when the macro is
+    defined. opcode is the operation, or the index of the param it is,
+    op the callable or signature dict of it, None if it is found when the
+    macro is used. args are the operands, str or, if params appear in
+    them, a list of str pieces and param indexes. code is the machine code
+    of a line without params, encoded once. operands are the (class,
+    value) of the args of a template line with params, found once,
+    (None, None) for the args with params, see AS.macroinstruction.
+    """
+    __slots__ = ('opcode', 'args', 'op', 'code', 'operands')
+
+    def __init__(self, opcode, args, op, code=None, operands=None):
+        self.opcode = opcode
+        self.args = args
+        self.op = op
+        self.code = code
+        self.operands = operands
+
+
+class Instruction(object):
+    """
+    a template instruction line parsed once, the record AS.instruction
+    makes for Peephole, the encoder and the branch layout. opcode is the
+    interned mnemonic, sig the operand classes (an interned tuple, see
+    AS.classify), tmpls the templates accepting sig, and values the
+    operands as the encoder takes them:
+
+        a/c/r classes           the register number, see GPR
+        d/i/n/u classes         int
+        f                       float
+        m classes               Memory
+        l, segment registers    str
+
+    a Hole stands for an immediate patched in after encoding.
+    """
+    __slots__ = ('opcode', 'sig', 'values', 'tmpls')
+
+    def __init__(self, opcode, sig, values, tmpls):
+        self.opcode = opcode
+        self.sig = sig
+        self.values = values
+        self.tmpls = tmpls
+
+
+class Memory(object):
+    """
+    a parsed memory operand, segment prefix, modrm with reg 0, sib,
+    displacement and REX bits, see AS.parsememory. the reg field is or'ed
+    in by the encoder, so one Memory serves all the instructions using
+    the operand. hole is the Hole of a displacement patched in after
+    encoding, None for the others.
+    """
+    __slots__ = ('segment', 'modrm', 'sib', 'displacement', 'rex', 'hole')
+
+    def __init__(self, segment, modrm, sib, displacement, rex, hole=None):
+        self.segment = segment
+        self.modrm = modrm
+        self.sib = sib
+        self.displacement = displacement
+        self.rex = rex
+        self.hole = hole
 
-    def __init__(self):
+
+class AS:
+    """
+    features:
+        # no .include
+        # it can be handled in python
+
+        # .byte
+        # handle string/hex/oct/float
+        # .byte 0, 0x10, 'ab"c\n', "a\nb'c", 'a'
+
+        # .type
+        # working
+
+        # labels
+        # name: and @name: are global, N: is local, referenced as
+        # name/@name and >N/<N (next/previous N) by jmp/jcc/call.
+        # layout='relax': the branches are laid out short or near once
+        # their forms are settled, the rest by finish().
+        # layout='onepass': backward branches are short if they fit,
+        # forward branches are near and patched when the label is defined.
+
+        # .define
+        # .define name, value
+        # name as an operation or a word of an operand stands for value
+        # from the next line on
+
+        # .extern
+        # .extern name1, name2 ...
+        # jmp/jcc/call to name take the near form with a zero displacement,
+        # a relocation of it is kept in relocations for the linker, see elf
+
+        # .macro
+        # .macro name, param1, param2 ... .endmacro
+        # the body is split and dispatched once, name param1, param2
+        # assembles it with the params substituted.
+
+        # peephole
+        # peephole=True passes the instructions through a Peephole window,
+        # which drops redundant compares, merges add/sub and clears
+        # registers with xor where the flags allow it.
+
+        # instructions
+        # a template line is parsed once into an Instruction, the register
+        # numbers, immediates and Memory operands the peephole window, the
+        # encoder and the branch layout take, see instruction and
+        # doinstruction.
+    """
+
+    def __init__(self, select='first', memcachesize=1024, linecachesize=4096, layout='relax', profile=False,
+            peephole=False, operandsetsize=1<<16):
 
         self.packer = Packer()
 
+        # template selection when several templates accept the operands:
+        #   first: the first one in asmap order, the encoding of t/t.result
+        #   shortest: the shortest encoding
+        if select not in ('first', 'shortest'):
+            raise ValueError('invalid template selection {}'.format(select))
+        self.select = select
+
+        # branch layout:
+        #   relax: branches are laid out by flush and finish, see
+        #   layoutbranches
+        #   onepass: branches are emitted at once, see emitbranch
+        if layout not in ('relax', 'onepass'):
+            raise ValueError('invalid branch layout {}'.format(layout))
+        self.layout = layout
+
         # assembly operation map
         self.asmap = {}
 
         # type definition map
         self.tpmap = {}
 
-        #### the current opmap
-        self.opmap = self.asmap
+        # macro body map
+        self.mcmap = {}
+
+        # operation index built from asmap/tpmap/mcmap, see buildIndex
+        self.asindex = {}
+        self.tpindex = {}
+        self.mcindex = {}
+
+        #### the current operation index
+        self.opindex = self.asindex
 
         # result binary
+        # base is the address of resultbin[0], see flush
         self.resultbin = bytearray()
-
-        # global labels
+        self.base = 0
+
+        # LRU cache of parsed memory operands, see domemory
+        self.memcache = OrderedDict()
+        self.memcachesize = memcachesize
+        self.memhits = 0
+        self.memmisses = 0
+
+        # LRU cache of encoded instruction lines, see doline
+        # linecachesize=0 turns it off
+        self.linecache = OrderedDict()
+        self.linecachesize = linecachesize
+        self.linehits = 0
+        self.linemisses = 0
+
+        # global labels, name -> Label
         self.glabels = {}
 
+        # local labels, slot N -> the last Label N, see localslot
+        self.llabels = []
+
+        # branches waiting for a label, slot N/name -> [Branch] when
+        # relaxing, [(address, format, end)] of the displacements to
+        # patch in one pass
+        self.lpending = []
+        self.gpending = {}
+
+        # branches to labels, in address order, not laid out yet, see
+        # layoutbranches
+        self.branches = []
+
+        # the number of branches laid out into resultbin, the bytes they
+        # take and the address before relaxing after the last of them.
+        # an address after it before relaxing plus growth is the address
+        # in resultbin.
+        self.laid = 0
+        self.growth = 0
+        self.laidpos = 0
+
+        # Labels whose addr waits for branches before them, see newlabel
+        self.openlabels = []
+
+        # short/near forms of the branch instructions, see dobranch
+        self.branchforms = {}
+
+        # operand signatures and operand values, one tuple shared by the
+        # Instructions of each, see instruction. operandsetsize bounds the
+        # values kept, operandsetsize=0 turns the sharing off
+        self.sigs = {}
+        self.operandsets = {}
+        self.operandsetsize = operandsetsize
+
+        # labels and branches recorded instead of laid out, a list of
+        # (address, name, None), (address, label, (short, near)) and
+        # (address, name, addend) of the branches to externs, see
+        # assemblechunk and link
+        self.events = None
+
+        # addresses of the global labels, set by finish
+        self.symbols = {}
+
+        # .extern names, the displacements of the branches to them as
+        # (Label, name, addend), and as (address, name, addend) once
+        # finish lays them out
+        self.externs = set()
+        self.externrefs = []
+        self.relocations = []
+
+        # number of short/near branches laid out
+        self.shortbranches = 0
+        self.nearbranches = 0
+
+        # the peephole window, see peepholedoline
+        self.peephole = None
+        if peephole:
+            self.peephole = Peephole(self)
+            self.doline = self.peepholedoline
+
+        # counters of the lines and phases if profile, see profiled
+        self.profile = None
+        if profile:
+            self.profile = Profile()
+            self.profiled()
+
         self.tm = TypeManager()
 
+        # .define aliases, name -> value
+        self.defines = {}
+
+        # macros, name -> Macro, and the one being defined
+        self.macros = {}
+        self.currmacro = None
+
         self.currtp = None
         self.initTypeMap()
+        self.initMacroMap()
         self.initAsMap()
+        self.compileTemplates(self.asmap)
+        self.compileTemplates(self.tpmap)
+        self.asindex.update(self.buildIndex(self.asmap))
+        self.tpindex.update(self.buildIndex(self.tpmap))
+        self.mcindex.update(self.buildIndex(self.mcmap))
 
     def initTypeMap(self):
         def typeop(op, params):
@@ -154,13 +482,60 @@ class AS:
         self.tpmap['*'] = typeop
 
         def dotendtype(op, params):
-            self.tm.registerType(currtp)
+            self.tm.registerType(self.currtp)
+            self.memcache.clear()
+            self.linecache.clear()
+            # the macro lines with type paths were encoded with the offsets
+            # of the types then
+            for macro in self.macros.values():
+                for ml in macro.lines:
+                    if ml.code is not None and any(':' in a for a in ml.args):
+                        ml.code = self.macrocode(ml.opcode, ml.args, ml.op)
             self.currtp = None
-            self.opmap = self.asmap
+            self.opindex = self.asindex
 
         self.tpmap['.endtype'] = dotendtype
 
+    def initMacroMap(self):
+        # the lines of a macro body are recorded until .endmacro
+        self.mcmap['*'] = self.recordmacro
+
+        def dotendmacro(op, params):
+            macro = self.currmacro
+            def invoke(op, params):
+                self.expandmacro(macro, params)
+            self.macros[macro.name] = macro
+            self.asindex[macro.name] = invoke
+            # lines of the name assembled before are not the macro
+            self.linecache.clear()
+            self.currmacro = None
+            self.opindex = self.asindex
+
+        self.mcmap['.endmacro-0'] = dotendmacro
+
     def initAsMap(self):
+        def dotdefine(op, params):
+            if len(params) != 2 or not params[0].isidentifier():
+                raise ValueError('.define needs a name and a value')
+            self.defines[params[0]] = params[1]
+            # lines assembled before may mean another thing now
+            self.linecache.clear()
+
+        self.asmap['.define-2'] = dotdefine
+
+        def dotmacro(op, params):
+            if len(params) < 1 or not all(p.isidentifier() for p in params):
+                raise ValueError('.macro needs a name and the names of its params')
+            self.currmacro = Macro(params[0], params[1:])
+            self.opindex = self.mcindex
+
+        self.asmap['.macro'] = dotmacro
+
+        def dotnop(op, params):
+            pass
+
+        self.asmap['.nop'] = dotnop
+
         def dottype(op, params):
             m = re.fullmatch(r'\s*(\w+):?(\w*)\s*', params[0])
             if not m:
@@ -171,10 +546,21 @@ class AS:
                 self.currtp = Type(name, 0, 1, True)
             else:
                 self.currtp = Type(name)
-            self.opmap = self.tpmap
+            self.opindex = self.tpindex
 
         self.asmap['.type-1'] = dottype
 
+        def dotextern(op, params):
+            for name in params:
+                if not name.isidentifier():
+                    raise ValueError('.extern needs the names of the labels')
+                if name in self.glabels or name in self.gpending:
+                    raise ValueError('label {} is used before .extern'.format(name))
+                self.externs.add(name)
+
+        self.asmap['.extern'] = dotextern
+        self.asmap['.label-1'] = self.dolabel
+
         ########################## template #################################
         # instruction structure:
         # [prefix]:[rex]:opcode:[modrm]/[operands]
@@ -265,7 +651,7 @@ class AS:
                 ':48:0F4{0:X}:/r64b64|'
                 ':48:0F4{0:X}:/r64m'
                 ).format(n)
-            self.asmap['j{}-1'.format(cc)] = '::7{0:X}:/i8|::0F8{0:X}:/i32'.format(n)
+            self.asmap['j{}-1'.format(cc)] = '::7{0:X}:/j8|::0F8{0:X}:/j32'.format(n)
             self.asmap['set{}-1'.format(cc)] = '::0F9{0:X}:00/b8|::0F9{0:X}:00/m'.format(n)
 
         self.asmap['inc-1'] = '::FE:00/b8|66::FF:00/b16|::FF:00/b32|:48:FF:00/b64'
@@ -321,19 +707,214 @@ class AS:
         self.asmap['cwd-0'] = '66::99:/'
         self.asmap['cdq-0'] = '::99:/'
         self.asmap['cqo-0'] = ':48:99:/'
-        self.asmap['ret-0'] = 
-        self.asmap['ret-1'] = 
-        self.asmap['enter-0'] = 
+        self.asmap['ret-0'] = '::C3:/'
+        self.asmap['ret-1'] = '::C2:/I16'
+        self.asmap['enter-2'] = '::C8:/I16I8'
         self.asmap['leave-0'] = '::C9:/'
         self.asmap['mov-2'] = (
+            '::88:/b8r8|'
+            '::88:/mr8|'
+            '66::89:/b16r16|'
+            '66::89:/mr16|'
+            '::89:/b32r32|'
+            '::89:/mr32|'
+            ':48:89:/b64r64|'
+            ':48:89:/mr64|'
+            '::8A:/r8m|'
+            '66::8B:/r16m|'
+            '::8B:/r32m|'
+            ':48:8B:/r64m|'
+            '::B0:/B8I8|'
+            '::B0:/B8i8|'
+            '66::B8:/B16I16|'
+            '66::B8:/B16i16|'
+            '::B8:/B32I32|'
+            '::B8:/B32i32|'
+            ':48:C7:00/b64i32|'
+            ':48:B8:/B64I64|'
+            ':48:B8:/B64i64'
             )
-        self.asmap['jmp-1'] = (
+        # I takes the unsigned immediates, i the negative ones
+        self.asmap['movb-2'] = '::C6:00/mI8|::C6:00/mi8'
+        self.asmap['movw-2'] = '66::C7:00/mI16|66::C7:00/mi16'
+        self.asmap['movd-2'] = '::C7:00/mI32|::C7:00/mi32'
+        self.asmap['movl-2'] = '::C7:00/mI32|::C7:00/mi32'
+        self.asmap['movq-2'] = ':48:C7:00/mi32'
+        self.asmap['movzx-2'] = (
+            '66::0FB6:/r16b8|'
+            '::0FB6:/r32b8|'
+            ':48:0FB6:/r64b8|'
+            '::0FB7:/r32b16|'
+            ':48:0FB7:/r64b16'
             )
-        self.asmap['call-1'] = (
+        self.asmap['movzxb-2'] = '66::0FB6:/r16m|::0FB6:/r32m|:48:0FB6:/r64m'
+        self.asmap['movzxw-2'] = '::0FB7:/r32m|:48:0FB7:/r64m'
+        self.asmap['imul-2'] = (
+            '66::0FAF:/r16b16|'
+            '66::0FAF:/r16m|'
+            '::0FAF:/r32b32|'
+            '::0FAF:/r32m|'
+            ':48:0FAF:/r64b64|'
+            ':48:0FAF:/r64m'
             )
+        self.asmap['imul-3'] = (
+            '66::6B:/r16b16i8|'
+            '66::69:/r16b16i16|'
+            '::6B:/r32b32i8|'
+            '::69:/r32b32i32|'
+            ':48:6B:/r64b64i8|'
+            ':48:69:/r64b64i32|'
+            '66::6B:/r16mi8|'
+            '66::69:/r16mi16|'
+            '::6B:/r32mi8|'
+            '::69:/r32mi32|'
+            ':48:6B:/r64mi8|'
+            ':48:69:/r64mi32'
+            )
+        self.asmap['jmp-1'] = '::EB:/j8|::E9:/j32|::FF:20/b64|::FF:20/m'
+        self.asmap['call-1'] = '::E8:/j32|::FF:10/b64|::FF:10/m'
             
 
-    def dotemplateone(self, tmpl, op, params):
+    def compileTemplates(self, opmap):
+        # parse every template string once, dotemplate works on the
+        # resulted Template lists
+        for key, op in opmap.items():
+            if isinstance(op, str):
+                opmap[key] = [Template(t) for t in op.split('|')]
+
+    def buildIndex(self, opmap):
+        """
+        build the operation index from an operation map
+
+        the keys of an operation map are 'op-N' (N operands), 'op-args'
+        (literal operands, e.g. 'push-fs'), 'op' (any operands) or '*'
+        (any operation). the index maps op to either a callable or a dict
+        from operand signature (tuple of operand classes, see classify)
+        to the templates accepting it, in their original order. sized
+        forms like 'addb-2' are indexed under 'add' too, with their m
+        operand accepting only the m8 class.
+        """
+        index = {}
+        names = set(key.split('-', 1)[0] for key in opmap)
+        for key, op in opmap.items():
+            name, _, rest = key.partition('-')
+            if callable(op):
+                index[name] = op
+                continue
+            if not isinstance(op, list):
+                continue
+
+            literal = None if rest.isdigit() else tuple(rest.split('-'))
+            entries = [(name, None)]
+            if name[:-1] in names and name[-1] in SizeSuffix:
+                entries.append((name[:-1], SizeSuffix[name[-1]]))
+
+            for t in op:
+                for iname, msize in entries:
+                    if literal is not None:
+                        sigs = [tuple([self.classify(a) for a in literal])]
+                    else:
+                        sigs = itertools.product(*self.accepts(t, msize))
+                    sigmap = index.setdefault(iname, {})
+                    for sig in sigs:
+                        tmpls = sigmap.setdefault(sig, [])
+                        if all(x.text != t.text for x in tmpls):
+                            tmpls.append(t)
+        return index
+
+    def accepts(self, tmpl, msize=None):
+        """
+        operand classes accepted by each operand of a template
+
+        msize restricts m to a sized memory class, otherwise m accepts the
+        plain class and the sized class matching the template's register
+        operand (any size if it has none).
+        """
+        regbits = [n for (o, n, sn) in tmpl.operands if o in 'rBbac']
+        result = []
+        for (o, n, sn) in tmpl.operands:
+            if o == 'a' or o == 'c':
+                result.append(['{}{}'.format(o, n)])
+            elif o in 'rBb':
+                result.append(['a{}'.format(n), 'c{}'.format(n), 'r{}'.format(n)])
+            elif o == 'm':
+                if msize is not None:
+                    result.append(['m{}'.format(msize)])
+                elif regbits:
+                    result.append(['m', 'm{}'.format(regbits[0])])
+                else:
+                    result.append(['m'] + ['m{}'.format(k) for k in (8, 16, 32, 64)])
+            elif o == 'i' or o == 'j':
+                result.append(['l'] * (o == 'j') + ['d1'] +
+                        ['{}{}'.format(c, k) for k in (8, 16, 32, 64) if k <= n for c in 'in'] +
+                        ['u{}'.format(k) for k in (8, 16, 32) if k < n])
+            elif o == 'I':
+                result.append(['d1'] +
+                        ['{}{}'.format(c, k) for k in (8, 16, 32, 64) if k <= n for c in 'iu'])
+            elif o == 'd':
+                result.append(['d{}'.format(n)])
+            elif o == 'f':
+                result.append(['f'])
+            else:
+                raise ValueError('invalid template {}'.format(tmpl.text))
+        return result
+
+    def classify(self, p):
+        """
+        operand class of an operand
+
+              a8/a16/a32/a64
+                AL/AX/EAX/RAX
+              c8/c16/c32/c64
+                CL/CX/ECX/RCX
+              r8/r16/r32/r64
+                other general purpose registers
+              m, m8/m16/m32/m64
+                memory operand, sized by byte/word/dword/qword/aword
+              d1
+                integer 1
+              i8/i16/i32/i64
+                non-negative integer fitting the signed size
+              u8/u16/u32/u64
+                integer fitting only the unsigned size
+              n8/n16/n32/n64
+                negative integer
+              f
+                floating point number
+              cs/ds/es/fs/gs/ss
+                segment register, class is the register name
+              l
+                label, >N/<N for the next/previous local label N,
+                @name or name for a global label
+
+        None is returned for anything else.
+        """
+        n = GPRbits.get(p)
+        if n is not None:
+            if p in regAbits: return 'a{}'.format(n)
+            if p in regCbits: return 'c{}'.format(n)
+            return 'r{}'.format(n)
+        if p in SegPrefix:
+            return p
+
+        if reInteger.fullmatch(p):
+            return intclass(int(p, 0))
+        if reFloat.fullmatch(p):
+            return 'f'
+
+        m = reSizedMemory.fullmatch(p)
+        if m:
+            return 'm{}'.format(MemSize[m.group(1)]) if self.classify(m.group(2)) == 'm' else None
+        if '[' in p:
+            return 'm'
+        m = reTypeMemory.fullmatch(p)
+        if m and m.group(1) not in SegPrefix:
+            return 'm'
+        if reLabel.fullmatch(p):
+            return 'l'
+        return None
+
+    def dotemplateone(self, tmpl, op, values):
 
         """
         处理一个指令模板 
@@ -360,6 +941,9 @@ class AS:
                 floating point number, f32/f64
               d
                 direct immediate integer, d1 means 1, d123 means 123
+              j
+                relative displacement from the end of the instruction,
+                j8/j32. a label or an integer.
               r
                 registers encoded in reg of modrm, and R in rex optionally.
                 r8/r16/r32/r64
@@ -533,22 +1117,15 @@ class AS:
                       1     1    10   100     nn nnn nnn  nnnnnnnn nnnnnnnn nnnnnnnn nnnnnnnn
         """
 
-        m = re.fullmatch(r'([0-9A-F]*):([0-9A-F]*):([0-9A-F]+):([0-9A-F]*)/([a-zA-Z0-9]*)', tmpl) 
-        if not m: raise ValueError('Invalid template')
-        sprefix = m.group(1)
-        srex    = m.group(2)
-        sopcode = m.group(3)
-        smodrm  = m.group(4)
-        soption = m.group(5)
-
-        prefix = bytearray.fromhex(sprefix)
-        rex = bytearray.fromhex(srex)
-        opcode = bytearray.fromhex(sopcode)
-        modrm = bytearray.fromhex(smodrm)
+        prefix = bytearray(tmpl.prefix)
+        rex = bytearray(tmpl.rex)
+        opcode = bytearray(tmpl.opcode)
+        modrm = bytearray(tmpl.modrm)
 
         sib = bytearray()
         displacement = bytearray()
         immediate = bytearray()
+        holes = []
 
         def REX():
             if len(rex) == 0:
@@ -565,211 +1142,310 @@ class AS:
                 sib.append(0)
             return sib
 
-        def ensuren(n):
-            if n == 8 or n == 16 or n == 32 or n == 64:
-                return
-            raise ValueError('invalid template {}'.format(tmpl))
-        
-        for (o, sn) in re.findall(r'([a-zA-Z])([0-9]*)', soption):
-            n = 0 if len(sn) == 0 else int(sn)
-
+        # the operand values of an Instruction, the templates accepting
+        # its signature take them in order, see Instruction
+        values = iter(values)
+        for (o, n, sn) in tmpl.operands:
             if o == 'a':
-                p = params.pop(0)
-                if n > 0 and regAbits[p] != n:
-                    raise ValueError('invalid ax value: {} bits'.format(n))
-            elif o == 'i' or o == 'I' or o == 'f':
-                imm = leval(params.pop(0))
-                immediate = self.packer.pack(o+sn, imm)
+                next(values)
+            elif o == 'i' or o == 'I' or o == 'f' or o == 'j':
+                p = next(values)
+                f = ('i' if o == 'j' else o) + sn
+                if isinstance(p, Hole):
+                    p.offset = len(immediate)
+                    p.format = '<' + self.packer.formats[f]
+                    holes.append(p)
+                    immediate += bytes(n >> 3)
+                else:
+                    immediate += self.packer.pack(f, p)
             elif o == 'd':
-                imm = leval(params.pop(0))
+                imm = next(values)
                 if n != imm:
                     raise ValueError('invalid immediate integer "{}", should be"{}"'.format(imm, n))
             elif o == 'r': # reg in modrm, and R in rex optionally
-                ensuren(n)
-                p = params.pop(0)
-                if GPRbits[p] != n:
-                    raise ValueError('invalid register "{}"'.format(p))
-                code = GPR[p]
+                code = next(values)
                 if code >= 8: # need REX
                     REX()[0] |= ((code&8)>>1)
                 MODRM()[0] |= ((code&7)<<3)
             elif o == 'B': # reg in opcode, and B in rex optionally
-                ensuren(n)
-                p = params.pop(0)
-                if GPRbits[p] != n:
-                    raise ValueError('invalid register "{}"'.format(p))
-                code = GPR[p]
+                code = next(values)
                 if code >= 8: # need REX
                     REX()[0] |= ((code&8)>>3)
                 opcode[-1] |= (code&7)
             elif o == 'b': # register in r/m in modrm, and B in rex optioanlly
-                ensuren(n)
-                p = params.pop(0)
-                if GPRbits[p] != n:
-                    raise ValueError('invalid register "{}"'.format(p))
-                code = GPR[p]
+                code = next(values)
                 if code >= 8: # need REX
                     REX()[0] |= ((code&8)>>3)
                 MODRM()[0] |= (0xC0|(code&7))
             elif o == 'm': # memory in r/m in modrm, and sib optionally
-                base = None
-                index = None
-                scale = None
-                offset = None
+                reg = modrm[0] & 0x38 if len(modrm) > 0 else 0
+                mem = next(values)
+                prefix.extend(mem.segment)
+                MODRM()[0] = mem.modrm | reg
+                sib = mem.sib
+                displacement = mem.displacement
+                if mem.rex:
+                    REX()[0] |= mem.rex
+                if mem.hole is not None and displacement:
+                    mem.hole.format = '<' + self.packer.formats['i{}'.format(len(displacement) * 8)]
+                    holes.append(mem.hole)
+
+        # instruction = prefix(opt) + rex(opt) + opcode(1-3bytes) +
+        #               modrm(opt) + sib(opt) + displacement(opt) + immediate(opt)
+        code = prefix + rex + opcode + modrm + sib + displacement + immediate
+        for h in holes:
+            if h.sign is not None:
+                h.offset = len(code) - len(immediate) - len(displacement)
+            else:
+                h.offset += len(code) - len(immediate)
+        return code
 
+    def domemory(self, p):
+        """
+        parse memory operand p into a Memory, see dotemplateone for the
+        encoding. the results are kept in a LRU cache of memcachesize
+        entries, memhits/memmisses count the lookups.
+        """
+        mem = self.memcache.get(p)
+        if mem is not None:
+            self.memhits += 1
+            self.memcache.move_to_end(p)
+            return mem
+
+        self.memmisses += 1
+        mem = self.parsememory(p)
+        if self.memcachesize > 0:
+            self.memcache[p] = mem
+            if len(self.memcache) > self.memcachesize:
+                self.memcache.popitem(last=False)
+        return mem
+
+    def parsememory(self, p, hole=None, disp=0):
+        # 见dotemplateone中的内存操作数处理流程
+        # the Hole hole written as HOLE.format(hole.index) in p gets its
+        # sign and the rest of the offset, p is encoded with offset disp,
+        # see encode
+        base = None
+        index = None
+        scale = None
+        offset = None
+
+        negative = False
+        modrm = bytearray([0])
+        sib = bytearray()
+        segment = bytearray()
+        displacement = bytearray()
+        rexbits = 0
+
+        # 去掉byte/word/dword/qword/aword，reg:state.ptr可以不加[]
+        m = reSizedMemory.fullmatch(p)
+        if m: p = m.group(2)
+        if '[' not in p: p = '[' + p + ']'
+
+        # 先取出segment register(opt)和[]中的内容
+        #     re.match(r'\s*((\w+)\s*:)?\s*\[\s*([^\]]+)\s*\]\s*', ' fs : [ rax + rdx * 4 - 5 ] ')
+        m = re.fullmatch(r'\s*((\w+)\s*:)?\s*\[\s*([^\]]+)\]\s*', p)
+        if not m: raise ValueError('{} is not valid memory addressing operand'.format(p))
+
+        # 根据段寄存器设置段前缀
+        if m.group(2):
+            segment.append(SegPrefix[m.group(2)])
+
+        # 然后解析[]中的内容
+        # 把reg:state.ptr这种类型的转化为reg+nnn
+        addr0 = reTypePath.sub(
+                lambda m: '{}+{}'.format(m.group(1), self.tm.offsetof(m.group(2))),
+                m.group(3))
+        # 解析[]种的内容
+        #     re.split(r'\s*([+-])\s*', 'a + 4 * b - 5 '.strip())
+        addr0 = re.split(r'\s*([+-])\s*', addr0.strip())
+        addr = []
+
+        for item in addr0:
+            if item == '+':
                 negative = False
-                p = params.pop(0)
-
-                # 先取出segment register(opt)和[]中的内容
-                #     re.match(r'\s*((\w+)\s*:)?\s*\[\s*([^\]]+)\s*\]\s*', ' fs : [ rax + rdx * 4 - 5 ] ')
-                m = re.fullmatch(r'\s*((\w+)\s*:)?\s*\[\s*([^\]]+)\]\s*', p)
-                if not m: raise ValueError('{} is not valid memory addressing operand'.format(p))
-
-                # 根据段寄存器设置段前缀
-                if m.group(2):
-                    sprefix = SegPrefix[m.group(2)]
-                    prefix.append(sprefix)
-
-                # 然后解析[]中的内容
-                # 把reg:state.ptr这种类型的转化为reg+nnn
-                addr0 = re.sub(r'(\w+):([\w.]+)', \
-                        lambda m: '{}+{}'.format(m.group(1), self.tm.offsetof(m.group(2))), \
-                        m.group(3))
-                # 解析[]种的内容
-                #     re.split(r'\s*([+-])\s*', 'a + 4 * b - 5 '.strip())
-                addr0 = re.split(r'\s*([+-])\s*', addr0.strip())
-                addr = []
-
-                for item in addr0:
-                    if item == '+':
-                        negative = False
-                    elif item == '-':
-                        negative = True
-                    else:
-                        if negative:
-                            negative = False
-                            item = -int(item)
-                        addr.append(item)
-                
-                # 然后把scale*index取出来，保证index不为rsp
-                #     re.split(r'\s*\*\s*', '4 * rbx'.strip())
-                for item in addr:
-                    item = item.strip()
-                    m = re.search(r'\*', item)
-                    if m:
-                        si = re.split(r'\s*\*\s*', item)
-                        if len(si) != 2: raise ValueError('item {} is not valid scaled index'.format(item))
-                        if index is not None: raise ValueError('duplicate index {}'.format(item))
-                        si0 = si[0].strip()
-                        si1 = si[1].strip()
-                        index, scale = (si0, si1) if len(si0)>len(si1) else (si1, si0)
-                        scale = Scale[scale]
-                        if index not in GPRbits or GPRbits[index] != 64:
-                            raise ValueError("index register should be 64-bit GPR")
-                        if index == 'rsp': raise ValueError("rsp can't be used as index register")
-                    elif item in GPRbits and GPRbits[item] == 64:
-                        if base is None:
-                            base = item
-                        elif index is None and scale is None:
-                            if item == 'rsp' and base == 'rsp':
-                                raise ValueError("rsp can't be used as index regiser")
-                            if item == 'rsp':
-                                index = base
-                                base = item
-                            else:
-                                index = item
-                            scale = 0
-                        else:
-                            raise ValueError('redundant register {}'.format(item))
-                    elif item == 'rip':
-                        if base is not None or index is not None:
-                            raise ValueError("rip can't be used with index register")
+            elif item == '-':
+                negative = True
+            else:
+                if negative:
+                    negative = False
+                    item = '-' + item
+                addr.append(item)
+        
+        # 然后把scale*index取出来，保证index不为rsp
+        #     re.split(r'\s*\*\s*', '4 * rbx'.strip())
+        for item in addr:
+            item = item.strip()
+            m = re.search(r'\*', item)
+            if m:
+                si = re.split(r'\s*\*\s*', item)
+                if len(si) != 2: raise ValueError('item {} is not valid scaled index'.format(item))
+                if index is not None: raise ValueError('duplicate index {}'.format(item))
+                si0 = si[0].strip()
+                si1 = si[1].strip()
+                index, scale = (si0, si1) if len(si0)>len(si1) else (si1, si0)
+                scale = Scale[scale]
+                if index not in GPRbits or GPRbits[index] != 64:
+                    raise ValueError("index register should be 64-bit GPR")
+                if index == 'rsp': raise ValueError("rsp can't be used as index register")
+            elif item in GPRbits and GPRbits[item] == 64:
+                if base is None:
+                    base = item
+                elif index is None and scale is None:
+                    if item == 'rsp' and base == 'rsp':
+                        raise ValueError("rsp can't be used as index regiser")
+                    if item == 'rsp':
+                        index = base
                         base = item
-                    elif isinstance(leval(item), int):
-                        offset = leval(item)
-                    else: # 不处理其他情况
-                        raise ValueError("invalid item {} for memory address".format(item))
-
-                if base is None and index is not None and scale == 0:
-                    base = index
-                    index = None
-
-                # 然后就是把基址/索引/倍数/偏移取出来，各种排列组合:
-                if base is not None and index is None:
-                    if offset is None: offset = 0
-                    if base == 'rip':
-                        # 4. rip相对寻址
-                        # mod   r/m   displacement
-                        #  00   101   nnnnnnnn nnnnnnnn nnnnnnnn nnnnnnnn
-                        MODRM()[0] = (MODRM()[0] & 0x38) | 0x5
-                        displacement = pack('i32', offset)
                     else:
-                        # 1. 寄存器基址
-                        # 3. 寄存器基址+偏移
-                        MODRM()[0] = ((MODRM()[0]&0x38)) | (GPR[base]&7)
-                        if GPR[base]>=8:
-                            REX()[0] = REX()[0] | 1
-                        if base == 'rsp' or base == 'r12':
-                            SIB()[0] = 0x24
-
-                        if (offset == 0 and (base == 'rbp' or base == 'r13')) or offset != 0:
-                            if offset <= 127 and offset >= -128:
-                                MODRM()[0] = (MODRM()[0] & 0x3F) | 0x40
-                                displacement = pack('i8', offset)
-                            else:
-                                MODRM()[0] = (MODRM()[0] & 0x3F) | 0x80
-                                displacement = pack('i32', offset)
-                elif base is None and index is None and offset is not None:
-                    # 2. 绝对地址
-                    MODRM()[0] = (MODRM()[0] & 0x38) | 0x4
-                    SIB()[0] = 0x25
-                    displacement = pack('i32', offset)
-                elif base is None and index is not None:
-                    # 5. 索引*倍数
-                    # 7. 索引*倍数+偏移
-                    if offset is None: offset = 0
-                    MODRM()[0] = ((MODRM()[0]&0x38)|4)
-                    if GPR[index] >= 8:
-                        REX()[0] = REX()[0] | 2 
-                    SIB()[0] = 5 | (scale<<6) | ((GPR[index]&7)<<3)
-                    displacement = pack('i32', offset)
-                elif base is not None and index is not None:
-                    # 6. 索引*倍数 + 基址
-                    # 8. 索引*倍数 + 基址 + 偏移
-                    if offset is None: offset = 0
-                    MODRM()[0] = (MODRM()[0] & 0x38) | 4
-                    SIB()[0] = (GPR[base]&7) | ((GPR[index]&7)<<3) | (scale << 6)
-                    if GPR[base] >= 8:
-                        REX()[0] |= 1
-                    if GPR[index] >= 8:
-                        REX()[0] |= 2
-                    if (offset == 0 and (base == 'rbp' or base == 'r13')) or offset != 0:
-                        if offset <= 127 and offset >= -128:
-                            MODRM()[0] = (MODRM()[0] & 0x3F) | 0x40
-                            displacement = pack('i8', offset)
-                        else:
-                            MODRM()[0] = (MODRM()[0] & 0x3F) | 0x80
-                            displacement = pack('i32', offset)
-
-        # instruction = prefix(opt) + rex(opt) + opcode(1-3bytes) +
-        #               modrm(opt) + sib(opt) + displacement(opt) + immediate(opt)
-        self.resultbin.extend(prefix)
-        self.resultbin.extend(rex)
-        self.resultbin.extend(opcode)
-        self.resultbin.extend(modrm)
-        self.resultbin.extend(sib)
-        self.resultbin.extend(displacement)
-        self.resultbin.extend(immediate)
-
-    def dotemplate(self, tmpl, op, params):
-        tmpls = tmpl.split('|')
+                        index = item
+                    scale = 0
+                else:
+                    raise ValueError('redundant register {}'.format(item))
+            elif item == 'rip':
+                if base is not None or index is not None:
+                    raise ValueError("rip can't be used with index register")
+                base = item
+            elif reInteger.fullmatch(item):
+                offset = int(item, 0) if offset is None else offset + int(item, 0)
+            elif hole is not None and item.lstrip('-') == HOLE.format(hole.index) and hole.sign is None:
+                hole.sign = -1 if item[0] == '-' else 1
+            else: # 不处理其他情况
+                raise ValueError("invalid item {} for memory address".format(item))
+
+        if hole is not None:
+            if hole.sign is None:
+                raise ValueError('{} is not in {}'.format(HOLE.format(hole.index), p))
+            hole.const = offset or 0
+            offset = disp
+
+        if base is None and index is not None and scale == 0:
+            base = index
+            index = None
+
+        # 然后就是把基址/索引/倍数/偏移取出来，各种排列组合:
+        if base is not None and index is None:
+            if offset is None: offset = 0
+            if base == 'rip':
+                # 4. rip相对寻址
+                # mod   r/m   displacement
+                #  00   101   nnnnnnnn nnnnnnnn nnnnnnnn nnnnnnnn
+                modrm[0] = (modrm[0] & 0x38) | 0x5
+                displacement = self.packer.pack('i32', offset)
+            else:
+                # 1. 寄存器基址
+                # 3. 寄存器基址+偏移
+                modrm[0] = ((modrm[0]&0x38)) | (GPR[base]&7)
+                if GPR[base]>=8:
+                    rexbits |= 1
+                if base == 'rsp' or base == 'r12':
+                    sib[:] = b'\x24'
+
+                if (offset == 0 and (base == 'rbp' or base == 'r13')) or offset != 0:
+                    if offset <= 127 and offset >= -128:
+                        modrm[0] = (modrm[0] & 0x3F) | 0x40
+                        displacement = self.packer.pack('i8', offset)
+                    else:
+                        modrm[0] = (modrm[0] & 0x3F) | 0x80
+                        displacement = self.packer.pack('i32', offset)
+        elif base is None and index is None and offset is not None:
+            # 2. 绝对地址
+            modrm[0] = (modrm[0] & 0x38) | 0x4
+            sib[:] = b'\x25'
+            displacement = self.packer.pack('i32', offset)
+        elif base is None and index is not None:
+            # 5. 索引*倍数
+            # 7. 索引*倍数+偏移
+            if offset is None: offset = 0
+            modrm[0] = ((modrm[0]&0x38)|4)
+            if GPR[index] >= 8:
+                rexbits |= 2 
+            sib[:] = bytes([5 | (scale<<6) | ((GPR[index]&7)<<3)])
+            displacement = self.packer.pack('i32', offset)
+        elif base is not None and index is not None:
+            # 6. 索引*倍数 + 基址
+            # 8. 索引*倍数 + 基址 + 偏移
+            if offset is None: offset = 0
+            modrm[0] = (modrm[0] & 0x38) | 4
+            sib[:] = bytes([(GPR[base]&7) | ((GPR[index]&7)<<3) | (scale << 6)])
+            if GPR[base] >= 8:
+                rexbits |= 1
+            if GPR[index] >= 8:
+                rexbits |= 2
+            if (offset == 0 and (base == 'rbp' or base == 'r13')) or offset != 0:
+                if offset <= 127 and offset >= -128:
+                    modrm[0] = (modrm[0] & 0x3F) | 0x40
+                    displacement = self.packer.pack('i8', offset)
+                else:
+                    modrm[0] = (modrm[0] & 0x3F) | 0x80
+                    displacement = self.packer.pack('i32', offset)
+
+        return Memory(bytes(segment), modrm[0], bytes(sib), bytes(displacement), rexbits, hole)
+
+    def instruction(self, opcode, args, op):
+        """
+        the Instruction of a template line split by splitline, with op
+        its signature dict
+        """
+        sig = tuple([self.classify(arg) for arg in args])
+        tmpls = op.get(sig)
+        if tmpls is None:
+            raise ValueError('no template suitable for "{}" with operands {}'.format(opcode, sig))
+        values = tuple([self.operand(arg, c) for arg, c in zip(args, sig)])
+        return self.newinstruction(opcode, sig, values, tmpls)
+
+    def newinstruction(self, opcode, sig, values, tmpls):
+        # the Instruction of the operands, sig and values shared with the
+        # ones made before
+        sig = self.sigs.setdefault(sig, sig)
+        if 'l' not in sig and 'f' not in sig:
+            # labels are seldom the same, 0.0 == -0.0 but encodes not so
+            shared = self.operandsets.get(values)
+            if shared is not None:
+                values = shared
+            elif len(self.operandsets) < self.operandsetsize:
+                self.operandsets[values] = values
+        return Instruction(sys.intern(opcode), sig, values, tmpls)
+
+    def operand(self, p, c):
+        # the value of the operand p of class c in an Instruction
+        code = GPR.get(p)
+        if code is not None:
+            return code
+        if c == 'l' or c in SegPrefix:
+            return p
+        if c == 'f':
+            return float(leval(p))
+        if c[0] == 'm':
+            return self.domemory(p)
+        return int(p, 0)
+
+    def doinstruction(self, ins):
+        # assemble an Instruction, return True if it is no branch
+        if 'l' in ins.sig:
+            self.dobranch(ins, ins.sig.index('l'))
+            return False
+        self.dotemplate(ins)
+        return True
+
+    def dotemplate(self, ins):
+        # emit the selected template, return it
+        tmpl, code = self.selecttemplate(ins.tmpls, ins.opcode, ins.values)
+        self.resultbin.extend(code)
+        return tmpl
+
+    def selecttemplate(self, tmpls, op, values):
+        # tmpls all accept the operand signature, return (template, code)
+        if self.select == 'first' or len(tmpls) == 1:
+            return tmpls[0], self.dotemplateone(tmpls[0], op, values)
+
+        # shortest encoding, the earlier template wins a tie
+        best = None
         for t in tmpls:
-            try:
-                self.dotemplateone(t, op, params[:])
-                return
-            except:
-                pass
-        raise ValueError('no template suitable for "{}" in "{}"'.format(op, tmpl))
+            code = self.dotemplateone(t, op, values)
+            if best is None or len(code) < len(best[1]):
+                best = (t, code)
+        return best
 
     def splitargs(self, argline):
         argline = re.fullmatch(r'(.*),?', argline).group(1)
@@ -810,42 +1486,1116 @@ class AS:
 
         if len(rstack) > 0: raise ValueError
 
-        args = ''.join(argline).split('\n')
+        argline = ''.join(argline)
+        # no operands before a comment
+        if argline.isspace() or argline == '': return []
+        args = argline.split('\n')
         return [arg.strip() for arg in args]
 
-    def doline(self, line):
+    def pc(self):
+        # address of the next byte assembled, before relaxing
+        return self.base + len(self.resultbin) - self.growth
+
+    def committed(self):
+        # bytes of resultbin below this address will not be changed any
+        # more, the branches not laid out can grow, the forward
+        # displacements are patched when their labels are defined
+        if self.branches:
+            return self.branches[0].pos + self.growth
+        if self.layout == 'onepass':
+            pending = [address for fs in itertools.chain(self.lpending, self.gpending.values())
+                    for address, format, end in fs]
+            if pending:
+                return min(pending)
+        return self.base + len(self.resultbin)
+
+    def dolabel(self, op, params):
+        # .label name
+        if len(params) != 1:
+            raise ValueError('.label needs one name')
+        name = params[0]
+        if self.events is not None:
+            self.events.append((self.pc(), name, None))
+            return
+        label = self.newlabel(self.pc())
+        if name.isdigit():
+            n = self.localslot(name)
+            self.llabels[n] = label
+            pending = self.lpending[n]
+            self.lpending[n] = []
+        else:
+            if name in self.glabels:
+                raise ValueError('duplicate label {}'.format(name))
+            if name in self.externs:
+                raise ValueError('label {} is extern'.format(name))
+            self.glabels[name] = label
+            pending = self.gpending.pop(name, ())
+        if self.layout == 'relax':
+            for b in pending:
+                b.target = label
+        else:
+            for address, format, end in pending:
+                struct.pack_into(format, self.resultbin, address - self.base, label.pos - end)
+
+    def newlabel(self, pos):
+        # a Label at pos, its addr is set when the branches before it are
+        # laid out
+        label = Label(pos, self.laid + len(self.branches))
+        if self.branches:
+            self.openlabels.append(label)
+        else:
+            label.addr = pos + self.growth
+        return label
+
+    def localslot(self, name):
+        # slot of the local label N in llabels/lpending, the slots
+        # are indexed by N so the lookups take no hashing
+        n = int(name)
+        if n >= len(self.llabels):
+            grow = n + 1 - len(self.llabels)
+            self.llabels.extend([None] * grow)
+            self.lpending.extend([] for _ in range(grow))
+        return n
+
+    def findlabel(self, label):
+        """
+        look up a label reference, return (Label, None) for a defined
+        label or (None, pending) with the list the reference waits in
+        """
+        if label[0] == '<':
+            target = self.llabels[self.localslot(label[1:])]
+            if target is None:
+                raise ValueError('undefined label {}'.format(label))
+            return target, None
+        if label[0] == '>':
+            return None, self.lpending[self.localslot(label[1:])]
+        target = self.glabels.get(label)
+        if target is not None:
+            return target, None
+        return None, self.gpending.setdefault(label, [])
+
+    def dobranch(self, ins, i):
+        """
+        a branch of the Instruction ins to the label values[i]. the short
+        (j8) and near (j32) forms are chosen by layoutbranches.
+        """
+        self.putbranch(self.branchformsof(ins, i), ins.values[i])
+
+    def branchformsof(self, ins, i):
+        # (short, near) forms of the branch ins to values[i], short is
+        # None if it has no j8 form. they are kept in branchforms.
+        values = ins.values
+        key = (ins.opcode, i, ins.sig, values[:i] + values[i+1:])
+        forms = self.branchforms.get(key)
+        if forms is None:
+            byrel = {}
+            for t in ins.tmpls:
+                n = [n for (o, n, sn) in t.operands if o == 'j'][0]
+                if n in byrel:
+                    continue
+                h = Hole(0)
+                byrel[n] = (bytes(self.dotemplateone(t, ins.opcode, values[:i] + (h,) + values[i+1:])),
+                        h.offset, h.format)
+            if 32 not in byrel:
+                raise ValueError('no near form of "{}"'.format(ins.opcode))
+            forms = self.branchforms[key] = (byrel.get(8), byrel[32])
+        return forms
+
+    def putbranch(self, forms, label):
+        # a branch at pc to label with its (short, near) forms
+        b = Branch(self.pc())
+        b.short, b.near = forms
+        self.placebranch(b, label)
+
+    def placebranch(self, b, label):
+        # a branch with its forms set, by the branch layout
+        if label in self.externs:
+            self.externbranch(b, label)
+            return
+        if self.events is not None:
+            self.events.append((b.pos, label, (b.short, b.near)))
+            return
+        if self.layout == 'onepass':
+            self.emitbranch(b, label)
+            return
+        b.target, pending = self.findlabel(label)
+        if pending is not None:
+            pending.append(b)
+        self.branches.append(b)
+
+    def externbranch(self, b, label):
+        # the near form of b to the extern label, its displacement is
+        # left to the linker
+        code, offset, format = b.near
+        addend = offset - len(code)
+        if self.events is not None:
+            self.events.append((b.pos + offset, label, addend))
+        else:
+            self.externrefs.append((self.newlabel(b.pos + offset), label, addend))
+        self.resultbin += code
+
+    def emitbranch(self, b, label):
+        """
+        emit the branch b to label at once. a backward branch takes the
+        short form if the displacement fits, a forward branch takes the
+        near form and its displacement is patched when the label is
+        defined, see dolabel.
+        """
+        target, pending = self.findlabel(label)
+        form = b.near
+        if target is not None and b.short is not None:
+            disp = target.pos - (b.pos + len(b.short[0]))
+            if -128 <= disp <= 127:
+                form = b.short
+        code, offset, format = form
+        end = b.pos + len(code)
+        n = len(self.resultbin)
+        self.resultbin += code
+        if target is not None:
+            struct.pack_into(format, self.resultbin, n + offset, target.pos - end)
+        else:
+            pending.append((b.pos + offset, format, end))
+        if form is b.short:
+            self.shortbranches += 1
+        else:
+            self.nearbranches += 1
+
+    def relax(self, sizes=None):
+        """
+        choose the form of the branches not laid out, return the sizes
+
+        all branches start short, the ones whose displacement overflows
+        rel8 grow near, and the addresses are recomputed in address order
+        until nothing grows. branches only grow, so this terminates. the
+        branches to labels not defined yet stay short, so before finish
+        the sizes are the least each branch can take. sizes starts them at
+        other sizes.
+        """
+        branches = self.branches
+        if sizes is None:
+            sizes = [len(b.short[0]) if b.short is not None else len(b.near[0]) for b in branches]
+        changed = True
+        while changed:
+            changed = False
+            before = self.before(sizes)
+            for i, b in enumerate(branches):
+                if b.short is None or sizes[i] != len(b.short[0]) or b.target is None:
+                    continue
+                disp = self.address(b.target, before) - (b.pos + before[i+1])
+                if disp < -128 or disp > 127:
+                    sizes[i] = len(b.near[0])
+                    changed = True
+        return sizes
+
+    def before(self, sizes):
+        # before[k]: growth of the addresses by the branches laid out and
+        # the first k branches not laid out, of sizes
+        return list(itertools.accumulate(sizes, initial=self.growth))
+
+    def address(self, label, before):
+        # the address of label with the branches of before, see before
+        if label.addr is not None:
+            return label.addr
+        return label.pos + before[label.nbranches - self.laid]
+
+    def settled(self, sizes):
+        """
+        the number of branches at the head of branches whose form is the
+        one finish will choose, for sizes returned by relax. a near branch
+        stays near, a short one stays short if its displacement fits with
+        the branches after the settled ones near.
+        """
+        branches = self.branches
+        settled = [b.short is None or sizes[i] != len(b.short[0]) for i, b in enumerate(branches)]
+        changed = True
+        while changed:
+            changed = False
+            before = self.before([size if settled[i] else len(b.near[0])
+                    for i, (b, size) in enumerate(zip(branches, sizes))])
+            for i, b in enumerate(branches):
+                if settled[i] or b.target is None:
+                    continue
+                disp = self.address(b.target, before) - (b.pos + before[i+1])
+                if -128 <= disp <= 127:
+                    settled[i] = True
+                    changed = True
+        return settled.index(False) if False in settled else len(branches)
+
+    def layoutbranches(self, final=False):
+        """
+        lay out the branches at the head of branches whose form and target
+        address are settled, and drop them. their code goes into
+        resultbin, which is laid out up to the first branch left. final
+        lays out all of them, the labels must be defined.
+        """
+        branches = self.branches
+        if not branches or branches[0].target is None and not final:
+            return
+        sizes = self.relax()
+        n = len(branches) if final else self.settled(sizes)
+        # the targets of the branches laid out must be settled too
+        for k, b in enumerate(branches[:n]):
+            t = b.target
+            if t is None or t.addr is None and t.nbranches - self.laid > n:
+                n = k
+                break
+        if n == 0:
+            return
+        before = self.before(sizes[:n])
+        # the bytes from the last branch laid out, or from resultbin[0]
+        # if they have been flushed, up to the first branch left
+        first = max(self.laidpos, self.base - self.growth)
+        cut = branches[n].pos if n < len(branches) else self.pc()
+        start = first + self.growth - self.base
+        raw = self.resultbin[start:start + cut - first]
+        code = bytearray()
+        pos = first
+        for i, b in enumerate(branches[:n]):
+            code += raw[pos - first:b.pos - first]
+            pos = b.pos
+            disp = self.address(b.target, before) - (b.pos + before[i+1])
+            form = b.short if b.short is not None and sizes[i] == len(b.short[0]) else b.near
+            k = len(code)
+            code += form[0]
+            struct.pack_into(form[2], code, k + form[1], disp)
+            if form is b.short:
+                self.shortbranches += 1
+            else:
+                self.nearbranches += 1
+        code += raw[pos - first:]
+        self.resultbin[start:start + len(raw)] = code
+
+        openlabels = []
+        for label in self.openlabels:
+            if label.nbranches - self.laid <= n:
+                label.addr = self.address(label, before)
+            else:
+                openlabels.append(label)
+        self.openlabels = openlabels
+        self.laid += n
+        self.growth = before[n]
+        self.laidpos = cut
+        del branches[:n]
+
+    def finish(self):
+        """
+        resolve the labels and lay out the branches into resultbin
+        """
+        if self.peephole is not None:
+            self.peephole.drain()
+        undefined = ['>{}'.format(n) for n, pending in enumerate(self.lpending) if pending]
+        undefined.extend(name for name, pending in self.gpending.items() if pending)
+        if undefined:
+            raise ValueError('undefined labels {}'.format(', '.join(undefined)))
+
+        self.layoutbranches(True)
+        for name, label in self.glabels.items():
+            self.symbols[name] = label.addr
+        for ref, name, addend in self.externrefs:
+            self.relocations.append((ref.addr, name, addend))
+        self.externrefs = []
+        self.glabels = {}
+        self.llabels = []
+        self.lpending = []
+        self.gpending = {}
+
+    def image(self):
+        """
+        finish and return (resultbin, symbols, relocations), the whole
+        machine code, for loader, elf and codecache. ValueError is raised
+        if part of it has been flushed.
+        """
+        if self.base != 0:
+            raise ValueError('the code has been flushed from resultbin')
+        self.finish()
+        return self.resultbin, self.symbols, self.relocations
+
+    def link(self, code, events):
+        """
+        append a fragment recorded by assemblechunk, its labels and
+        branches are laid out as if its lines were assembled here
+        """
+        start = 0
+        for pos, name, forms in events:
+            self.resultbin += code[start:pos]
+            start = pos
+            if forms is None:
+                self.dolabel('.label', [name])
+            elif isinstance(forms, int):
+                # the near branch is in code, pos is its displacement
+                self.externs.add(name)
+                self.externrefs.append((self.newlabel(self.pc()), name, forms))
+            else:
+                self.putbranch(forms, name)
+        self.resultbin += code[start:]
+
+    def flush(self, write, final=False):
+        """
+        pass the committed bytes of resultbin to write and drop them,
+        final passes all of them. the branches settled so far are laid
+        out first.
+        """
+        if self.layout == 'relax' and not final:
+            self.layoutbranches()
+        n = len(self.resultbin) if final else self.committed() - self.base
+        if n > 0:
+            write(bytes(self.resultbin[:n]))
+            del self.resultbin[:n]
+            self.base += n
+
+    def splitline(self, line):
+        """
+        split a line into (opcode, args, op), op is the callable or the
+        signature dict found in the current operation index. None is
+        returned for empty and comment lines.
+        """
 
         # ignore empty line and comment line
         if re.fullmatch(r'\s*(#.*)?\s*', line):
-            return
+            return None
 
         # translate label
-        m = re.fullmatch(r'\s*(@?\w+)\s*:\s*', line)
+        m = reLabelLine.fullmatch(line)
         if m: line = '.label ' + m.group(1)
 
         # split statement
-        m = re.fullmatch(r'\s*([-.\w]+)\s+(.*)\s*', line)
+        m = re.fullmatch(r'\s*([-.\w]+)(\s+(.*))?\s*', line)
         if not m: raise ValueError(line)
         opcode = m.group(1)
-        args = self.splitargs(m.group(2))
-
-        key = '{}-{}'.format(opcode, len(args))
-        if key not in self.opmap:
-            key = opcode
-            if key not in self.opmap:
-                key = '{}-{}'.format(opcode, '-'.join(args))
-                if key not in self.opmap:
-                    key = '*'
-                    if key not in self.opmap:
-                        raise ValueError('unknown operation {}'.format(opcode))
-        op = self.opmap[key]
+        args = self.splitargs(m.group(3) or '')
+        if self.defines and opcode not in ('.define', '.macro'):
+            # the params of a macro body hide the aliases
+            keep = self.currmacro.params if self.opindex is self.mcindex else ()
+            if opcode not in keep:
+                opcode = self.defines.get(opcode, opcode)
+            args = self.substitute(args, keep)
+
+        op = self.opindex.get(opcode)
+        if op is None:
+            op = self.opindex.get('*')
+            if op is None:
+                raise ValueError('unknown operation {}'.format(opcode))
+        return opcode, args, op
+
+    def substitute(self, args, keep=()):
+        """
+        the .define aliases in args, one dict lookup for an operand which
+        is a name, one for every name in the others. quoted operands and
+        the names in keep are left as they are.
+        """
+        defines = self.defines
+        if keep:
+            defines = {k: v for k, v in defines.items() if k not in keep}
+        result = []
+        for a in args:
+            if a.isidentifier():
+                result.append(defines.get(a, a))
+            elif a[:1] in '\'"':
+                result.append(a)
+            else:
+                result.append(reWord.sub(lambda m: defines.get(m.group(), m.group()), a))
+        return result
+
+    def recordmacro(self, opcode, args):
+        """
+        record a line of the macro being defined. the line is dispatched
+        now, a template line without params is encoded now.
+        """
+        macro = self.currmacro
+        params = macro.params
+        if params:
+            reParam = re.compile(r'\b({})\b'.format('|'.join(params)))
+        pargs = []
+        for a in args:
+            pieces = reParam.split(a) if params else [a]
+            if len(pieces) == 1:
+                pargs.append(a)
+            else:
+                pargs.append([p if k % 2 == 0 else params.index(p) for k, p in enumerate(pieces)])
 
+        if opcode in params:
+            macro.lines.append(MacroLine(params.index(opcode), pargs, None))
+            return
+        op = self.asindex.get(opcode)
+        code = operands = None
+        if op is not None and not callable(op):
+            if pargs == args:
+                code = self.macrocode(opcode, args, op)
+            else:
+                operands = self.macrooperands(pargs)
+        macro.lines.append(MacroLine(opcode, pargs, op, code, operands))
+
+    def macrocode(self, opcode, args, op):
+        # the machine code of a template line without params of a macro
+        # body, None for a branch or a line not encoded until it is used
+        try:
+            ins = self.instruction(opcode, args, op)
+            if 'l' in ins.sig:
+                return None
+            return bytes(self.selecttemplate(ins.tmpls, ins.opcode, ins.values)[1])
+        except ValueError:
+            # the error is raised where the macro is used
+            return None
+
+    def macrooperands(self, pargs):
+        # the MacroLine operands of a template line with params, None if
+        # an arg without params is no operand, the error is raised where
+        # the macro is used
+        operands = []
+        for a in pargs:
+            if not isinstance(a, str):
+                operands.append((None, None))
+                continue
+            c = self.classify(a)
+            if c is None:
+                return None
+            try:
+                operands.append((c, self.operand(a, c)))
+            except ValueError:
+                return None
+        return operands
+
+    def macroinstruction(self, ml, params):
+        # the Instruction of a template line of a macro body with params
+        # for its params, only the args with params are classified
+        sig = []
+        values = []
+        for (c, v), a in zip(ml.operands, ml.args):
+            if c is None:
+                a = ''.join(p if k % 2 == 0 else params[p] for k, p in enumerate(a))
+                c = self.classify(a)
+                v = self.operand(a, c) if c is not None else None
+            sig.append(c)
+            values.append(v)
+        sig = tuple(sig)
+        tmpls = ml.op.get(sig)
+        if tmpls is None:
+            raise ValueError('no template suitable for "{}" with operands {}'.format(ml.opcode, sig))
+        return self.newinstruction(ml.opcode, sig, tuple(values), tmpls)
+
+    def expandmacro(self, macro, params):
+        # assemble the body of macro with params for its params
+        if len(params) != len(macro.params):
+            raise ValueError('macro {} needs {} operands'.format(macro.name, len(macro.params)))
+        for ml in macro.lines:
+            if ml.code is not None:
+                self.resultbin += ml.code
+                continue
+            if ml.operands is not None:
+                self.doinstruction(self.macroinstruction(ml, params))
+                continue
+            opcode = ml.opcode
+            op = ml.op
+            if not isinstance(opcode, str):
+                opcode = params[opcode]
+            args = [a if isinstance(a, str) else
+                    ''.join(p if k % 2 == 0 else params[p] for k, p in enumerate(a))
+                    for a in ml.args]
+            if op is None:
+                op = self.asindex.get(opcode)
+                if op is None:
+                    raise ValueError('unknown operation {} in macro {}'.format(opcode, macro.name))
+            self.dostatement(opcode, args, op)
+
+    def encode(self, line, holes=()):
+        """
+        encode a line without emitting it, for the actions mode of pyasm.
+        return (code, actions, order), None if the line is a directive or
+        can not be encoded this way.
+
+        HOLE.format(k) stands for holes[k]:
+
+            as an operand       an immediate, encoded as the widest the
+                                templates accept for the operand size
+                                (imm64 for mov to a 64-bit register)
+            in a memory operand its displacement, added or subtracted
+            in a label          a part of the label name
+
+        the actions are what is left to the runtime, by their offsets in
+        code:
+
+            (offset, format)            the immediate field of a hole
+            (offset, 'label', name, n)  a label defined at offset
+            (offset, 'branch', forms, name, n)
+                                        a branch, see branchformsof
+            (offset, 'memory', variants, const, sign)
+                                        a line with a displacement hole
+
+        name has '{!r}' for each of its n holes. variants are the
+        (lo, hi, code, fields) of the line for displacements lo..hi,
+        fields the (offset, format) of the displacement (None if it has
+        no field) and of the immediates, the displacement is const + sign
+        * value. order is the indexes of the holes the actions take, in
+        turn. an unsigned field also takes the negative values of its
+        size, see pyasm.Dasm.put.
+        """
+        if self.opindex is not self.asindex:
+            return None
+        stmt = self.splitline(line)
+        if stmt is None:
+            return b'', (), ()
+        return self.encodestatement(*stmt, holes)
+
+    def encodestatement(self, opcode, args, op, holes):
+        # encode a split line, see encode
+        if opcode == '.nop':
+            return b'', (), ()
+        if opcode == '.label' and len(args) == 1:
+            name, order = holename(args[0])
+            return b'', ((0, 'label', name, len(order)),), order
+        if opcode in self.macros and op is self.asindex.get(opcode):
+            return self.encodemacro(self.macros[opcode], args, holes)
+        if callable(op):
+            return None
+
+        sig = []
+        values = []
+        order = []
+        label = mem = None
+        for i, arg in enumerate(args):
+            ks = [int(k) for k in reHole.findall(arg)]
+            if any(k >= len(holes) for k in ks):
+                return None
+            if not ks:
+                c = self.classify(arg)
+                if c is None:
+                    return None
+                if c == 'l':
+                    label = (i, arg, ())
+            elif reHole.fullmatch(arg):
+                order.append(ks[0])
+                sig.append(None)
+                values.append(holes[ks[0]])
+                continue
+            elif '[' in arg and len(ks) == 1 and mem is None:
+                # encoded for every displacement size below
+                c = self.classify(arg)
+                mem = (i, arg, ks[0])
+            elif reLabel.fullmatch(reHole.sub('0', arg)):
+                c = 'l'
+                arg, ks = holename(arg)
+                label = (i, arg, ks)
+            else:
+                return None
+            sig.append(c)
+            values.append(arg if c == 'l' or mem is not None and mem[0] == i else self.operand(arg, c))
+
+        if label is not None:
+            # a branch, with no other hole
+            if order or mem is not None:
+                return None
+            sig = tuple(sig)
+            tmpls = op.get(sig)
+            if tmpls is None:
+                return None
+            i, name, ks = label
+            forms = self.branchformsof(Instruction(opcode, sig, tuple(values), tmpls), i)
+            return b'', ((0, 'branch', forms, name, len(ks)),), ks
+
+        if mem is None:
+            code = self.encodeholes(opcode, op, sig, values)
+            if code is None:
+                return None
+            holes = [values[i] for i, c in enumerate(sig) if c is None]
+            return code, tuple((h.offset, h.format) for h in holes), tuple(order)
+
+        i, arg, k = mem
+        variants = []
+        for lo, hi, disp in ((0, 0, 0), (-128, 127, 1), (-1 << 31, (1 << 31) - 1, 1 << 16)):
+            h = Hole(k)
+            values[i] = self.parsememory(arg, h, disp)
+            code = self.encodeholes(opcode, op, sig, values)
+            if code is None:
+                return None
+            fields = [(h.offset, h.format) if h.offset is not None else None]
+            fields.extend((v.offset, v.format) for v, c in zip(values, sig) if c is None)
+            variants.append((lo, hi, code, tuple(fields)))
+        return b'', ((0, 'memory', tuple(variants), h.const, h.sign),), (k,) + tuple(order)
+
+    def encodeholes(self, opcode, op, sig, values):
+        # the code of a template line with the immediate holes of sig None,
+        # the widest immediate is tried first for them
+        choices = [('i64', 'i32', 'i16', 'i8') if c is None else (c,) for c in sig]
+        for sig in itertools.product(*choices):
+            tmpls = op.get(sig)
+            if tmpls is not None:
+                # the size of a hole is fixed, the first template is taken
+                return bytes(self.dotemplateone(tmpls[0], opcode, values))
+        return None
+
+    def encodemacro(self, macro, params, holes):
+        # encode the body of macro with params for its params, see
+        # expandmacro
+        if len(params) != len(macro.params):
+            return None
+        parts = []
+        for ml in macro.lines:
+            if ml.code is not None:
+                parts.append((ml.code, (), ()))
+                continue
+            opcode = ml.opcode
+            if not isinstance(opcode, str):
+                opcode = params[opcode]
+            args = [a if isinstance(a, str) else
+                    ''.join(p if k % 2 == 0 else params[p] for k, p in enumerate(a))
+                    for a in ml.args]
+            op = ml.op if ml.op is not None else self.asindex.get(opcode)
+            part = None if op is None else self.encodestatement(opcode, args, op, holes)
+            if part is None:
+                return None
+            parts.append(part)
+        return joinencoded(parts)
+
+    def doline(self, line):
+
+        # label-free instruction lines assembled before, not while a
+        # .macro or .type is recorded
+        if self.linecachesize > 0 and self.opindex is self.asindex:
+            code = self.linecache.get(line)
+            if code is not None:
+                self.linehits += 1
+                self.linecache.move_to_end(line)
+                self.resultbin.extend(code)
+                return
+            self.linemisses += 1
+        key = line
+
+        stmt = self.splitline(line)
+        if stmt is None:
+            return
+        start = len(self.resultbin)
+        if self.dostatement(*stmt) and self.linecachesize > 0:
+            # the bytes of a template instruction depend only on the line
+            self.linecache[key] = bytes(self.resultbin[start:])
+            if len(self.linecache) > self.linecachesize:
+                self.linecache.popitem(last=False)
+
+    def dostatement(self, opcode, args, op):
+        """
+        assemble a split line, return True if it is a template
+        instruction (not a directive, macro or branch)
+        """
         if callable(op):
             op(opcode, args)
-        elif isinstance(op, str):
-            self.dotemplate(op, opcode, args)
+            return False
+        return self.doinstruction(self.instruction(opcode, args, op))
+
+    def peepholedoline(self, line):
+        # doline through the peephole window, the lines are not cached
+        stmt = self.splitline(line)
+        if stmt is None:
+            return
+        if self.opindex is self.asindex:
+            self.peephole.push(*stmt)
+        else:
+            self.dostatement(*stmt)
+
+    def profiled(self):
+        """
+        wrap doline and the methods of the phases to count the lines by
+        mnemonic and time the phases, see Profile. the time of a line
+        not spent in the phases is its emit, or directive for a directive
+        line. through the peephole window the lines are encoded as they
+        leave it, their time is charged to the line pushing them out.
+        """
+        # the time of the line in the phases, and its split line
+        spent = [0.0]
+        stmt = [None]
+
+        def timed(phase, f, nested=False):
+            def timedf(*args):
+                start = time.perf_counter()
+                try:
+                    return f(*args)
+                finally:
+                    seconds = time.perf_counter() - start
+                    self.profile.phases[phase] += seconds
+                    if not nested:
+                        spent[0] += seconds
+            return timedf
+
+        splitline = timed('tokenise', self.splitline)
+        def profilesplitline(line):
+            stmt[0] = splitline(line)
+            return stmt[0]
+        self.splitline = profilesplitline
+        self.instruction = timed('dispatch', self.instruction)
+        self.domemory = timed('memory', self.domemory, True)
+        self.dobranch = timed('branch', self.dobranch)
+
+        selecttemplate = timed('encode', self.selecttemplate)
+        def profileselecttemplate(tmpls, op, values):
+            tmpl, code = selecttemplate(tmpls, op, values)
+            self.profile.match(op, tmpl, self.asmap.get('{}-{}'.format(op, len(values)), ()),
+                    len(tmpls) - 1 if self.select == 'shortest' else 0)
+            return tmpl, code
+        self.selecttemplate = profileselecttemplate
+
+        doline = self.doline
+        def profiledoline(line):
+            prof = self.profile
+            hits = self.linehits
+            spent[0] = 0.0
+            stmt[0] = None
+            start = time.perf_counter()
+            doline(line)
+            seconds = time.perf_counter() - start
+            if self.linehits != hits:
+                prof.phases['cache'] += seconds
+                prof.count(line.split(None, 1)[0], seconds)
+            elif stmt[0] is not None:
+                opcode, args, op = stmt[0]
+                prof.phases['directive' if callable(op) else 'emit'] += seconds - spent[0]
+                prof.count(opcode, seconds)
+        self.doline = profiledoline
+
+
+class Profile(object):
+    """
+    counters of AS(profile=True)
+
+    ops: mnemonic -> [lines, seconds]
+    matched: (mnemonic, template) -> lines encoded by the template
+    rejected: mnemonic -> alternatives passed over before the matched
+        one, the templates ahead of it in asmap order (which the index
+        skips) and the candidates losing to it in shortest selection
+    phases: phase -> seconds. tokenise (splitline), dispatch (classify,
+        index lookup and the Instruction), encode, emit, and for other
+        lines cache (line cache hits), branch, directive. memory is the
+        part of dispatch spent in domemory. see AS.profiled
+    """
+    Phases = ('cache', 'tokenise', 'dispatch', 'encode', 'memory', 'emit', 'branch', 'directive')
+
+    def __init__(self):
+        self.ops = {}
+        self.matched = {}
+        self.rejected = {}
+        self.phases = dict.fromkeys(self.Phases, 0.0)
+        # (mnemonic, template) -> position in its asmap list
+        self.positions = {}
+
+    def count(self, opcode, seconds):
+        c = self.ops.get(opcode)
+        if c is None:
+            c = self.ops[opcode] = [0, 0.0]
+        c[0] += 1
+        c[1] += seconds
+
+    def match(self, opcode, tmpl, alternatives, losers):
+        key = (opcode, tmpl.text)
+        self.matched[key] = self.matched.get(key, 0) + 1
+        position = self.positions.get(key)
+        if position is None:
+            texts = [t.text for t in alternatives]
+            position = self.positions[key] = texts.index(tmpl.text) if tmpl.text in texts else 0
+        self.rejected[opcode] = self.rejected.get(opcode, 0) + position + losers
+
+    def merge(self, other):
+        # add the counters of other, e.g. from a worker of translate
+        for opcode, (n, seconds) in other.ops.items():
+            c = self.ops.setdefault(opcode, [0, 0.0])
+            c[0] += n
+            c[1] += seconds
+        for key, n in other.matched.items():
+            self.matched[key] = self.matched.get(key, 0) + n
+        for opcode, n in other.rejected.items():
+            self.rejected[opcode] = self.rejected.get(opcode, 0) + n
+        for phase, seconds in other.phases.items():
+            self.phases[phase] += seconds
+
+    def asdict(self):
+        return {
+            'ops': {op: {'lines': n, 'seconds': seconds, 'rejected': self.rejected.get(op, 0)}
+                for op, (n, seconds) in self.ops.items()},
+            'matched': [{'op': op, 'template': text, 'lines': n}
+                for (op, text), n in sorted(self.matched.items())],
+            'phases': dict(self.phases),
+            }
+
+    def table(self):
+        # the mnemonics by time, the matched templates and the phases
+        lines = ['{:<12} {:>10} {:>10} {:>9} {:>10}'.format('op', 'lines', 'seconds', 'us/line', 'rejected')]
+        for op, (n, seconds) in sorted(self.ops.items(), key=lambda x: -x[1][1]):
+            lines.append('{:<12} {:>10} {:>10.4f} {:>9.2f} {:>10}'.format(
+                op, n, seconds, seconds * 1e6 / n, self.rejected.get(op, 0)))
+        lines.append('')
+        lines.append('{:<12} {:<32} {:>10}'.format('op', 'template', 'lines'))
+        for (op, text), n in sorted(self.matched.items(), key=lambda x: -x[1]):
+            lines.append('{:<12} {:<32} {:>10}'.format(op, text, n))
+        lines.append('')
+        lines.append('{:<12} {:>10}'.format('phase', 'seconds'))
+        for phase in self.Phases:
+            lines.append('{:<12} {:>10.4f}'.format(phase, self.phases[phase]))
+        return '\n'.join(lines)
+
+
+class Peephole(object):
+    """
+    a window of Instructions and labels between instruction and the
+    encoding, see AS(peephole=True). the rules applied to the first
+    entries of it:
+
+        dropcmp: cmp x, 0 or test x, x right after the arithmetic
+            instruction writing x, which set ZF/SF/PF the same way
+        merge: add/sub x, imm followed by add/sub x, imm as one add/sub,
+            or none if they cancel out
+        xorzero: mov reg, 0 as xor reg32, reg32
+
+    a rule rewrites the sig and values of the Instructions, it fires only
+    if the flags it changes are not read afterwards. the liveness is
+    followed through labels, to the branch targets in the window and to
+    the labels assembled before. where the liveness runs past the
+    entries pushed, or to a label not pushed yet, the first entry is held
+    until it is known, with up to reach entries in the window, e.g. at
+    the target of the jz out of a loop head. liveout are the flags taken
+    as live where the window can not see, all of them by default.
+
+    counts: rule -> times it fired
+    """
+    Rules = ('dropcmp', 'merge', 'xorzero')
+
+    def __init__(self, pas, window=8, liveout=None, reach=64):
+        self.pas = pas
+        self.window = window
+        self.reach = reach
+        self.liveout = AllFlags if liveout is None else liveout
+        # set by live when the flags are not known from the entries pushed
+        self.unresolved = False
+        # Instructions not assembled yet, and the names of the labels
+        # between them
+        self.lines = []
+        # flags live at the labels assembled, the last one for local N
+        self.livein = {}
+        self.counts = dict.fromkeys(self.Rules, 0)
+
+    def push(self, opcode, args, op):
+        if not callable(op):
+            self.lines.append(self.pas.instruction(opcode, args, op))
+        elif opcode == '.label' and len(args) == 1:
+            self.lines.append(args[0])
+        else:
+            # directives and macros are not looked through
+            self.drain()
+            self.pas.dostatement(opcode, args, op)
+            return
+        while len(self.lines) > self.window and self.emit(len(self.lines) > self.reach):
+            pass
+
+    def drain(self):
+        while self.lines:
+            self.emit(True)
+
+    def emit(self, force=False):
+        """
+        assemble the first entry after rewriting it, return True. unless
+        force, False is returned instead if the liveness of a rule waits
+        for the entries not pushed yet.
+        """
+        self.unresolved = False
+        while self.rewrite():
+            pass
+        ins = self.lines[0]
+        if isinstance(ins, str):
+            livein = self.live(-1, AllFlags)
+        if self.unresolved and not force:
+            return False
+        del self.lines[0]
+        if isinstance(ins, str):
+            self.livein[ins] = livein
+            self.pas.dolabel('.label', [ins])
+        else:
+            self.pas.doinstruction(ins)
+        return True
+
+    def live(self, i, flags):
+        """
+        the flags of flags which may be read after lines[i]
+        """
+        lines = self.lines
+        found = 0
+        for j in range(i+1, len(lines)):
+            ins = lines[j]
+            if isinstance(ins, str):
+                continue
+            opcode = ins.opcode
+            reads, writes = FlagUse.get(opcode, (AllFlags, 0))
+            found |= reads & flags
+            if opcode[0] == 'j' and opcode in FlagUse and len(ins.sig) == 1:
+                if ins.sig[0] == 'l':
+                    found |= self.target(j, ins.values[0], flags)
+                else:
+                    found |= flags & self.liveout
+                if opcode == 'jmp':
+                    return found
+            flags &= ~writes
+            if not flags:
+                return found
+        self.unresolved = True
+        return found | (flags & self.liveout)
+
+    def target(self, j, label, flags):
+        # the flags of flags which may be read at label, branched to by lines[j]
+        lines = self.lines
+        if label[0] == '>':
+            name = label[1:]
+            for k in range(j+1, len(lines)):
+                if lines[k] == name:
+                    return self.live(k, flags)
+            self.unresolved = True
+            return flags & self.liveout
+        if label[0] == '<':
+            label = label[1:]
         else:
-            raise ValueError
+            for k in range(j+1, len(lines)):
+                if lines[k] == label:
+                    return self.live(k, flags)
+        if label in lines[:j]:
+            # a loop in the window, not followed
+            return flags & self.liveout
+        if label not in self.livein and not label.isdigit() and label not in self.pas.glabels \
+                and label not in self.pas.externs:
+            # a forward global label
+            self.unresolved = True
+        return flags & self.livein.get(label, self.liveout)
+
+    def rewrite(self):
+        # apply a rule to the first entries, return True if one fired
+        lines = self.lines
+        ins = lines[0]
+        if isinstance(ins, str):
+            return False
+        sig, values = ins.sig, ins.values
+        base, bits = mnemonic(ins)
+
+        if ins.opcode == 'mov' and len(sig) == 2 and sig[0][0] in 'acr' and immediate(ins, 1) == 0 \
+                and not self.live(0, AllFlags):
+            # writing the 32-bit register clears the upper half
+            c = sig[0][0] + '32' if bits == 64 else sig[0]
+            xor = self.rebuild('xor', (c, c), (values[0], values[0]))
+            if xor is not None:
+                lines[0] = xor
+                self.counts['xorzero'] += 1
+                return True
+
+        if len(lines) < 2 or isinstance(lines[1], str):
+            return False
+        ins1 = lines[1]
+        sig1, values1 = ins1.sig, ins1.values
+        base1, bits1 = mnemonic(ins1)
+        if ins1.opcode[len(base1):] != ins.opcode[len(base):] or not sig or not sig1 \
+                or not sameoperand(sig[0], values[0], sig1[0], values1[0]):
+            return False
+
+        if base in CmpFlags and len(sig1) == 2 and (base1 == 'cmp' and immediate(ins1, 1) == 0 or
+                base1 == 'test' and sameoperand(sig1[0], values1[0], sig1[1], values1[1])) \
+                and not self.live(1, CmpFlags[base]):
+            del lines[1]
+            self.counts['dropcmp'] += 1
+            return True
+
+        if base in ('add', 'sub') and base1 in ('add', 'sub') and bits is not None and bits == bits1 \
+                and len(sig) == 2 and len(sig1) == 2:
+            v, v1 = immediate(ins, 1), immediate(ins1, 1)
+            if v is None or v1 is None:
+                return False
+            half = 1 << (bits-1)
+            if not (-half <= v < half and -half <= v1 < half):
+                return False
+            n = (v if base == 'add' else -v) + (v1 if base1 == 'add' else -v1)
+            n = (n + half) % (2*half) - half
+            if not -(1 << 31) <= n < (1 << 31):
+                return False
+            if n == 0:
+                if self.live(1, AllFlags):
+                    return False
+                del lines[:2]
+            else:
+                if self.live(1, FlagC | FlagA | FlagO):
+                    return False
+                suffix = ins.opcode[len(base):]
+                name, n = ('sub', -n) if n < 0 and n != -half else ('add', n)
+                merged = self.rebuild(name + suffix, (sig[0], intclass(n)), (values[0], n))
+                if merged is None:
+                    return False
+                lines[:2] = [merged]
+            self.counts['merge'] += 1
+            return True
+        return False
+
+    def rebuild(self, opcode, sig, values):
+        # the Instruction of opcode with the operands sig and values, None
+        # if no template takes them
+        op = self.pas.asindex.get(opcode)
+        tmpls = op.get(sig) if op is not None and not callable(op) else None
+        if tmpls is None:
+            return None
+        return Instruction(sys.intern(opcode), self.pas.sigs.setdefault(sig, sig), values, tmpls)
+
+
+def mnemonic(ins):
+    """
+    (base mnemonic, operand bits) of an Instruction, addb [rbx], 1 and
+    add byte [rbx], 1 are ('add', 8). bits is None if it is not known.
+    """
+    opcode = ins.opcode
+    bits = None
+    base = opcode
+    if opcode[-1:] in SizeSuffix and opcode[:-1] in FlagUse:
+        base = opcode[:-1]
+        bits = SizeSuffix[opcode[-1]]
+    if ins.sig:
+        c = ins.sig[0]
+        if c[0] in 'acrm' and c[1:].isdigit():
+            bits = int(c[1:])
+    return base, bits
+
+def immediate(ins, i):
+    # the integer operand i of an Instruction, None if it is no integer
+    c = ins.sig[i] if i < len(ins.sig) else None
+    if c is not None and (c[0] in 'inu' or c == 'd1'):
+        return ins.values[i]
+    return None
+
+def sameoperand(c, v, c1, v1):
+    # operands of classes c, c1 with values v, v1 are the same
+    if c != c1:
+        return False
+    if c[0] == 'm':
+        return (v.segment, v.modrm, v.sib, v.displacement, v.rex) == \
+                (v1.segment, v1.modrm, v1.sib, v1.displacement, v1.rex)
+    return v == v1
+
+def intclass(v):
+    # operand class of the integer v, None if it is too wide, see AS.classify
+    if v == 1: return 'd1'
+    for k in (8, 16, 32, 64):
+        if v < 0:
+            if v >= -(1<<(k-1)): return 'n{}'.format(k)
+        elif v < (1<<(k-1)):
+            return 'i{}'.format(k)
+        elif v < (1<<k):
+            return 'u{}'.format(k)
+    return None
+
+def holename(arg):
+    # a label operand with holes: the name with '{!r}' for them, and the
+    # indexes of the holes
+    pieces = reHole.split(arg)
+    name = ''.join(p.replace('{', '{{').replace('}', '}}') if k % 2 == 0 else '{!r}'
+                   for k, p in enumerate(pieces))
+    return name, tuple(int(p) for p in pieces[1::2])
+
+def joinencoded(parts):
+    # the (code, actions, order) of encoded lines one after another, see
+    # AS.encode
+    code = b''
+    actions = []
+    order = []
+    for c, a, o in parts:
+        actions.extend((action[0] + len(code),) + action[1:] for action in a)
+        order.extend(o)
+        code += c
+    return code, tuple(actions), tuple(order)
 
 ########################### constant ##########################
 cclist = [
@@ -888,6 +2638,13 @@ regAbits = {
     'rax':  64, # with REX prefix
     }
 
+regCbits = {
+    'cl':   8,
+    'cx':   16,
+    'ecx':  32,
+    'rcx':  64,
+    }
+
 Scale = {
     '1': 0,
     '2': 1,
@@ -1046,6 +2803,86 @@ SegPrefix = {
     'ss':    0x36,
     }
 
+MemSize = {
+    'byte':  8,
+    'word':  16,
+    'dword': 32,
+    'qword': 64,
+    'aword': 64, # address size
+    }
+
+# size suffix of mnemonics, e.g. addb/addw/addd/addl/addq
+SizeSuffix = {
+    'b': 8,
+    'w': 16,
+    'd': 32,
+    'l': 32,
+    'q': 64,
+    }
+
+# status flags, as the bits of rflags
+FlagC = 0x1
+FlagP = 0x4
+FlagA = 0x10
+FlagZ = 0x40
+FlagS = 0x80
+FlagO = 0x800
+AllFlags = FlagC | FlagP | FlagA | FlagZ | FlagS | FlagO
+
+# flags read by the condition codes, by cclist number >> 1
+CondFlags = (FlagO, FlagC, FlagZ, FlagC | FlagZ, FlagS, FlagP, FlagS | FlagO, FlagZ | FlagS | FlagO)
+
+# mnemonic -> (flags read, flags written) for the flag liveness of
+# Peephole, a mnemonic not here reads all and writes none. the shifts
+# write none as their count may be 0. call and ret read all, the flags
+# may be passed to the code called or returned to.
+FlagUse = {}
+for name in ('add', 'sub', 'cmp', 'and', 'or', 'xor', 'test', 'neg', 'mul', 'imul', 'div', 'idiv'):
+    FlagUse[name] = (0, AllFlags)
+for name in ('adc', 'sbb'):
+    FlagUse[name] = (FlagC, AllFlags)
+for name in ('inc', 'dec'):
+    FlagUse[name] = (0, AllFlags & ~FlagC)
+for name in ('rcl', 'rcr'):
+    FlagUse[name] = (FlagC, 0)
+for name in ('rol', 'ror', 'shl', 'sal', 'shr', 'sar', 'mov', 'movzx', 'movsx', 'movsxd', 'lea',
+        'push', 'pop', 'nop', 'not', 'xchg', 'cbw', 'cwde', 'cdqe', 'cwd', 'cdq', 'cqo', 'enter', 'leave', 'jmp'):
+    FlagUse[name] = (0, 0)
+for name in ('call', 'ret'):
+    FlagUse[name] = (AllFlags, 0)
+for name in list(FlagUse):
+    for suffix in SizeSuffix:
+        FlagUse.setdefault(name + suffix, FlagUse[name])
+for cc, n in cclist:
+    for name in ('j', 'set', 'cmov'):
+        FlagUse[name + cc] = (CondFlags[n >> 1], 0)
+
+# flags a compare with 0 after the mnemonic sets unlike it, see Peephole
+CmpFlags = {
+    'add': FlagC | FlagA | FlagO,
+    'sub': FlagC | FlagA | FlagO,
+    'adc': FlagC | FlagA | FlagO,
+    'sbb': FlagC | FlagA | FlagO,
+    'neg': FlagC | FlagA | FlagO,
+    'inc': FlagC | FlagA | FlagO,
+    'dec': FlagC | FlagA | FlagO,
+    'and': FlagA,
+    'or':  FlagA,
+    'xor': FlagA,
+    }
+
+reInteger = re.compile(r'[-+]?(0[xX][0-9a-fA-F]+|0[oO][0-7]+|0[bB][01]+|[1-9][0-9]*|0)')
+reFloat = re.compile(r'[-+]?([0-9]+\.[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?|[-+]?[0-9]+[eE][-+]?[0-9]+')
+reLabel = re.compile(r'[<>][0-9]+|@\w+|[A-Za-z_]\w*')
+reWord = re.compile(r'\b[A-Za-z_]\w*')
+reLabelLine = re.compile(r'\s*(@?[\w\x00]+)\s*:\s*')
+reOpcode = re.compile(r'\s*([-.\w]+)')
+reHole = re.compile(r'\x00(\d+)\x00')
+HOLE = '\x00{}\x00'
+reSizedMemory = re.compile(r'(byte|word|dword|qword|aword)\s+(.*)')
+reTypeMemory = re.compile(r'(\w+)\s*:\s*[\w.]+')
+reTypePath = re.compile(r'(\w+):([\w.]+)')
+
 Prefix = {
     # group 1
     'lock':  0xF0,
@@ -1079,16 +2916,172 @@ Prefix = {
     }
 
 
-def translate(file, out):
-    pas = AS()
+# output formats of translate, format(out) returns the write function
+Formats = {
+    'hex': lambda out: (lambda b: out.write(b.hex())),
+    'raw': lambda out: getattr(out, 'buffer', out).write,
+    }
+
+# blocks of lines which only change the state of AS, opening -> closing,
+# and such lines
+StateBlocks = {
+    '.type': '.endtype',
+    '.macro': '.endmacro',
+    }
+StateLines = ('.define', '.extern')
+
+def splitchunks(lines, chunklines):
+    """
+    split lines at global labels into chunks of at least chunklines
+    lines, return [(prelude, chunk)]. prelude has the state blocks of the
+    chunks before, which set up an AS for the chunk.
+    """
+    chunks = []
+    chunk = []
+    prelude = []
+    start = 0
+    block = None
+    for line in lines:
+        m = reOpcode.match(line)
+        opcode = m.group(1) if m else None
+        if block is None and len(chunk) >= chunklines:
+            m = reLabelLine.fullmatch(line)
+            if m:
+                name = m.group(1)
+            else:
+                words = line.split()
+                name = words[1] if opcode == '.label' and len(words) == 2 else '0'
+            if not name.isdigit():
+                chunks.append((prelude[:start], chunk))
+                chunk = []
+                start = len(prelude)
+        if block is not None:
+            prelude.append(line)
+            if opcode == block:
+                block = None
+        elif opcode in StateBlocks:
+            prelude.append(line)
+            block = StateBlocks[opcode]
+        elif opcode in StateLines:
+            prelude.append(line)
+        chunk.append(line)
+    chunks.append((prelude[:start], chunk))
+    return chunks
+
+def assemblechunk(prelude, lines, select='first', profile=False, peephole=False):
+    """
+    assemble a chunk in a worker, return (code, events, counters, profile,
+    peephole counts). the labels and branches are recorded in events for
+    AS.link.
+    """
+    pas = AS(select, profile=profile, peephole=peephole)
+    for line in prelude:
+        pas.doline(line)
+    # the prelude is counted by the chunk it comes from
+    before = (pas.memhits, pas.memmisses, pas.linehits, pas.linemisses)
+    if profile:
+        pas.profile = Profile()
+    pas.events = []
+    for line in lines:
+        pas.doline(line)
+    counts = None
+    if pas.peephole is not None:
+        pas.peephole.drain()
+        counts = pas.peephole.counts
+    counters = (pas.memhits, pas.memmisses, pas.linehits, pas.linemisses)
+    return bytes(pas.resultbin), pas.events, tuple(n - m for n, m in zip(counters, before)), \
+            pas.profile, counts
+
+def translate(file, out, select='first', format='hex', chunksize=1<<16, layout='relax', jobs=1, profile=False,
+        peephole=False):
+    """
+    assemble file and write the machine code to out every chunksize bytes
+
+    jobs > 1 assembles chunks of the file split at global labels in a
+    process pool, and links them in order, the machine code is the same.
+    with peephole the windows end at the chunks, which may keep a rule
+    from firing.
+    """
+    write = Formats[format](out)
+    pas = AS(select, layout=layout, profile=profile, peephole=peephole)
+    # bytes held back by pending branches are retried after chunksize more
+    limit = chunksize
     with open(file) as f:
-        for line in f:
-            pas.doline(line)
-    out.write(pas.resultbin.hex())
+        if jobs <= 1:
+            for line in f:
+                pas.doline(line)
+                if len(pas.resultbin) >= limit:
+                    pas.flush(write)
+                    limit = len(pas.resultbin) + chunksize
+            pas.finish()
+            pas.flush(write, True)
+            return pas
+        lines = f.readlines()
+
+    from concurrent.futures import ProcessPoolExecutor
+    chunks = splitchunks(lines, max(1000, len(lines) // (jobs * 4)))
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(assemblechunk,
+                [prelude for prelude, chunk in chunks],
+                [chunk for prelude, chunk in chunks],
+                itertools.repeat(select),
+                itertools.repeat(profile),
+                itertools.repeat(peephole))
+        for code, events, counters, chunkprofile, counts in results:
+            pas.link(code, events)
+            pas.memhits += counters[0]
+            pas.memmisses += counters[1]
+            pas.linehits += counters[2]
+            pas.linemisses += counters[3]
+            if chunkprofile is not None:
+                pas.profile.merge(chunkprofile)
+            if counts is not None:
+                for rule, n in counts.items():
+                    pas.peephole.counts[rule] += n
+            if len(pas.resultbin) >= limit:
+                pas.flush(write)
+                limit = len(pas.resultbin) + chunksize
+    pas.finish()
+    pas.flush(write, True)
+    return pas
 
 if __name__ == '__main__':
-    from sys import stdout, argv
-    if len(argv) != 2:
-        print("Usage: {} xxx.as".format(argv[0]))
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='assemble xxx.as into machine code')
+    parser.add_argument('file', help='xxx.as')
+    parser.add_argument('--select', choices=['first', 'shortest'], default='first',
+            help='template selection, first matched (default) or shortest encoding')
+    parser.add_argument('-f', '--format', choices=sorted(Formats), default='hex',
+            help='output format, hex text (default) or raw machine code')
+    parser.add_argument('--layout', choices=['relax', 'onepass'], default='relax',
+            help='branch layout, relaxed by finish (default) or in one pass')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of processes assembling in parallel, 1 by default')
+    parser.add_argument('--profile', choices=['table', 'json'],
+            help='print the time per mnemonic, template and phase to stderr')
+    parser.add_argument('--peephole', action='store_true',
+            help='drop redundant compares, merge add/sub and clear registers with xor')
+    parser.add_argument('-o', '--output', help='output file, stdout by default')
+    parser.add_argument('--stats', action='store_true',
+            help='print cache, branch and peephole statistics to stderr')
+    args = parser.parse_args()
+    if args.output is None:
+        pas = translate(args.file, sys.stdout, args.select, args.format, layout=args.layout, jobs=args.jobs,
+                profile=args.profile is not None, peephole=args.peephole)
     else:
-        translate(argv[1], stdout)
+        with open(args.output, 'w' if args.format == 'hex' else 'wb') as out:
+            pas = translate(args.file, out, args.select, args.format, layout=args.layout, jobs=args.jobs,
+                    profile=args.profile is not None, peephole=args.peephole)
+    if args.stats:
+        print('memory operand cache: {} hits, {} misses'.format(pas.memhits, pas.memmisses), file=sys.stderr)
+        print('line cache: {} hits, {} misses'.format(pas.linehits, pas.linemisses), file=sys.stderr)
+        print('branches: {} short, {} near'.format(pas.shortbranches, pas.nearbranches), file=sys.stderr)
+        if pas.peephole is not None:
+            print('peephole: {}'.format(', '.join('{} {}'.format(rule, n)
+                for rule, n in pas.peephole.counts.items())), file=sys.stderr)
+    if args.profile == 'table':
+        print(pas.profile.table(), file=sys.stderr)
+    elif args.profile == 'json':
+        import json
+        print(json.dumps(pas.profile.asdict(), indent=2), file=sys.stderr)
@@ -0,0 +1,213 @@
+"""
+benchmarks of the assembler and the preprocessor
+
+    python bench.py -o new.json
+    python bench.py --baseline old.json --threshold 0.1
+
+the workloads are generated from mandelbrot.bf repeated --scales times:
+brainfuck.pas is translated by pyasm, the result translates the program
+into assembly lines, and AS assembles them. a metric worse than the
+baseline by more than threshold fails the run.
+"""
+import contextlib
+import importlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import pyasm
+
+asm = importlib.import_module('as')
+
+
+def timeit(func, *args, repeat=3):
+    # the best wall time of repeat runs, and the result of the last one
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best, result
+
+
+def peakmemory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def translatepas(file, mode='print'):
+    out = io.StringIO()
+    pyasm.translate(file, out, mode)
+    return out.getvalue()
+
+
+def bfassembly(source, program):
+    """
+    the assembly lines of a brainfuck program, by the translator source
+    pyasm made of brainfuck.pas
+    """
+    ns = {'__name__': 'brainfuck'}
+    exec(compile(source, 'brainfuck.py', 'exec'), ns)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ns['translate'](program + '\0')
+    return out.getvalue().split('\n')
+
+
+def check(lines):
+    """
+    assemble lines once and return them, a line AS rejects is an error
+    naming it, the workload must be the whole translator output
+    """
+    pas = asm.AS()
+    for n, line in enumerate(lines, 1):
+        try:
+            pas.doline(line)
+        except ValueError as e:
+            raise ValueError('line {} {!r} rejected: {}'.format(n, line, e)) from None
+    pas.finish()
+    return lines
+
+
+def assemble(lines, **kw):
+    pas = asm.AS(**kw)
+    for line in lines:
+        pas.doline(line)
+    pas.finish()
+    return pas
+
+
+def mnemoniccost(lines, repeat=3):
+    """
+    encoding cost of every mnemonic in microseconds per line, with the
+    line cache off. lines encode does not take (labels, branches,
+    directives and macros) are left out, they are assembled for the
+    defines and macros they set up.
+    """
+    pas = asm.AS(linecachesize=0)
+    groups = {}
+    for line in lines:
+        stmt = line.split()
+        if stmt and not stmt[0].startswith('.') and stmt[0] not in pas.macros \
+                and pas.encode(line) is not None:
+            groups.setdefault(stmt[0], []).append(line)
+        else:
+            pas.doline(line)
+    costs = {}
+    for mnemonic, group in sorted(groups.items()):
+        def encodeall():
+            for line in group:
+                pas.encode(line)
+        t, _ = timeit(encodeall, repeat=repeat)
+        costs[mnemonic] = t * 1e6 / len(group)
+    return costs
+
+
+def run(scales, pas='brainfuck.pas', bf='mandelbrot.bf', fixture='t/t.as', repeat=3):
+    results = {}
+
+    # pyasm.translate on brainfuck.pas
+    nlines = len(open(pas).readlines())
+    for mode in ('print', 'actions'):
+        t, source = timeit(translatepas, pas, mode, repeat=repeat)
+        results['pyasm.{}'.format(mode)] = {
+            'lines_per_s': nlines / t,
+            'seconds': t,
+            }
+    source = translatepas(pas)
+
+    program = open(bf).read()
+    with open(fixture) as f:
+        lines = f.read().split('\n')
+    lines.extend(check(bfassembly(source, program)))
+    results['mnemonic'] = {'us_per_line': mnemoniccost(lines, repeat)}
+
+    for scale in scales:
+        t, lines = timeit(bfassembly, source, program * scale, repeat=1)
+        results['brainfuck.x{}'.format(scale)] = {
+            'lines_per_s': len(lines) / t,
+            'seconds': t,
+            }
+
+        check(lines)
+        t, done = timeit(assemble, lines, repeat=repeat)
+        nbytes = len(done.resultbin)
+        results['doline.x{}'.format(scale)] = {
+            'lines': len(lines),
+            'bytes': nbytes,
+            'lines_per_s': len(lines) / t,
+            'bytes_per_s': nbytes / t,
+            'seconds': t,
+            'peak_bytes': peakmemory(assemble, lines),
+            }
+    return results
+
+
+# direction of the metrics, by the end of their names
+HigherIsBetter = ('_per_s',)
+LowerIsBetter = ('us_per_line', 'peak_bytes')
+
+def regressions(old, new, threshold):
+    """
+    the metrics of new worse than old by more than threshold (a ratio),
+    as [(benchmark, metric, old, new)]
+    """
+    found = []
+    for bench, metrics in new.items():
+        for metric, value in metrics.items():
+            before = old.get(bench, {}).get(metric)
+            if before is None:
+                continue
+            if isinstance(value, dict):
+                for key, v in value.items():
+                    if key in before and v > before[key] * (1 + threshold):
+                        found.append(('{}.{}'.format(bench, key), metric, before[key], v))
+            elif metric.endswith(HigherIsBetter) and value < before * (1 - threshold):
+                found.append((bench, metric, before, value))
+            elif metric.endswith(LowerIsBetter) and value > before * (1 + threshold):
+                found.append((bench, metric, before, value))
+    return found
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='benchmark the assembler and the preprocessor')
+    parser.add_argument('--scales', default='10,100',
+            help='workload sizes in copies of mandelbrot.bf, 10,100 by default')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='runs of every benchmark, the best is taken, 3 by default')
+    parser.add_argument('-o', '--output', help='JSON result file, stdout by default')
+    parser.add_argument('--baseline', help='JSON result file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+            help='allowed slowdown against the baseline, 0.1 (10%%) by default')
+    args = parser.parse_args()
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': run([int(s) for s in args.scales.split(',')], repeat=args.repeat),
+        }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(baseline['results'], report['results'], args.threshold)
+        for bench, metric, before, value in found:
+            print('regression: {} {} {:.6g} -> {:.6g}'.format(bench, metric, before, value), file=sys.stderr)
+        if found:
+            sys.exit(1)
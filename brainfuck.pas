@@ -1,11 +1,34 @@
 TAPE_LENGTH = 30000
 
-def translate(program):
-    ip = 0
-
-    rstack = []
-    nextpc = 0
+def loopbody(program, ip):
+    """
+    the loop with its body at program[ip:], just after '[', if it has no
+    inner loop and no io: (delta, step, end), delta maps the offsets from
+    the pointer to the change of the cells in an iteration, step is the
+    pointer move of an iteration, end the index after ']'. None otherwise.
+    """
+    delta = {}
+    offset = 0
+    while True:
+        i = program[ip]
+        ip += 1
+        if i == '+':
+            delta[offset] = delta.get(offset, 0) + 1
+        elif i == '-':
+            delta[offset] = delta.get(offset, 0) - 1
+        elif i == '>':
+            offset += 1
+        elif i == '<':
+            offset -= 1
+        elif i == ']':
+            delta = {k: d % 256 for k, d in delta.items() if d % 256 != 0}
+            return delta, offset, ip
+        elif i in '[.,\0':
+            return None
 
+def prelude():
+    # the registers, macros and the state type of the code, before the
+    # helpers so that pyasm encodes their lines at translation time
     $$$
     # test comment
     .define aPtr, rbx # test comment on this line
@@ -16,7 +39,6 @@ def translate(program):
     .define rArg2, rsi
     .macro precall1, arg1
       mov rArg1, arg1
-      mov rArg2, arg2
     .endmacro
     .define postcall, .nop
     .macro prologue
@@ -43,9 +65,113 @@ def translate(program):
     .endtype
     $$$
 
-    $ .byte 'a"si\'b{}\'c\t', "ab{d\" ' ef\n", {TAPE_LENGTH/2}
+def move(n, guard=False):
+    # aPtr += n on the circular tape, or the growing one of guard
+    if guard:
+        if n > 0:
+            $ add aPtr, {n}
+        elif n < 0:
+            $ sub aPtr, {-n}
+    elif n < 0:
+        $ sub aPtr, {-n%TAPE_LENGTH}
+        $ cmp aPtr, aTapeBegin
+        $ ja >1
+        $ add aPtr, {TAPE_LENGTH}
+        $1:
+    else:
+        $ add aPtr, {n%TAPE_LENGTH}
+        $ cmp aPtr, aTapeEnd
+        $ jbe >1
+        $ sub aPtr, {TAPE_LENGTH}
+        $1:
+
+def change(k, n):
+    # cell [aPtr + k] += n, which is in the tape
+    n = (n + 128) % 256 - 128
+    if n > 0 or n == -128:
+        if k > 0:
+            $ add byte [aPtr + {k}], {n}
+        elif k < 0:
+            $ add byte [aPtr - {-k}], {n}
+        else:
+            $ add byte [aPtr], {n}
+    elif n < 0:
+        if k > 0:
+            $ sub byte [aPtr + {k}], {-n}
+        elif k < 0:
+            $ sub byte [aPtr - {-k}], {-n}
+        else:
+            $ sub byte [aPtr], {-n}
+
+def block(runs, guard=False):
+    """
+    the +-<> runs [(moves, n)] between loop boundaries and io, with the
+    pointer moves folded into the displacements of the cells changed.
+    if the cells are all in the tape, aPtr is moved once with no wrap
+    check, else the runs are taken one by one. a block of one move is
+    left as it is. the growing tape of guard needs no check.
+    """
+    offset = lo = hi = 0
+    cells = {}
+    for moves, n in runs:
+        if moves:
+            offset += n
+            lo = min(lo, offset)
+            hi = max(hi, offset)
+        else:
+            cells[offset] = cells.get(offset, 0) + n
+    if guard:
+        lo = hi = 0
+    elif sum(moves for moves, n in runs) == 1 or -lo >= TAPE_LENGTH or hi >= TAPE_LENGTH:
+        for moves, n in runs:
+            if moves:
+                move(n)
+            else:
+                change(0, n)
+        return
+
+    if lo < 0:
+        $ lea rcx, [aPtr - {-lo}]
+        $ cmp rcx, aTapeBegin
+        $ jbe >4
+    if hi > 0:
+        $ lea rcx, [aPtr + {hi}]
+        $ cmp rcx, aTapeEnd
+        $ ja >4
+    for k, n in cells.items():
+        change(k, n)
+    if offset > 0:
+        $ add aPtr, {offset}
+    elif offset < 0:
+        $ sub aPtr, {-offset}
+    if lo == hi == 0:
+        return
+    $ jmp >5
+    $4:
+    for moves, n in runs:
+        if moves:
+            move(n)
+        else:
+            change(0, n)
+    $5:
+
+def translate(program, fold=False, guard=False):
+    """
+    print the assembly of program, return the number of loops reduced by
+    kind: clear [-], copy [->+<], multiply [->++>+++<<] and scan [>].
+    fold moves the pointer once for the +-<> between loop boundaries and
+    io, see block. guard drops the wrap checks of the pointer, the tape
+    must be a loader.Tape, which grows when the pointer runs off it.
+    """
+    ip = 0
+
+    rstack = []
+    nextpc = 0
+    reduced = {'clear': 0, 'copy': 0, 'multiply': 0, 'scan': 0}
+    runs = []
+
+    prelude()
 
-    $ .code
     $bf_main:
     $ prologue
     $ mov aPtr, aState:state.tape
@@ -55,58 +181,119 @@ def translate(program):
     while True:
         i = program[ip]
         ip += 1
-        if i == '<':
+        if i in '<>+-':
             n = 1
-            while program[ip] == '<':
+            while program[ip] == i:
                 ip += 1
                 n += 1
-            $ sub aPtr, {n%TAPE_LENGTH}
-            $ cmp aPtr, aTapeBegin
-            $ ja >1
-            $ add aPtr, {TAPE_LENGTH}
-            $1:
-        elif i == '>':
-            n = 1
-            while program[ip] == '>':
-                ip += 1
-                n += 1
-            $ add aPtr, {n%TAPE_LENGTH}
-            $ cmp aPtr, aTapeEnd
-            $ jbe >1
-            $ sub aPtr, {TAPE_LENGTH}
-            $1:
-        elif i == '+':
-            n = 1
-            while program[ip] == '+':
-                ip += 1
-                n += 1
-            $ add byte [aPtr], {n}
-        elif i == '-':
-            n = 1
-            while program[ip] == '-':
-                ip += 1
-                n += 1
-            $ sub byte [aPtr], {n}
-        elif i == ',':
+            if i in '<-':
+                n = -n
+            if fold:
+                runs.append((i in '<>', n))
+            elif i in '<>':
+                move(n, guard)
+            else:
+                change(0, n)
+            continue
+        if i in '[].,\0' and runs:
+            block(runs, guard)
+            runs = []
+
+        if i == ',':
             $ call aword aState:state.get_char
             $ postcall 1
             $ mov byte [aPtr], al
         elif i == '.':
-            $ movzx r0, byte [aPtr]
-            $ precall1 r0
+            $ movzx eax, byte [aPtr]
+            $ precall1 rax
             $ call aword aState:state.put_char
             $ postcall 2
         elif i == '[':
-            if program[ip] == '-' and program[ip+1] == ']':
-                ip += 2
-                $ xor eax, eax
-                $ mov byte [aPtr], al
-            else:
+            kind = None
+            loop = loopbody(program, ip)
+            if loop is not None:
+                delta, step, end = loop
+                # the cell at the pointer counts down or up to 0, as many
+                # times as its value times factor
+                factor = {1: -1, 255: 1}.get(delta.get(0))
+                if step == 0 and factor is not None:
+                    factors = [(k, (d * factor + 128) % 256 - 128)
+                            for k, d in sorted(delta.items()) if k != 0]
+                    if not factors:
+                        kind = 'clear'
+                    elif all(abs(k) < TAPE_LENGTH for k, f in factors):
+                        kind = 'copy' if all(f == 1 for k, f in factors) else 'multiply'
+                elif not delta and step % TAPE_LENGTH != 0:
+                    kind = 'scan'
+
+            if kind is None:
                 $ cmp byte [aPtr], 0
                 $ jz @{nextpc + 1}
                 $@{nextpc}:
                 rstack.append(nextpc)
                 nextpc += 2
+                continue
+            ip = end
+            reduced[kind] += 1
+            if kind == 'clear':
+                $ xor eax, eax
+                $ mov byte [aPtr], al
+            elif kind == 'scan' and guard:
+                $ jmp >2
+                $1:
+                move(step, guard)
+                $2:
+                $ cmp byte [aPtr], 0
+                $ jnz <1
+            elif kind == 'scan':
+                # [>] and [<<], the zero test on top, the wrap out of it
+                if step > 0:
+                    $1:
+                    $ cmp byte [aPtr], 0
+                    $ jz >3
+                    $ add aPtr, {step % TAPE_LENGTH}
+                    $ cmp aPtr, aTapeEnd
+                    $ jbe <1
+                    $ sub aPtr, {TAPE_LENGTH}
+                    $ jmp <1
+                    $3:
+                else:
+                    $1:
+                    $ cmp byte [aPtr], 0
+                    $ jz >3
+                    $ sub aPtr, {-step % TAPE_LENGTH}
+                    $ cmp aPtr, aTapeBegin
+                    $ ja <1
+                    $ add aPtr, {TAPE_LENGTH}
+                    $ jmp <1
+                    $3:
+            else:
+                # cell[k] += cell[0] * factor for the cells of a pointer
+                # neutral loop, straight-line with no back edge
+                $ movzx eax, byte [aPtr]
+                for k, f in factors:
+                    if guard and k > 0:
+                        $ lea rdx, [aPtr + {k}]
+                    elif guard:
+                        $ lea rdx, [aPtr - {-k}]
+                    elif k > 0:
+                        $ lea rdx, [aPtr + {k}]
+                        $ lea rcx, [aPtr - {TAPE_LENGTH - k}]
+                        $ cmp rdx, aTapeEnd
+                        $ cmova rdx, rcx
+                    else:
+                        $ lea rdx, [aPtr - {-k}]
+                        $ lea rcx, [aPtr + {TAPE_LENGTH + k}]
+                        $ cmp rdx, aTapeBegin
+                        $ cmovbe rdx, rcx
+                    if f == 1:
+                        $ add byte [rdx], al
+                    elif f == -1:
+                        $ sub byte [rdx], al
+                    else:
+                        $ imul ecx, eax, {f}
+                        $ add byte [rdx], cl
+                $ mov byte [aPtr], 0
         elif i == ']':
             if len(rstack) == 0:
                 raise ValueError("no corresponding '['")
@@ -118,16 +305,114 @@ def translate(program):
             if len(rstack) > 0:
                 raise ValueError("no corresponding ']'")
             $ epilogue
-            return 
+            if guard:
+                # where the code continues after running off the tape
+                $bf_fault:
+                $ epilogue
+            return reduced
 
-if __name__ == '__main__':
-    from sys import argv
-    if len(argv) != 2:
-        print('Usage: python brainfuck.pas bffile')
+def statetype():
+    # the .type state of translate, with no AS to define it
+    import importlib
+    asm = importlib.import_module('as')
+    ptr = asm.TypeManager().typeof('.ptr')
+    tp = asm.Type('state')
+    for name in ('tape', 'get_char', 'put_char'):
+        tp.addMember(name, ptr)
+    return tp
+
+def run(program, fold=False, guard=False, cache=None):
+    """
+    assemble program and run it, reading stdin and writing stdout, with
+    the assembly printed in the print or emit mode of pyasm, or encoded
+    by _dasm in the actions mode. return the loops reduced, see
+    translate.
+
+    cache is a codecache directory, the code is looked up by program,
+    the options and the sources of the translator and the assembler
+    before it is made. None is returned for the code found there.
+
+    guard is ignored where loader.GuardPages is False, the tape is
+    checked as without it.
+    """
+    import contextlib
+    import ctypes
+    import importlib
+    import importlib.util
+    import io
+    import sys
+    import loader
+
+    guard = guard and loader.GuardPages
+    reduced = code = None
+    if cache is not None:
+        import codecache
+        cache = codecache.CodeCache(cache)
+        sources = [__file__] + [importlib.util.find_spec(name).origin for name in ('as', 'pyasm')]
+        key = cache.key(program, fold, guard, codecache.stamp(*sources))
+        code = cache.get(key)
+    if code is None:
+        text = io.StringIO()
+        pas = importlib.import_module('as').AS()
+        if '_dasm' in globals():
+            globals()['_dasm'].asm = pas
+        with contextlib.redirect_stdout(text):
+            reduced = translate(program + '\0', fold, guard)
+            if '_emitter' in globals():
+                globals()['_emitter'].flush()
+        for line in text.getvalue().split('\n'):
+            pas.doline(line)
+        code = loader.load(pas) if cache is None else cache.put(key, pas)
+    bf_main = code.function('bf_main', None, ctypes.c_void_p)
+
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    def get_char():
+        c = stdin.read(1)
+        return c[0] if c else 0
+    def put_char(c):
+        stdout.write(bytes([c & 255]))
+
+    if guard:
+        tape = loader.Tape(TAPE_LENGTH)
+        tape.resume = code.address + code.symbols['bf_fault']
     else:
-        with open(argv[1]) as bf:
-            program = bf.read()
+        tape = (ctypes.c_uint8 * TAPE_LENGTH)()
+    state = loader.newstruct(statetype(),
+            tape=tape.address if guard else tape,
+            get_char=loader.callback(get_char, ctypes.c_int),
+            put_char=loader.callback(put_char, None, ctypes.c_int))
+    bf_main(ctypes.byref(state))
+    stdout.flush()
+    if guard:
+        tape.close()
+        if tape.overrun is not None:
+            raise ValueError('the pointer ran off the tape at {:#x}'.format(tape.overrun))
+    return reduced
+
+if __name__ == '__main__':
+    import argparse
+    from sys import stderr
+    parser = argparse.ArgumentParser(description='translate a brainfuck program into assembly')
+    parser.add_argument('file', help='xxx.bf')
+    parser.add_argument('--fold', action='store_true',
+            help='move the pointer once between loop boundaries and io')
+    parser.add_argument('--guard', action='store_true',
+            help='no wrap checks, the tape grows into guard pages (Linux x86_64 with glibc)')
+    parser.add_argument('--run', action='store_true',
+            help='run the program instead of printing its assembly')
+    parser.add_argument('--cache', metavar='DIR',
+            help='with --run, look the code up in DIR and store it there')
+    args = parser.parse_args()
 
-        program = program + '\0'
+    with open(args.file) as bf:
+        program = bf.read()
 
-        translate(program)
+    if args.run:
+        reduced = run(program, args.fold, args.guard, args.cache)
+    else:
+        reduced = translate(program + '\0', args.fold, args.guard)
+    if reduced is None:
+        print('code found in {}'.format(args.cache), file=stderr)
+    else:
+        print('loops reduced: {}'.format(', '.join('{} {}'.format(kind, n) for kind, n in reduced.items())),
+                file=stderr)
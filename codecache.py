@@ -0,0 +1,201 @@
+"""
+a directory of assembled machine code, keyed by what it is made of
+
+    cache = CodeCache('~/.cache/pyasm')
+    key = cache.key(program, options, stamp('brainfuck.pas', 'as.py'))
+    code = cache.get(key)
+    if code is None:
+        pas = AS()
+        for line in lines:
+            pas.doline(line)
+        code = cache.put(key, pas)
+    bf_main = code.function('bf_main', None, ctypes.c_void_p)
+
+an entry is the file KEY.code with the machine code of a finished AS,
+its global labels and the relocations left to a linker, see Header. the
+code starts at a page of the file, a hit maps it read/execute from the
+file with no copy and no assembly.
+
+entries are written to a temporary file and renamed, so writers of the
+same key race to leave one whole entry and readers never see half of
+one, a broken entry is a miss. the least recently used entries are
+removed when the directory grows over maxsize bytes, a hit touches the
+mtime of its entry. the code mapped from a removed entry stays valid.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import loader
+
+# magic, format, code offset, code length, number of labels, relocations
+Header = struct.Struct('<4sIQQII')
+Magic = b'PASC'
+Format = 1
+# a label: offset, length of the name, the name
+LabelEntry = struct.Struct('<QH')
+# a relocation: offset, addend, length of the name, the name
+RelocationEntry = struct.Struct('<QqH')
+
+Suffix = '.code'
+TempSuffix = '.tmp'
+# temporaries older than this (seconds) are left by dead writers
+TempAge = 3600
+
+
+def stamp(*paths):
+    # sha256 of the files at paths, the version of the code they make
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.digest()
+
+
+def pack(code, symbols, relocations):
+    # the bytes of an entry, the code padded to a page
+    tables = bytearray()
+    for name, offset in symbols.items():
+        name = name.encode()
+        tables += LabelEntry.pack(offset, len(name)) + name
+    for offset, name, addend in relocations:
+        name = name.encode()
+        tables += RelocationEntry.pack(offset, addend, len(name)) + name
+    start = (Header.size + len(tables) + mmap.PAGESIZE - 1) & -mmap.PAGESIZE
+    header = Header.pack(Magic, Format, start, len(code), len(symbols), len(relocations))
+    return header + tables + bytes(start - Header.size - len(tables)) + bytes(code)
+
+
+def unpack(f):
+    """
+    the loader.Code of the entry in the file object f, mapped from it,
+    with the labels in symbols and the relocations in relocations
+    """
+    magic, format, start, length, nlabels, nrelocations = Header.unpack(f.read(Header.size))
+    if magic != Magic or format != Format or start % mmap.PAGESIZE != 0 \
+            or os.fstat(f.fileno()).st_size != start + length:
+        raise ValueError('broken cache entry')
+    tables = f.read(start - Header.size)
+    pos = 0
+    symbols = {}
+    for i in range(nlabels):
+        offset, n = LabelEntry.unpack_from(tables, pos)
+        pos += LabelEntry.size + n
+        symbols[tables[pos-n:pos].decode()] = offset
+    relocations = []
+    for i in range(nrelocations):
+        offset, addend, n = RelocationEntry.unpack_from(tables, pos)
+        pos += RelocationEntry.size + n
+        relocations.append((offset, tables[pos-n:pos].decode(), addend))
+    return loader.Code.mapfile(f.fileno(), start, length, symbols, relocations)
+
+
+class CodeCache(object):
+    """
+    the entries in directory, at most maxsize bytes of them. hits,
+    misses and evictions count the lookups and the entries removed.
+    """
+
+    def __init__(self, directory, maxsize=1<<26):
+        self.directory = os.path.expanduser(directory)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, *parts):
+        # hex sha256 of the parts, str and bytes as they are, others by repr
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            elif not isinstance(part, bytes):
+                part = repr(part).encode()
+            h.update(struct.pack('<Q', len(part)))
+            h.update(part)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + Suffix)
+
+    def get(self, key):
+        # the code of the entry of key, None if there is no whole one
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                code = unpack(f)
+        except (OSError, ValueError, struct.error):
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return code
+
+    def put(self, key, pas):
+        """
+        finish the AS and store its resultbin, which must not be flushed,
+        as the entry of key. return its code mapped from the entry, or
+        loaded as loader.Code if the entry can not be written.
+        """
+        image = pas.image()
+        data = pack(*image)
+        path = self.path(key)
+        try:
+            fd, tmp = tempfile.mkstemp(TempSuffix, dir=self.directory)
+        except OSError:
+            return loader.Code(*image)
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                f.write(data)
+                f.flush()
+                f.seek(0)
+                code = unpack(f)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return loader.Code(*image)
+        self.evict(path)
+        return code
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used entries but keep until the entries
+        take maxsize bytes at most, and the temporaries of dead writers
+        """
+        entries = []
+        now = time.time()
+        for e in os.scandir(self.directory):
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            if e.name.endswith(Suffix):
+                entries.append((st.st_mtime_ns, st.st_size, e.path))
+            elif e.name.endswith(TempSuffix) and now - st.st_mtime > TempAge:
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                # removed by another process
+                pass
+            total -= size
@@ -0,0 +1,184 @@
+"""
+write assembled machine code as an ELF64 relocatable object for x86_64
+
+    pas = AS()
+    for line in lines:
+        pas.doline(line)
+    with open('mandelbrot.o', 'wb') as out:
+        out.write(objectfile(pas))
+
+    python elf.py mandelbrot.as -o mandelbrot.o
+    ld -shared -o mandelbrot.so mandelbrot.o
+
+resultbin is the .text section, the global labels are symbols in it,
+global but for the @name labels, and the branches to .extern names
+are R_X86_64_PLT32 relocations against undefined symbols, so a linker
+resolves them and the object links into an executable or a shared
+library. .data has the bytes passed in, AS has no data directives.
+"""
+import struct
+
+# e_ident of an ELF64 little endian object of the System V ABI
+Ident = b'\x7fELF\x02\x01\x01' + bytes(9)
+ET_REL = 1
+EM_X86_64 = 62
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+SHF_INFO_LINK = 0x40
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STT_NOTYPE = 0
+STT_SECTION = 3
+SHN_UNDEF = 0
+
+R_X86_64_PLT32 = 4
+
+# the sections in order, name -> (type, flags, alignment, entry size),
+# the header of section i is at index i + 1, after the null one
+Sections = {
+    '.text':            (SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, 16, 0),
+    '.data':            (SHT_PROGBITS, SHF_ALLOC | SHF_WRITE, 8, 0),
+    '.symtab':          (SHT_SYMTAB, 0, 8, 24),
+    '.strtab':          (SHT_STRTAB, 0, 1, 0),
+    '.rela.text':       (SHT_RELA, SHF_INFO_LINK, 8, 24),
+    '.shstrtab':        (SHT_STRTAB, 0, 1, 0),
+    # no executable stack is needed
+    '.note.GNU-stack':  (SHT_PROGBITS, 0, 1, 0),
+    }
+SectionIndex = {name: i + 1 for i, name in enumerate(Sections)}
+
+
+class StringTable(object):
+    # an ELF string table, offset returns the offset of a name in it
+    def __init__(self):
+        self.data = bytearray(1)
+        self.offsets = {'': 0}
+
+    def offset(self, name):
+        if name not in self.offsets:
+            self.offsets[name] = len(self.data)
+            self.data += name.encode() + b'\0'
+        return self.offsets[name]
+
+
+def relocatable(text, symbols=None, relocations=(), data=b'', datasymbols=None):
+    """
+    the bytes of an object with text in .text and data in .data.
+    symbols and datasymbols map the global labels to their offsets in
+    text and data. relocations are (offset, name, addend) of the rel32
+    displacements in text to the names not in symbols.
+    """
+    symbols = dict(symbols or {})
+    datasymbols = dict(datasymbols or {})
+    for name in datasymbols:
+        if name in symbols:
+            raise ValueError('symbol {} is in .text and .data'.format(name))
+    for name, offset in symbols.items():
+        if not 0 <= offset <= len(text):
+            raise ValueError('symbol {} out of .text'.format(name))
+    for name, offset in datasymbols.items():
+        if not 0 <= offset <= len(data):
+            raise ValueError('symbol {} out of .data'.format(name))
+
+    strtab = StringTable()
+    # null, the sections, then the globals: defined, undefined
+    symtab = [struct.pack('<IBBHQQ', 0, 0, 0, SHN_UNDEF, 0, 0)]
+    for name in ('.text', '.data'):
+        symtab.append(struct.pack('<IBBHQQ', 0, (STB_LOCAL << 4) | STT_SECTION, 0, SectionIndex[name], 0, 0))
+    index = {}
+    # the labels which are no C names, such as @name, are local and come
+    # before the globals
+    for bind in (STB_LOCAL, STB_GLOBAL):
+        if bind == STB_GLOBAL:
+            nlocals = len(symtab)
+        for defined, shndx in ((symbols, SectionIndex['.text']), (datasymbols, SectionIndex['.data'])):
+            for name, offset in sorted(defined.items(), key=lambda s: (s[1], s[0])):
+                if (bind == STB_GLOBAL) != name.isidentifier():
+                    continue
+                index[name] = len(symtab)
+                symtab.append(struct.pack('<IBBHQQ', strtab.offset(name), (bind << 4) | STT_NOTYPE, 0,
+                    shndx, offset, 0))
+    for offset, name, addend in relocations:
+        if name in datasymbols:
+            raise ValueError('branch to .data symbol {}'.format(name))
+        if name not in index:
+            index[name] = len(symtab)
+            symtab.append(struct.pack('<IBBHQQ', strtab.offset(name), (STB_GLOBAL << 4) | STT_NOTYPE, 0,
+                SHN_UNDEF, 0, 0))
+
+    rela = bytearray()
+    for offset, name, addend in sorted(relocations):
+        if not 0 <= offset <= len(text) - 4:
+            raise ValueError('relocation of {} out of .text'.format(name))
+        rela += struct.pack('<QQq', offset, (index[name] << 32) | R_X86_64_PLT32, addend)
+
+    shstrtab = StringTable()
+    for name in Sections:
+        shstrtab.offset(name)
+    contents = {
+        '.text': bytes(text),
+        '.data': bytes(data),
+        '.symtab': b''.join(symtab),
+        '.strtab': bytes(strtab.data),
+        '.rela.text': bytes(rela),
+        '.shstrtab': bytes(shstrtab.data),
+        '.note.GNU-stack': b'',
+        }
+    # sh_link and sh_info by section
+    links = {
+        '.symtab': (SectionIndex['.strtab'], nlocals),
+        '.rela.text': (SectionIndex['.symtab'], SectionIndex['.text']),
+        }
+
+    body = bytearray(64)
+    headers = [bytes(64)]
+    for name, (shtype, flags, align, entsize) in Sections.items():
+        body += bytes(-len(body) % align)
+        link, info = links.get(name, (0, 0))
+        headers.append(struct.pack('<IIQQQQIIQQ', shstrtab.offset(name), shtype, flags, 0, len(body),
+            len(contents[name]), link, info, align, entsize))
+        body += contents[name]
+    body += bytes(-len(body) % 8)
+    shoff = len(body)
+    struct.pack_into('<16sHHIQQQIHHHHHH', body, 0, Ident, ET_REL, EM_X86_64, 1, 0, 0, shoff, 0,
+            64, 0, 0, 64, len(headers), SectionIndex['.shstrtab'])
+    return bytes(body) + b''.join(headers)
+
+
+def objectfile(pas, data=b'', datasymbols=None):
+    """
+    finish the AS and return the object of its resultbin, which must not
+    be flushed, see relocatable
+    """
+    return relocatable(*pas.image(), data, datasymbols)
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+    parser = argparse.ArgumentParser(description='assemble xxx.as into an ELF64 relocatable object')
+    parser.add_argument('file', help='xxx.as')
+    parser.add_argument('--select', choices=['first', 'shortest'], default='first',
+            help='template selection, first matched (default) or shortest encoding')
+    parser.add_argument('--peephole', action='store_true',
+            help='drop redundant compares, merge add/sub and clear registers with xor')
+    parser.add_argument('-o', '--output', help='output file, xxx.o by default')
+    args = parser.parse_args()
+
+    pas = importlib.import_module('as').AS(args.select, peephole=args.peephole)
+    with open(args.file) as f:
+        for line in f:
+            pas.doline(line)
+    output = args.output
+    if output is None:
+        output = (args.file[:-3] if args.file.endswith('.as') else args.file) + '.o'
+    with open(output, 'wb') as out:
+        out.write(objectfile(pas))
@@ -0,0 +1,350 @@
+"""
+load assembled machine code into executable memory
+
+    pas = AS()
+    for line in lines:
+        pas.doline(line)
+    code = load(pas)
+    bf_main = code.function('bf_main', None, ctypes.c_void_p)
+
+    io = newstruct(pas.tm.typeof('state'),
+            tape=tape,
+            get_char=callback(get_char, ctypes.c_int),
+            put_char=callback(put_char, None, ctypes.c_int))
+    bf_main(ctypes.byref(io))
+
+the code is copied into an anonymous mapping while it is writable and
+the mapping is switched to read/execute before anything runs, so no
+page is writable and executable at the same time.
+
+a Tape is memory for code which does not check its bounds, an access
+past it faults on a guard page and the tape grows to it, see Tape. it
+works on Linux x86_64 with glibc only, where GuardPages is True. the
+SIGSEGV handler and the saved rip it rewrites are those of glibc there,
+the code has to check its bounds elsewhere.
+"""
+import ctypes
+import mmap
+import os
+import platform
+import signal
+import sys
+import weakref
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+libc.mprotect.restype = ctypes.c_int
+libc.mprotect.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+libc.munmap.restype = ctypes.c_int
+libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+
+MAP_FAILED = ctypes.c_void_p(-1).value
+PROT_NONE = 0
+MAP_NORESERVE = 0x4000
+SA_SIGINFO = 4
+# offset of the saved rip in the ucontext_t of a SA_SIGINFO handler
+UContextRIP = 168
+
+# SigAction and UContextRIP are the layouts of glibc on Linux x86_64
+GuardPages = sys.platform.startswith('linux') and platform.machine() == 'x86_64' \
+        and platform.libc_ver()[0] == 'glibc'
+
+
+class SigAction(ctypes.Structure):
+    # struct sigaction of glibc on x86_64
+    _fields_ = [
+        ('handler', ctypes.c_void_p),
+        ('mask', ctypes.c_ulong * 16),
+        ('flags', ctypes.c_int),
+        ('restorer', ctypes.c_void_p),
+        ]
+
+libc.sigaction.restype = ctypes.c_int
+libc.sigaction.argtypes = (ctypes.c_int, ctypes.POINTER(SigAction), ctypes.POINTER(SigAction))
+
+# ctypes of the builtin .type member types
+CTypes = {
+    '.byte':   ctypes.c_uint8,
+    '.int16':  ctypes.c_int16,
+    '.int32':  ctypes.c_int32,
+    '.int64':  ctypes.c_int64,
+    '.float':  ctypes.c_float,
+    '.double': ctypes.c_double,
+    '.ptr':    ctypes.c_void_p,
+    }
+
+
+def oserror():
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e))
+
+
+class Code(object):
+    """
+    machine code mapped read/execute at address. symbols maps the
+    global labels to their offsets in the code, relocations has the
+    (offset, name, addend) of the displacements left to a linker.
+    """
+
+    def __init__(self, code, symbols=None, relocations=()):
+        code = bytes(code)
+        self.address = None
+        self.size = (max(len(code), 1) + mmap.PAGESIZE - 1) & -mmap.PAGESIZE
+        self.symbols = dict(symbols or {})
+        self.relocations = list(relocations)
+        address = libc.mmap(None, self.size, mmap.PROT_READ | mmap.PROT_WRITE,
+                mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS, -1, 0)
+        if address in (None, MAP_FAILED):
+            raise oserror()
+        ctypes.memmove(address, code, len(code))
+        if libc.mprotect(address, self.size, mmap.PROT_READ | mmap.PROT_EXEC) != 0:
+            e = oserror()
+            libc.munmap(address, self.size)
+            raise e
+        self.address = address
+
+    @classmethod
+    def mapfile(cls, fileno, offset, length, symbols=None, relocations=()):
+        """
+        the code of length bytes at offset of the file fileno, mapped
+        read/execute from the file with no copy. offset is a multiple of
+        the page size.
+        """
+        self = cls.__new__(cls)
+        self.address = None
+        self.size = (max(length, 1) + mmap.PAGESIZE - 1) & -mmap.PAGESIZE
+        self.symbols = dict(symbols or {})
+        self.relocations = list(relocations)
+        address = libc.mmap(None, self.size, mmap.PROT_READ | mmap.PROT_EXEC, mmap.MAP_PRIVATE, fileno, offset)
+        if address in (None, MAP_FAILED):
+            raise oserror()
+        self.address = address
+        return self
+
+    def function(self, entry=0, restype=None, *argtypes):
+        """
+        a ctypes function calling the code at entry, a global label or an
+        offset. it keeps the code mapped while it is alive.
+        """
+        if isinstance(entry, str):
+            if entry not in self.symbols:
+                raise ValueError('undefined label {}'.format(entry))
+            entry = self.symbols[entry]
+        if self.address is None:
+            raise ValueError('code is unmapped')
+        if entry < 0 or entry >= self.size:
+            raise ValueError('entry {} out of the code'.format(entry))
+        func = ctypes.CFUNCTYPE(restype, *argtypes)(self.address + entry)
+        func.code = self
+        return func
+
+    def close(self):
+        # no function of the code may be called after this
+        if self.address is not None:
+            libc.munmap(self.address, self.size)
+            self.address = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class Tape(object):
+    """
+    length bytes of zeros at address, read/write, between PROT_NONE guards
+    of guard bytes. an access to the inner half of a guard faults, the
+    SIGSEGV handler maps the pages from the tape up to it read/write and
+    the access is resumed, so the tape grows into the guards and the code
+    using it needs no bounds checks. faults counts the times it grew.
+
+    the outer halves never grow, an access there is an overrun: the code
+    continues at the address resume, if it is set, with overrun set to the
+    address accessed. other faults are passed on to the handler installed
+    before.
+
+    the handler is python called by ctypes in the signal handler, which
+    is not async-signal-safe. it is only safe for faults of code like the
+    brainfuck one, raised by its own loads and stores of the tape and not
+    inside libc or the interpreter, in one thread. a ValueError is raised
+    where GuardPages is False.
+    """
+
+    def __init__(self, length, guard=1<<26):
+        self.base = None
+        if not GuardPages:
+            raise ValueError('guard page tapes need Linux x86_64 with glibc')
+        page = mmap.PAGESIZE
+        self.guard = (guard + page - 1) & -page
+        self.length = (max(length, 1) + page - 1) & -page
+        self.size = self.length + 2 * self.guard
+        base = libc.mmap(None, self.size, PROT_NONE,
+                mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | MAP_NORESERVE, -1, 0)
+        if base in (None, MAP_FAILED):
+            raise oserror()
+        self.base = base
+        # the read/write pages are [lo, hi)
+        self.lo = base + self.guard
+        self.hi = self.lo + self.length
+        if libc.mprotect(self.lo, self.length, mmap.PROT_READ | mmap.PROT_WRITE) != 0:
+            e = oserror()
+            libc.munmap(base, self.size)
+            raise e
+        self.address = self.lo
+        self.faults = 0
+        self.resume = None
+        self.overrun = None
+        installsegv()
+        Tapes.add(self)
+
+    def grow(self, address):
+        """
+        map the guard pages up to address, at least doubling the tape in
+        the inner half of the guard. False if address is not in the inner
+        half.
+        """
+        page = mmap.PAGESIZE
+        start = (self.base + self.guard // 2) & -page
+        end = (self.base + self.size - self.guard // 2) & -page
+        if not start <= address < end or self.lo <= address < self.hi:
+            return False
+        if address < self.lo:
+            lo, hi = max(min(address & -page, 2*self.lo - self.hi), start), self.lo
+            self.lo = lo
+        else:
+            lo, hi = self.hi, min(max((address & -page) + page, 2*self.hi - self.lo), end)
+            self.hi = hi
+        if libc.mprotect(lo, hi - lo, mmap.PROT_READ | mmap.PROT_WRITE) != 0:
+            return False
+        self.faults += 1
+        return True
+
+    def close(self):
+        # no code may use the tape after this
+        if self.base is not None:
+            Tapes.discard(self)
+            libc.munmap(self.base, self.size)
+            self.base = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+# the tapes the SIGSEGV handler grows, the action it replaced
+Tapes = weakref.WeakSet()
+SegvHandler = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+segvhandler = None
+previous = SigAction()
+
+def segv(signum, info, context):
+    # si_addr of the siginfo_t is the address accessed
+    address = ctypes.cast(info, ctypes.POINTER(ctypes.c_void_p))[2] or 0
+    for tape in list(Tapes):
+        if tape.base is None or not tape.base <= address < tape.base + tape.size:
+            continue
+        if tape.grow(address):
+            return
+        if tape.resume is not None:
+            tape.overrun = address
+            ctypes.c_void_p.from_address(context + UContextRIP).value = tape.resume
+            return
+    # not on a tape, the access faults again with the action before
+    libc.sigaction(signal.SIGSEGV, ctypes.byref(previous), None)
+
+def installsegv():
+    # the SIGSEGV handler of the tapes, installed once
+    global segvhandler
+    if segvhandler is not None:
+        return
+    handler = SegvHandler(segv)
+    action = SigAction()
+    action.handler = ctypes.cast(handler, ctypes.c_void_p).value
+    action.flags = SA_SIGINFO
+    if libc.sigaction(signal.SIGSEGV, ctypes.byref(action), ctypes.byref(previous)) != 0:
+        raise oserror()
+    segvhandler = handler
+
+
+def load(pas):
+    """
+    finish the AS and load its resultbin, which must not be flushed
+    nor branch to .extern names, which are left to a linker, see elf
+    """
+    code, symbols, relocations = pas.image()
+    if relocations:
+        raise ValueError('unresolved externs {}'.format(', '.join(sorted({r[1] for r in relocations}))))
+    return Code(code, symbols)
+
+
+def callback(func, restype=None, *argtypes):
+    # a C function pointer calling func, store it in a .ptr member
+    return ctypes.CFUNCTYPE(restype, *argtypes)(func)
+
+
+def structure(tp, types=None):
+    """
+    the ctypes.Structure class laid out as the Type tp, members at the
+    offsets of tp with explicit padding. types caches the classes of the
+    nested types.
+    """
+    if types is None:
+        types = {}
+    if tp.name in CTypes:
+        return CTypes[tp.name]
+    if tp.name in types:
+        return types[tp.name]
+
+    fields = []
+    offset = 0
+    for name, mtp in sorted(tp.members.items(), key=lambda m: tp.offsets[m[0]]):
+        if tp.offsets[name] > offset:
+            fields.append(('_pad{}'.format(offset), ctypes.c_uint8 * (tp.offsets[name] - offset)))
+        fields.append((name, structure(mtp, types)))
+        offset = tp.offsets[name] + mtp.size()
+    if tp.size() > offset:
+        fields.append(('_pad{}'.format(offset), ctypes.c_uint8 * (tp.size() - offset)))
+
+    cls = type(tp.name, (ctypes.Structure,), {'_pack_': 1, '_fields_': fields})
+    if ctypes.sizeof(cls) != tp.size():
+        raise ValueError('layout of {} differs from its ctypes'.format(tp.name))
+    types[tp.name] = cls
+    return cls
+
+
+CData = (ctypes._SimpleCData, ctypes._Pointer, ctypes._CFuncPtr, ctypes.Array, ctypes.Structure, ctypes.Union)
+
+
+def address(value):
+    # the address a ctypes object stands for in a .ptr member
+    if isinstance(value, (ctypes._Pointer, ctypes._CFuncPtr, ctypes.c_void_p)):
+        return ctypes.cast(value, ctypes.c_void_p).value
+    return ctypes.addressof(value)
+
+
+def newstruct(tp, **values):
+    """
+    a new instance of structure(tp) with the members in values set.
+    callbacks and other ctypes objects stored in .ptr members are kept
+    alive by the instance.
+    """
+    s = structure(tp)()
+    s.keep = {}
+    for name, value in values.items():
+        if name not in tp.members:
+            raise ValueError('no member {} in {}'.format(name, tp.name))
+        if tp.members[name].name == '.ptr' and isinstance(value, CData):
+            s.keep[name] = value
+            value = address(value)
+        setattr(s, name, value)
+    return s
@@ -1,4 +1,14 @@
 import re
+import os
+import sys
+import atexit
+import struct
+import hashlib
+import marshal
+import importlib
+import importlib.util
+import importlib.machinery
+from ast import literal_eval as leval
 
 NORMAL = 0
 SINGLE_QUOTE = 1
@@ -27,144 +37,531 @@ ASPYTHON = 4 # python in assembly
 #       SINGLE_QUOTE
 #       DOUBLE_QUOTE
 
-def translate(file, out):
+class Translator(object):
+    """
+    $-assembly is translated into print() of the assembly text
+
+    the scanner of translate appends the text it copies to the list
+    returned by the last begin/holebegin/holeend/end call.
+    """
+
+    def __init__(self):
+        self.out = []
+
+    def header(self):
+        return ''
+
+    def begin(self):
+        self.out.append("print('''")
+        return self.out
+
+    def holebegin(self):
+        self.out.append("''' + repr(")
+        return self.out
+
+    def holeend(self):
+        self.out.append(") + '''")
+        return self.out
+
+    def end(self):
+        self.out.append("''')")
+        return self.out
+
+
+class EmitTranslator(Translator):
+    """
+    $-assembly is translated into calls of the Emitter runtime (emit mode)
+
+    the calls are those of print(), to _emit, which batches the text. a
+    $$$ block is one call.
+    """
+
+    def header(self):
+        return 'from pyasm import Emitter as _Emitter; _emitter = _Emitter(); _emit = _emitter.emit\n'
+
+    def begin(self):
+        self.out.append("_emit('''")
+        return self.out
+
+
+class ActionTranslator(Translator):
+    """
+    $-assembly is translated into calls of the Dasm runtime (actions mode)
+
+    like DynASM, every assembly line is encoded into bytes at translation
+    time, with the actions left to the runtime by Dasm.put: the {...}
+    holes of immediates and displacements are patched in, labels and
+    branches go to the branch layout of the runtime assembler, see
+    AS.encode. macros are encoded by their lines. the lines which can not
+    be encoded this way (directives) are handed to the runtime assembler
+    as text by Dasm.text. they are also assembled at translation time, so
+    .define and the like apply to the later lines.
+    """
+
+    def __init__(self, asm):
+        Translator.__init__(self)
+        self.asm = asm
+
+    def header(self):
+        return 'from pyasm import Dasm as _Dasm; _dasm = _Dasm()\n'
+
+    def begin(self):
+        # static text and hole expressions, alternately
+        self.pieces = []
+        self.buf = []
+        return self.buf
+
+    def holebegin(self):
+        self.pieces.append(''.join(self.buf))
+        self.buf = []
+        return self.buf
+
+    def holeend(self):
+        self.pieces.append(''.join(self.buf))
+        self.buf = []
+        return self.buf
+
+    def end(self):
+        self.pieces.append(''.join(self.buf))
+
+        # split into lines of [text, hole, text, ..., text]
+        lines = [['']]
+        for i, piece in enumerate(self.pieces):
+            if i % 2 == 1:
+                lines[-1].extend([piece, ''])
+                continue
+            texts = piece.split('\n')
+            lines[-1][-1] += texts[0]
+            lines.extend([[text] for text in texts[1:]])
+
+        calls = []
+        encoded = []
+        values = []
+        for line in lines:
+            e = self.encode(line)
+            if e is None:
+                self.put(calls, encoded, values)
+                encoded, values = [], []
+                if len(line) > 1 or line[0].strip():
+                    calls.append(self.text(line))
+            elif e[0] or e[1]:
+                encoded.append(e)
+                values.extend(line[2 * k + 1] for k in e[2])
+        self.put(calls, encoded, values)
+
+        self.out.append('; '.join(calls) if calls else 'pass')
+        self.out.append('\n' * (len(lines) - 1))
+        return self.out
+
+    def encode(self, line):
+        """
+        (bytes, actions, order) of a line, see AS.encode, None if it can
+        not be encoded
+        """
+        asm = importlib.import_module('as')
+        try:
+            texts = [leval("'''" + text + "'''") for text in line[0::2]]
+        except (ValueError, SyntaxError):
+            return None
+        holes = [asm.Hole(k) for k in range(len(line) // 2)]
+        text = ''.join(texts[k//2] if k % 2 == 0 else asm.HOLE.format(k//2)
+                       for k in range(len(line)))
+        try:
+            encoded = self.asm.encode(text, holes)
+            if encoded is None and not holes:
+                self.asm.doline(text)
+        except Exception:
+            # leave the error to the runtime assembler
+            return None
+        if encoded is None or sorted(encoded[2]) != list(range(len(holes))):
+            return None
+        return encoded
+
+    def put(self, calls, encoded, values):
+        # append the call putting the encoded lines to calls
+        if encoded:
+            code, actions, order = importlib.import_module('as').joinencoded(encoded)
+            calls.append('_dasm.put({!r}, {!r}{})'.format(
+                    code, actions, ''.join(', ({})'.format(v) for v in values)))
+
+    def text(self, line):
+        return "_dasm.text('''" + ''.join(
+                piece if k % 2 == 0 else "''' + repr(" + piece + ") + '''"
+                for k, piece in enumerate(line)) + "''')"
+
+
+class Dasm(object):
+    """
+    runtime of the code translated in actions mode
+
+    the generated module creates one as _dasm, the machine code goes to
+    the resultbin of its assembler asm.
+    """
+
+    def __init__(self, asm=None):
+        self.asm = asm if asm is not None else importlib.import_module('as').AS()
+
+    def put(self, code, actions, *values):
+        """
+        append code to the resultbin of asm with the values of its
+        actions, see AS.encode. the immediates and displacements are
+        patched in, the labels and branches go to asm where they are in
+        code.
+        """
+        asm = self.asm
+        pos = 0
+        k = 0
+        fields = []
+        for action in actions:
+            offset = action[0]
+            if len(action) == 2:
+                fields.append((offset, action[1], values[k]))
+                k += 1
+                continue
+            self.append(code, pos, offset, fields)
+            fields = []
+            pos = offset
+            kind = action[1]
+            if kind == 'memory':
+                variants, const, sign = action[2:]
+                disp = const + sign * values[k]
+                for lo, hi, vcode, vfields in variants:
+                    if lo <= disp <= hi:
+                        break
+                else:
+                    raise ValueError('displacement {} out of range'.format(disp))
+                n = len(vfields)
+                self.append(vcode, 0, len(vcode),
+                        [f + (v,) for f, v in zip(vfields, (disp,) + values[k+1:k+n]) if f is not None])
+                k += n
+                continue
+            name, n = action[-2:]
+            if n:
+                name = name.format(*values[k:k+n])
+                k += n
+            if kind == 'label':
+                asm.dolabel('.label', [name])
+            else:
+                asm.putbranch(action[2], name)
+        self.append(code, pos, len(code), fields)
+
+    def append(self, code, pos, end, fields):
+        # append code[pos:end] to the resultbin, with the fields (offset
+        # in code, format, value) patched in
+        buf = self.asm.resultbin
+        start = len(buf) - pos
+        buf += code[pos:end]
+        for offset, fmt, value in fields:
+            if value < 0:
+                # an unsigned field of the operand size, two's complement
+                fmt = fmt.lower()
+            struct.pack_into(fmt, buf, start + offset, value)
+
+    def text(self, text):
+        for line in text.split('\n'):
+            self.asm.doline(line)
+
+
+class Emitter(object):
+    """
+    runtime of the code translated in emit mode
+
+    the generated module creates one as _emitter, its emit is called as
+    _emit. the text of every call is a line like print, the lines are
+    collected and written to out (sys.stdout by default) every blocklines
+    calls, the rest by flush, which also runs at exit. if asm is set, the
+    lines go to its doline at once instead, e.g.
+
+        brainfuck._emitter.asm = AS()
+    """
+
+    def __init__(self, out=None, asm=None, blocklines=4096):
+        self.out = out
+        self.asm = asm
+        self.blocklines = blocklines
+        self.buf = []
+        atexit.register(self.flush)
+
+    def emit(self, text):
+        if self.asm is not None:
+            for line in text.split('\n'):
+                self.asm.doline(line)
+            return
+        buf = self.buf
+        buf.append(text)
+        if len(buf) >= self.blocklines:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            out = self.out if self.out is not None else sys.stdout
+            self.buf.append('')
+            out.write('\n'.join(self.buf))
+            self.buf = []
+
+
+# the characters changing the state of the scanner, in every state,
+# the spans between them are copied as they are
+Specials = {
+    NORMAL:              re.compile(r'[\'"#$]'),
+    SINGLE_QUOTE:        re.compile(r"['\\]"),
+    DOUBLE_QUOTE:        re.compile(r'["\\]'),
+    TRIPLE_SINGLE_QUOTE: re.compile(r"['\\]"),
+    TRIPLE_DOUBLE_QUOTE: re.compile(r'["\\]'),
+    ASSEMBLY:            re.compile(r'[#\'"{\n]'),
+    TRIPLE_ASSEMBLY:     re.compile(r'[#\'"{$]'),
+    ASPYTHON:            re.compile(r'[\'"{}]'),
+    }
+
+# the states copying assembly text into the ''' strings of a translator
+Assembly = (ASSEMBLY, TRIPLE_ASSEMBLY)
+
+def translate(file, out, mode='print'):
+    with open(file) as f:
+        text = f.read()
+    # one write of the whole translation
+    out.write(translatetext(text, mode))
+
+def translatetext(text, mode='print'):
+    # the python source translated from the text of a .pas file
+    if mode == 'print':
+        t = Translator()
+    elif mode == 'emit':
+        t = EmitTranslator()
+    elif mode == 'actions':
+        t = ActionTranslator(importlib.import_module('as').AS())
+    else:
+        raise ValueError('invalid mode {}'.format(mode))
+
     rstack = 0
-    buf = []
+    buf = t.out
     ss = [NORMAL] # state stack
 
-    with open(file) as f:
-        for line in f:
-            m = re.fullmatch(r'(.*)(\n?)', line)
-            line = m.group(1)
-            eol = m.group(2)
-
-            i = 0
-            length = len(line)
-            while i < length:
-                c = line[i]
-                i += 1
-                if ss[-1] == NORMAL:
-                    if c == "'":
-                        buf.append(c)
-                        if i+1 < length and line[i] == "'" and line[i+1] == "'":
-                            ss.append(TRIPLE_SINGLE_QUOTE)
-                            i += 2
-                            buf.append("''")
-                        else:
-                            ss.append(SINGLE_QUOTE)
-                    elif c == '"':
-                        buf.append(c)
-                        if i+1 < length and line[i] == '"' and line[i+1] == '"':
-                            ss.append(TRIPLE_DOUBLE_QUOTE)
-                            i += 2
-                            buf.append('""')
-                        else:
-                            ss.append(DOUBLE_QUOTE)
-                    elif c == '#':
-                        buf.append(line[i-1:])
-                        i = length
-                    elif c == '$':
-                        if i+1 < length and line[i] == '$' and line[i+1] == '$':
-                            ss.append(TRIPLE_ASSEMBLY)
-                            i += 2
-                        else:
-                            ss.append(ASSEMBLY)
-
-                        buf.append("print('''")
-                    else:
-                        buf.append(c)
-                elif ss[-1] == SINGLE_QUOTE:
-                    buf.append(c)
-                    if c == "'":
-                        ss.pop()
-                    elif c == '\\' and i < length:
-                        buf.append(line[i])
-                        i += 1
-                elif ss[-1] == DOUBLE_QUOTE:
-                    buf.append(c)
-                    if c == '"':
-                        ss.pop()
-                    elif c == '\\' and i < length:
-                        buf.append(line[i])
-                        i += 1
-                elif ss[-1] == TRIPLE_SINGLE_QUOTE:
-                    buf.append(c)
-                    if i+1 < length and c == "'" and line[i] == "'" and line[i+1] == "'":
-                        buf.append("''")
-                        ss.pop()
-                        i += 2
-                    elif c == '\\' and i < length:
-                        buf.append(line[i])
-                        i += 1
-                elif ss[-1] == TRIPLE_DOUBLE_QUOTE:
-                    buf.append(c)
-                    if i+1 < length and c == '"' and line[i] == '"' and line[i+1] == '"':
-                        buf.append('""')
-                        ss.pop()
-                        i += 2
-                    elif c == '\\' and i < length:
-                        buf.append(line[i])
-                        i += 1
-                elif ss[-1] == ASSEMBLY or ss[-1] == TRIPLE_ASSEMBLY:
-                    if c == '#':
-                        # ignore comment in assembly
-                        i = length
-                    elif c == "'":
-                        buf.append(c)
-                        ss.append(SINGLE_QUOTE)
-                    elif c == '"':
-                        buf.append(c)
-                        ss.append(DOUBLE_QUOTE)
-                    elif c == '{':
-                        buf.append("''' + repr(")
-                        ss.append(ASPYTHON)
-                        rstack = 0
-                    elif ss[-1] == TRIPLE_ASSEMBLY and i+1 < length and \
-                         c == '$' and line[i] == '$' and line[i+1] == '$':
-                        i += 2
-                        buf.append("''')")
-                        ss.pop()
-                    else:
-                        buf.append(c)
-                elif ss[-1] == ASPYTHON:
-                    if c == "'":
-                        buf.append(c)
-                        ss.append(SINGLE_QUOTE)
-                    elif c == '"':
-                        buf.append(c)
-                        ss.append(DOUBLE_QUOTE)
-                    elif c == '}':
-                        if rstack == 0:
-                            buf.append(") + '''")
-                            ss.pop()
-                        else:
-                            rstack -= 1
-                            buf.append(c)
-                    elif c == '{':
-                        buf.append(c)
-                        rstack += 1
-                    else:
-                        buf.append(c)
+    # the whole text is scanned at once, newlines only matter to
+    # comments and to $-assembly, which ends with its physical line
+    i = 0
+    length = len(text)
+    while i < length:
+        state = ss[-1]
+        m = Specials[state].search(text, i)
+        if m is None:
+            buf.append(text[i:])
+            break
+        j = m.start()
+        if j > i:
+            if state == DOUBLE_QUOTE and ss[-2] in Assembly:
+                # a ' of the assembly text next to the ''' around it
+                # would end it, \' is the same
+                buf.append(text[i:j].replace("'", "\\'"))
+            else:
+                buf.append(text[i:j])
+        c = text[j]
+        i = j + 1
+        if state == NORMAL:
+            if c == "'":
+                buf.append(c)
+                if text.startswith("''", i):
+                    ss.append(TRIPLE_SINGLE_QUOTE)
+                    i += 2
+                    buf.append("''")
+                else:
+                    ss.append(SINGLE_QUOTE)
+            elif c == '"':
+                buf.append(c)
+                if text.startswith('""', i):
+                    ss.append(TRIPLE_DOUBLE_QUOTE)
+                    i += 2
+                    buf.append('""')
+                else:
+                    ss.append(DOUBLE_QUOTE)
+            elif c == '#':
+                i = text.find('\n', j)
+                if i < 0:
+                    i = length
+                buf.append(text[j:i])
+            else:
+                if text.startswith('$$', i):
+                    ss.append(TRIPLE_ASSEMBLY)
+                    i += 2
                 else:
-                    raise ValueError
+                    ss.append(ASSEMBLY)
 
-            if ss[-1] == ASSEMBLY:
+                buf = t.begin()
+        elif state == SINGLE_QUOTE or state == DOUBLE_QUOTE:
+            buf.append("\\'" if c == "'" and ss[-2] in Assembly else c)
+            if c != '\\':
+                ss.pop()
+            elif i < length and text[i] != '\n':
+                buf.append(text[i])
+                i += 1
+        elif state == TRIPLE_SINGLE_QUOTE or state == TRIPLE_DOUBLE_QUOTE:
+            buf.append(c)
+            if c != '\\':
+                if text.startswith(c + c, i):
+                    buf.append(c + c)
+                    ss.pop()
+                    i += 2
+            elif i < length and text[i] != '\n':
+                buf.append(text[i])
+                i += 1
+        elif state == ASSEMBLY or state == TRIPLE_ASSEMBLY:
+            if c == '#':
+                # ignore comment in assembly
+                i = text.find('\n', j)
+                if i < 0:
+                    i = length
+            elif c == '\n':
                 # $-assembly ended with physical line
-                buf.append("''')")
+                buf = t.end()
                 ss.pop()
+                buf.append(c)
+            elif c == "'":
+                buf.append("\\'")
+                ss.append(SINGLE_QUOTE)
+            elif c == '"':
+                buf.append(c)
+                ss.append(DOUBLE_QUOTE)
+            elif c == '{':
+                buf = t.holebegin()
+                ss.append(ASPYTHON)
+                rstack = 0
+            elif text.startswith('$$', i):
+                i += 2
+                buf = t.end()
+                ss.pop()
+            else:
+                buf.append(c)
+        elif state == ASPYTHON:
+            if c == "'":
+                buf.append(c)
+                ss.append(SINGLE_QUOTE)
+            elif c == '"':
+                buf.append(c)
+                ss.append(DOUBLE_QUOTE)
+            elif c == '}':
+                if rstack == 0:
+                    buf = t.holeend()
+                    ss.pop()
+                else:
+                    rstack -= 1
+                    buf.append(c)
+            else:
+                buf.append(c)
+                rstack += 1
+        else:
+            raise ValueError
 
-            buf.append(eol)
+    if ss[-1] == ASSEMBLY:
+        # $-assembly on the last line without a newline
+        buf = t.end()
+        ss.pop()
 
     if ss[-1] != NORMAL:
         raise ValueError
 
-    for str in buf:
-        out.write(str)
+    return t.header() + ''.join(t.out)
+
+
+class PasLoader(importlib.machinery.SourceFileLoader):
+    """
+    loader of .pas modules, see install
+
+    the source is translated by translatetext in memory and compiled. the
+    code is cached in __pycache__/NAME.pas.MODE.TAG.pyc, which is valid
+    while the mtime and size of the source match, or else its sha256
+    does. the mtimes of pyasm.py and as.py are part of the key as they
+    make the translation.
+    """
+    mode = 'print'
+
+    # magic, pyasm.py mtime, as.py mtime, source mtime, size, sha256
+    header = struct.Struct('<4s4Q32s')
+
+    def translator(self):
+        asm = importlib.import_module('as')
+        return os.stat(__file__).st_mtime_ns, os.stat(asm.__file__).st_mtime_ns
+
+    def get_code(self, fullname):
+        path = self.get_filename(fullname)
+        cache = importlib.util.cache_from_source('{}.{}.py'.format(path, self.mode))
+        st = os.stat(path)
+        stamp = self.translator()
+
+        cached = None
+        try:
+            with open(cache, 'rb') as f:
+                data = f.read()
+            fields = self.header.unpack_from(data)
+            if fields[0] == importlib.util.MAGIC_NUMBER and fields[1:3] == stamp:
+                cached = fields
+        except (OSError, struct.error):
+            pass
+        if cached is not None and cached[3:5] == (st.st_mtime_ns, st.st_size):
+            return marshal.loads(memoryview(data)[self.header.size:])
+
+        source = self.get_data(path)
+        digest = hashlib.sha256(source).digest()
+        if cached is not None and cached[5] == digest:
+            code = marshal.loads(memoryview(data)[self.header.size:])
+        else:
+            text = translatetext(importlib.util.decode_source(source), self.mode)
+            code = compile(text, path, 'exec', dont_inherit=True)
+        if not sys.dont_write_bytecode:
+            self.writecache(cache, stamp, st, digest, code)
+        return code
+
+    def writecache(self, cache, stamp, st, digest, code):
+        # written to a temporary file and renamed, readers never see half
+        data = self.header.pack(importlib.util.MAGIC_NUMBER, *stamp,
+                st.st_mtime_ns, st.st_size, digest) + marshal.dumps(code)
+        tmp = '{}.{}'.format(cache, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, cache)
+        except OSError:
+            pass
+
+
+def install(mode='print'):
+    """
+    let import find NAME.pas on sys.path, before NAME.py
+    """
+    loader = type('PasLoader', (PasLoader,), {'mode': mode})
+    hook = importlib.machinery.FileFinder.path_hook(
+            (loader, ['.pas']),
+            (importlib.machinery.ExtensionFileLoader, importlib.machinery.EXTENSION_SUFFIXES),
+            (importlib.machinery.SourceFileLoader, importlib.machinery.SOURCE_SUFFIXES),
+            (importlib.machinery.SourcelessFileLoader, importlib.machinery.BYTECODE_SUFFIXES))
+    sys.path_hooks.insert(0, hook)
+    sys.path_importer_cache.clear()
+    return hook
+
+
+def run(file, argv, mode='print'):
+    # run a .pas file as __main__ with argv, through the PasLoader cache
+    loader = type('PasLoader', (PasLoader,), {'mode': mode})('__main__', os.path.abspath(file))
+    code = loader.get_code('__main__')
+    sys.argv = [file] + list(argv)
+    exec(code, {'__name__': '__main__', '__file__': file, '__loader__': loader,
+                '__builtins__': __builtins__})
 
 
 if __name__ == '__main__':
-    from sys import stdout, argv
-    if len(argv) != 2:
-        print("Usage: {} xxx.pas".format(argv[0]))
+    import argparse
+    from sys import stdout
+    parser = argparse.ArgumentParser(description='translate xxx.pas into python')
+    parser.add_argument('file', help='xxx.pas')
+    parser.add_argument('--run', action='store_true',
+            help='run xxx.pas with args instead of printing the translation, '
+                 'the translation is cached in __pycache__')
+    parser.add_argument('--mode', choices=['print', 'emit', 'actions'], default='print',
+            help='print the assembly text (default), emit it in blocks, '
+                 'or encode it at translation time into Dasm actions')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments of xxx.pas with --run')
+    args = parser.parse_args()
+    if args.run:
+        run(args.file, args.args, args.mode)
     else:
-        translate(argv[1], stdout)
+        translate(args.file, stdout, args.mode)
@@ -0,0 +1,867 @@
+"""
+check the assembler against the fixtures in t/
+
+    python t/run.py [check ...]
+
+t.as is assembled a line at a time, the bytes of each line must be the
+same line of t.result, - for a line with no code. it is assembled in
+every configuration of Configs. the checks print ok or FAIL and the
+exit status is the number of failures.
+"""
+import contextlib
+import ctypes
+import difflib
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import traceback
+
+T = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(T))
+asm = importlib.import_module('as')
+import codecache
+import elf
+import loader
+import pyasm
+
+# AS arguments t.as is assembled with, the caches off and on, profile
+# last
+Configs = [
+    {},
+    {'linecachesize': 0},
+    {'memcachesize': 0, 'linecachesize': 0},
+    {'operandsetsize': 0},
+    {'profile': True},
+    ]
+
+
+def assemble(lines, **kw):
+    # the machine code of lines, finished
+    pas = asm.AS(**kw)
+    for line in lines:
+        pas.doline(line)
+    pas.finish()
+    return bytes(pas.resultbin)
+
+
+def translate(lines, format='raw', out=None, **kw):
+    # the output of asm.translate on a file of lines
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'x.as')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        if out is None:
+            out = io.BytesIO() if format == 'raw' else io.StringIO()
+        asm.translate(path, out, format=format, **kw)
+    return out.getvalue()
+
+
+def program(n, pad=(0, 20, 60)):
+    """
+    the lines of main, which calls f0, f1 ... f{n-1} chained by jmp, and
+    the value main returns in rax. they have short and near, forward and
+    backward branches to local and global labels, a .define and a .macro.
+    """
+    lines = ['.define acc, rax', '.macro step, n', 'add acc, n', '.endmacro',
+            'main:', 'xor eax, eax', 'call f0', 'ret']
+    acc = 0
+    for k in range(n):
+        lines += ['f{}:'.format(k), 'mov ecx, {}'.format(k % 5 + 1), '1:', 'step {}'.format(k),
+                'sub ecx, 1', 'jnz <1', 'test eax, 1', 'jz >2', 'add acc, 3']
+        lines += ['lea rdx, [rdx+1]'] * pad[k % len(pad)]
+        lines += ['2:', 'jmp f{}'.format(k + 1) if k + 1 < n else 'ret']
+        acc += k * (k % 5 + 1)
+        if acc & 1:
+            acc += 3
+    return lines, acc
+
+
+def call(code, entry=0):
+    # run the machine code from entry, return rax
+    with loader.Code(code) as c:
+        return c.function(entry, ctypes.c_long)()
+
+
+def check_fixture():
+    with open(os.path.join(T, 't.as')) as f:
+        lines = f.readlines()
+    with open(os.path.join(T, 't.result')) as f:
+        expected = f.read().split()
+    assert len(lines) == len(expected), 't.as has {} lines, t.result {}'.format(len(lines), len(expected))
+    bad = []
+    for kw in Configs:
+        pas = asm.AS(**kw)
+        for n, (line, e) in enumerate(zip(lines, expected), 1):
+            start = len(pas.resultbin)
+            try:
+                pas.doline(line)
+            except ValueError as ex:
+                bad.append('{} t.as:{}: {}'.format(kw, n, ex))
+                continue
+            got = pas.resultbin[start:].hex() or '-'
+            if got != e:
+                bad.append('{} t.as:{}: {} is {}, not {}'.format(kw, n, line.split('#')[0].strip(), got, e))
+    assert not bad, '\n'.join(bad)
+
+
+
+def check_scanner():
+    # t/scan.pas translated in print mode is t/scan.result, markers in
+    # strings and comments left alone, and the assembly of f the same in
+    # every mode
+    with open(os.path.join(T, 'scan.pas')) as f:
+        source = f.read()
+    with open(os.path.join(T, 'scan.result')) as f:
+        expected = f.read()
+    got = pyasm.translatetext(source)
+    assert got == expected, ''.join(difflib.unified_diff(expected.splitlines(True), got.splitlines(True)))
+
+    module = {'__name__': 'scan'}
+    text = io.StringIO()
+    with contextlib.redirect_stdout(text):
+        exec(got, module)
+        module['f'](3)
+    lines = [line.strip() for line in text.getvalue().split('\n') if line.strip()]
+    assert lines == ['mov eax, 3', 'mov ecx, 1', ".define hash, '#{'", 'mov edx, 4',
+            '.define dollars, "$$$ in a string"', '@3:', 'add eax, 3'], lines
+    assert module['s3'] == "it's $ still a string" and module['s6'].endswith('ends here'), module
+    code = assemble(['mov eax, 3', 'mov ecx, 1', 'mov edx, 4', '@3:', 'add eax, 3'])
+    for mode in ('print', 'emit', 'actions'):
+        assert pasrun(source, mode, 'f', 3) == code, mode
+
+
+# line, its code with select='first' and with select='shortest', which
+# is that of GNU as
+SelectCases = [
+    ('add eax, 8', '0508000000', '83c008'),
+    ('add rax, 8', '480508000000', '4883c008'),
+    ('adc eax, 8', '1508000000', '83d008'),
+    ('add rax, -1', '4805ffffffff', '4883c0ff'),
+    ('cmp eax, 100', '3d64000000', '83f864'),
+    ('sub r9, 1', '4983e901', '4983e901'),
+    ]
+
+
+def check_shortest():
+    bad = []
+    for line, first, shortest in SelectCases:
+        for select, expected in (('first', first), ('shortest', shortest)):
+            got = assemble([line], select=select).hex()
+            if got != expected:
+                bad.append('{} {} is {}, not {}'.format(select, line, got, expected))
+    # no line of t.as is longer
+    with open(os.path.join(T, 't.as')) as f:
+        lines = f.readlines()
+    pas = [asm.AS(select=select) for select in ('first', 'shortest')]
+    for n, line in enumerate(lines, 1):
+        start = [len(p.resultbin) for p in pas]
+        for p in pas:
+            p.doline(line)
+        first, shortest = [p.resultbin[k:] for p, k in zip(pas, start)]
+        if len(shortest) > len(first):
+            bad.append('t.as:{}: shortest {} is longer than {}'.format(n, shortest.hex(), first.hex()))
+    assert not bad, '\n'.join(bad)
+
+
+def check_memcache():
+    lines = ['mov rax, [rbx+8]', 'add ecx, [rbx+8]', 'mov [rsp+r12*4-16], edx',
+            'cmp byte [rbx+8], 0', 'mov r9, [rsp+r12*4-16]', 'lea rdi, [rbx+8]'] * 3
+    expected = assemble(lines, memcachesize=0, linecachesize=0)
+    for size in (1, 2, 1024):
+        pas = asm.AS(memcachesize=size, linecachesize=0)
+        for line in lines:
+            pas.doline(line)
+        assert bytes(pas.resultbin) == expected, 'memcachesize={} {}'.format(size, pas.resultbin.hex())
+        assert len(pas.memcache) <= size, 'memcachesize={} holds {}'.format(size, len(pas.memcache))
+    # keyed by the text, byte [rbx+8] is an entry of its own
+    assert (pas.memhits, pas.memmisses) == (15, 3), (pas.memhits, pas.memmisses)
+
+
+def check_linecache():
+    lines = ['add rbx, 1', 'mov rax, [rbx+8]', 'nop', 'push rbx'] * 4
+    expected = assemble(lines, linecachesize=0)
+    for size in (1, 2, 4096):
+        pas = asm.AS(linecachesize=size)
+        for line in lines:
+            pas.doline(line)
+        assert bytes(pas.resultbin) == expected, 'linecachesize={} {}'.format(size, pas.resultbin.hex())
+        assert len(pas.linecache) <= size, 'linecachesize={} holds {}'.format(size, len(pas.linecache))
+    assert (pas.linehits, pas.linemisses) == (12, 4), (pas.linehits, pas.linemisses)
+
+    # branches and labels are not cached, the same line jumps back to
+    # a different 1: each time
+    lines = ['1:', 'jmp <1', 'nop', '1:', 'nop', 'jmp <1']
+    for kw in Configs:
+        got = assemble(lines, **kw).hex()
+        assert got == 'ebfe9090ebfd', '{} {}'.format(kw, got)
+
+
+def check_stream():
+    lines, acc = program(150)
+    expected = assemble(lines)
+    for chunksize in (16, 1000, 1 << 16):
+        got = translate(lines, chunksize=chunksize)
+        assert got == expected, 'chunksize={} differs'.format(chunksize)
+    assert translate(lines, 'hex', chunksize=16) == expected.hex(), 'hex differs'
+
+    # the bytes held back wait for the branches not settled, not for the
+    # end of the file, so every write is about chunksize bytes
+    class Out(io.BytesIO):
+        def write(self, b):
+            sizes.append(len(b))
+            return super().write(b)
+    lines, acc = program(3000)
+    for layout in ('relax', 'onepass'):
+        sizes = []
+        got = translate(lines, out=Out(), chunksize=4096, layout=layout)
+        assert call(got) == acc, '{} main of program returns another value'.format(layout)
+        assert max(sizes) < 2 * 4096, '{} held {} bytes'.format(layout, max(sizes))
+
+
+# lines, their code laid out by relax: the short forms reach -128..127
+RelaxCases = [
+    (['jz >1'] + ['nop'] * 127 + ['1:'], '747f' + '90' * 127),
+    (['jz >1'] + ['nop'] * 128 + ['1:'], '0f8480000000' + '90' * 128),
+    (['1:'] + ['nop'] * 126 + ['jmp <1'], '90' * 126 + 'eb80'),
+    (['1:'] + ['nop'] * 127 + ['jmp <1'], '90' * 127 + 'e97cffffff'),
+    (['jmp f', 'nop', 'f:', 'call f', 'jnz f'], 'eb0190e8fbffffff75f9'),
+    ]
+
+
+def check_relax():
+    bad = []
+    for lines, expected in RelaxCases:
+        got = assemble(lines, layout='relax').hex()
+        if got != expected:
+            bad.append('{}: {} is {}, not {}'.format(lines[:2], lines[-1], got, expected))
+    assert not bad, '\n'.join(bad)
+    lines, acc = program(150)
+    assert call(assemble(lines, layout='relax')) == acc, 'main of program returns another value'
+
+
+# lines, their code laid out by onepass: the forward branches are near
+OnepassCases = [
+    (['jz >1'] + ['nop'] * 127 + ['1:'], '0f847f000000' + '90' * 127),
+    (['1:'] + ['nop'] * 126 + ['jmp <1'], '90' * 126 + 'eb80'),
+    (['1:'] + ['nop'] * 127 + ['jmp <1'], '90' * 127 + 'e97cffffff'),
+    (['jmp f', 'nop', 'f:', 'call f', 'jnz f'], 'e90100000090e8fbffffff75f9'),
+    ]
+
+
+def check_onepass():
+    bad = []
+    for lines, expected in OnepassCases:
+        got = assemble(lines, layout='onepass').hex()
+        if got != expected:
+            bad.append('{}: {} is {}, not {}'.format(lines[:2], lines[-1], got, expected))
+    assert not bad, '\n'.join(bad)
+    # the same program as relax, near where relax is short
+    lines, acc = program(150)
+    relax = assemble(lines, layout='relax')
+    onepass = assemble(lines, layout='onepass')
+    assert call(onepass) == acc, 'main of program returns another value'
+    assert len(relax) < len(onepass), 'relax {} bytes, onepass {}'.format(len(relax), len(onepass))
+    lines, acc = program(20, pad=(40,))
+    assert call(assemble(lines, layout='onepass')) == acc, 'main of program returns another value'
+
+
+LoaderLines = [
+    '.type pair',
+    '.int32 x',
+    '.int64 y',
+    '.ptr f',
+    '.endtype',
+    'sum:',
+    'lea rax, [rdi+rsi]',
+    'ret',
+    'gety:',
+    'mov rax, [rdi:pair.y]',
+    'ret',
+    # f(y) of the pair at rdi
+    'callf:',
+    'push rbx',
+    'mov rbx, rdi',
+    'mov rdi, [rbx:pair.y]',
+    'call aword [rbx:pair.f]',
+    'pop rbx',
+    'ret',
+    ]
+
+
+def check_loader():
+    pas = asm.AS()
+    for line in LoaderLines:
+        pas.doline(line)
+    tp = pas.tm.typeof('pair')
+    code = loader.load(pas)
+    assert code.function('sum', ctypes.c_long, ctypes.c_long, ctypes.c_long)(3, -10) == -7
+    assert ctypes.sizeof(loader.structure(tp)) == tp.size() == 24
+    s = loader.newstruct(tp, x=1, y=21, f=loader.callback(lambda y: 2 * y, ctypes.c_long, ctypes.c_long))
+    assert code.function('gety', ctypes.c_long, ctypes.c_void_p)(ctypes.byref(s)) == 21
+    assert code.function('callf', ctypes.c_long, ctypes.c_void_p)(ctypes.byref(s)) == 42
+
+    # no page is writable and executable
+    if os.path.exists('/proc/self/maps'):
+        with open('/proc/self/maps') as f:
+            for line in f:
+                lo, hi = (int(a, 16) for a in line.split()[0].split('-'))
+                if lo <= code.address < hi:
+                    assert line.split()[1] == 'r-xp', line
+
+    for func in (lambda: code.function('nosuch'), lambda: code.function(code.size)):
+        try:
+            func()
+        except ValueError:
+            continue
+        raise AssertionError('bad entry taken')
+    code.close()
+    try:
+        code.function('sum')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('function of closed code')
+    pas = asm.AS()
+    for line in ('.extern puts', 'main:', 'call puts', 'ret'):
+        pas.doline(line)
+    try:
+        loader.load(pas)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('code with relocations loaded')
+
+    # the image of a flushed AS is refused by all its users
+    with tempfile.TemporaryDirectory() as d:
+        for use in (loader.load, elf.objectfile, lambda pas: codecache.CodeCache(d).put('k', pas)):
+            pas = asm.AS()
+            pas.doline('ret')
+            pas.flush(lambda data: None)
+            try:
+                use(pas)
+            except ValueError:
+                continue
+            raise AssertionError('flushed code taken by {}'.format(use))
+
+
+# poke(tape, offset, value) stores value at tape+offset and returns the
+# byte there, or -1 if the store is an overrun resumed at over
+TapeLines = [
+    'poke:',
+    'mov byte [rdi+rsi], dl',
+    'movzx eax, byte [rdi+rsi]',
+    'ret',
+    'over:',
+    'mov rax, -1',
+    'ret',
+    ]
+
+
+def check_tape():
+    if not loader.GuardPages:
+        try:
+            loader.Tape(4096)
+        except ValueError:
+            return
+        raise AssertionError('guard page tape without GuardPages')
+    pas = asm.AS()
+    for line in TapeLines:
+        pas.doline(line)
+    code = loader.load(pas)
+    poke = code.function('poke', ctypes.c_long, ctypes.c_void_p, ctypes.c_long, ctypes.c_long)
+    guard = 1 << 20
+    with loader.Tape(4096, guard) as tape:
+        assert poke(tape.address, 4095, 1) == 1 and tape.faults == 0
+        # into the inner halves of the guards, up and down
+        assert poke(tape.address, 4096 + 100, 2) == 2 and tape.faults == 1
+        assert tape.hi - tape.lo >= 2 * 4096
+        assert poke(tape.address, -1, 3) == 3 and tape.faults == 2
+        assert poke(tape.address, guard // 2 - 4096, 4) == 4 and tape.faults == 3
+        assert poke(tape.address, 4095, 5) == 5 and poke(tape.address, 4096 + 100, 6) == 6
+        # into the outer half, an overrun
+        tape.resume = code.address + code.symbols['over']
+        address = tape.address + 4096 + guard * 3 // 4
+        assert poke(tape.address, address - tape.address, 7) == -1
+        assert tape.overrun == address and tape.faults == 3
+
+
+# main returns abs(-5) doubled by the local @twice
+ElfLines = [
+    '.extern abs',
+    'main:',
+    'sub rsp, 8',
+    'mov edi, -5',
+    'call abs',
+    'call @twice',
+    'add rsp, 8',
+    'ret',
+    '@twice:',
+    'add eax, eax',
+    'ret',
+    ]
+
+
+def readelf(obj):
+    """
+    the sections of an ELF64 object by name, (type, flags, link, info,
+    contents), and its symbols, (name, bind, section index, value)
+    """
+    ident, etype, machine, shoff, shentsize, shnum, shstrndx = (
+            struct.unpack_from('<16sHH20xQ10xHHH', obj, 0))
+    assert ident[:4] == b'\x7fELF' and etype == elf.ET_REL and machine == elf.EM_X86_64
+    headers = [struct.unpack_from('<IIQQQQIIQQ', obj, shoff + i * shentsize) for i in range(shnum)]
+    contents = [obj[h[4]:h[4] + h[5]] for h in headers]
+    def name(table, offset):
+        return table[offset:table.index(b'\0', offset)].decode()
+    sections = {name(contents[shstrndx], h[0]): (h[1], h[2], h[6], h[7], c)
+            for h, c in zip(headers, contents)}
+    symtab, strtab = sections['.symtab'][4], sections['.strtab'][4]
+    symbols = []
+    for i in range(0, len(symtab), 24):
+        offset, info, other, shndx, value, size = struct.unpack_from('<IBBHQQ', symtab, i)
+        symbols.append((name(strtab, offset), info >> 4, shndx, value))
+    return sections, symbols
+
+
+def check_elf():
+    pas = asm.AS()
+    for line in ElfLines:
+        pas.doline(line)
+    obj = elf.objectfile(pas, b'data', {'msg': 0})
+    sections, symbols = readelf(obj)
+    assert list(sections) == [''] + list(elf.Sections)
+    assert sections['.text'][4] == bytes(pas.resultbin) and sections['.data'][4] == b'data'
+    text, data = elf.SectionIndex['.text'], elf.SectionIndex['.data']
+    assert symbols == [('', 0, 0, 0), ('', 0, text, 0), ('', 0, data, 0),
+            ('@twice', elf.STB_LOCAL, text, pas.symbols['@twice']), ('main', elf.STB_GLOBAL, text, 0),
+            ('msg', elf.STB_GLOBAL, data, 0), ('abs', elf.STB_GLOBAL, elf.SHN_UNDEF, 0)]
+    # sh_info of .symtab is the first global
+    assert sections['.symtab'][2:4] == (elf.SectionIndex['.strtab'], 4)
+    rtype, flags, link, info, rela = sections['.rela.text']
+    assert (link, info) == (elf.SectionIndex['.symtab'], text)
+    offset = pas.resultbin.index(b'\xe8') + 1
+    assert struct.unpack('<QQq', rela) == (offset, (6 << 32) | elf.R_X86_64_PLT32, -4)
+
+    for args in ((b'', {'a': 1}), (b'1234', {}, [(1, 'b', -4)]), (b'', {'a': 0}, (), b'', {'a': 0})):
+        try:
+            elf.relocatable(*args)
+        except ValueError:
+            continue
+        raise AssertionError('bad object {}'.format(args))
+
+    # linked and run where there is a compiler driver
+    cc = shutil.which('cc') or shutil.which('gcc')
+    if cc:
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'x.o'), 'wb') as f:
+                f.write(obj)
+            subprocess.check_call([cc, '-o', os.path.join(d, 'x'), os.path.join(d, 'x.o')])
+            assert subprocess.call([os.path.join(d, 'x')]) == 10
+
+
+def check_codecache():
+    def entry(cache, key, n):
+        # put the code returning n as the entry of key
+        pas = asm.AS()
+        for line in ('main:', 'mov eax, {}'.format(n), 'ret'):
+            pas.doline(line)
+        return cache.put(key, pas)
+
+    with tempfile.TemporaryDirectory() as d:
+        cache = codecache.CodeCache(d)
+        stamp = codecache.stamp(os.path.abspath(__file__))
+        key = cache.key('main', 1, stamp)
+        assert key == cache.key('main', 1, stamp) != cache.key('main', 2, stamp)
+        assert cache.key('ab', 'c') != cache.key('a', 'bc') == cache.key(b'a', 'bc')
+        assert cache.get(key) is None and cache.misses == 1
+        code = entry(cache, key, 42)
+        assert code.function('main', ctypes.c_long)() == 42
+        hit = cache.get(key)
+        assert cache.hits == 1 and hit.symbols == {'main': 0}
+        assert hit.function('main', ctypes.c_long)() == 42
+
+        # a broken entry is a miss
+        size = os.path.getsize(cache.path(key))
+        with open(cache.path(key), 'r+b') as f:
+            f.truncate(os.fstat(f.fileno()).st_size - 1)
+        assert cache.get(key) is None and cache.misses == 2
+        os.remove(cache.path(key))
+
+        # the least recently used go first, a hit uses an entry
+        cache = codecache.CodeCache(d, 3 * size)
+        keys = [cache.key(n) for n in range(4)]
+        codes = []
+        for n, key in enumerate(keys[:3]):
+            codes.append(entry(cache, key, n))
+            os.utime(cache.path(key), (n, n))
+        cache.get(keys[0])
+        with open(os.path.join(d, 'dead' + codecache.TempSuffix), 'wb') as f:
+            pass
+        os.utime(f.name, (0, 0))
+        entry(cache, keys[3], 3)
+        assert sorted(os.listdir(d)) == sorted(os.path.basename(cache.path(k)) for k in keys if k != keys[1])
+        assert cache.evictions == 1
+        # the code of an evicted entry stays mapped
+        assert codes[1].function('main', ctypes.c_long)() == 1
+
+
+def check_jobs():
+    # the program with branches to an extern, events of the chunks too
+    lines = ['.extern ext']
+    for line in program(150)[0]:
+        lines += [line, 'call ext'] if line.startswith('f') else [line]
+    assert len(asm.splitchunks(lines, 1000)) > 2, 'one chunk'
+    for layout in ('relax', 'onepass'):
+        serial = translate(lines, layout=layout)
+        for jobs in (2, 3):
+            assert translate(lines, layout=layout, jobs=jobs) == serial, '{} jobs={} differs'.format(layout, jobs)
+
+
+
+def check_profile():
+    # the lines counted by mnemonic, alone, through the peephole window
+    # and from the chunks of jobs, whose preludes are not counted again
+    lines = program(150)[0]
+    expected = {}
+    for line in lines:
+        opcode = '.label' if line.endswith(':') else line.split(None, 1)[0]
+        expected[opcode] = expected.get(opcode, 0) + 1
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'x.as')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        for kw in ({}, {'peephole': True}, {'jobs': 3}, {'jobs': 3, 'peephole': True}):
+            out = io.BytesIO()
+            pas = asm.translate(path, out, format='raw', profile=True, **kw)
+            prof = pas.profile
+            assert {op: n for op, (n, seconds) in prof.ops.items()} == expected, \
+                    '{}: {}'.format(kw, prof.ops)
+            assert out.getvalue() == translate(lines, **kw), '{}: the code differs'.format(kw)
+            assert set(op for op, text in prof.matched) <= set(expected), kw
+            assert all(seconds >= 0 for seconds in prof.phases.values()), prof.phases
+
+            table = prof.table().split('\n')
+            row = [r.split() for r in table if r.startswith('mov ')][0]
+            assert row[1] == str(expected['mov']), row
+            ops = json.loads(json.dumps(prof.asdict()))['ops']
+            assert ops['sub']['lines'] == expected['sub'], ops['sub']
+
+
+# lines with no template for their operands, or no operation
+Rejected = [
+    'add eax, rbx',
+    'mov al, 0x1ff',
+    'add [rbx], 1',
+    'push eax',
+    'add rax',
+    'add rax, 0x80000000',
+    'bogus rax',
+    'mov rax, [rbx',
+    ]
+
+
+def check_rejected():
+    bad = []
+    for line in Rejected:
+        for kw in Configs:
+            try:
+                assemble([line], **kw)
+            except ValueError:
+                continue
+            bad.append('{} {} is taken'.format(kw, line))
+    assert not bad, '\n'.join(bad)
+
+
+
+def check_macro():
+    # the lines of a macro body with params are the lines written out,
+    # whatever the params of its uses, and rejected with them
+    body = ['.macro put, r, k', 'mov qword [rbx + 8], r', 'add r, k', 'lea rcx, [r + 4*rdx + k]', '.endmacro']
+    uses = [('rax', '1'), ('r9', '300'), ('rsi', '0x80'), ('rax', '2')]
+    got = assemble(body + ['put {}, {}'.format(r, k) for r, k in uses])
+    lines = ['mov qword [rbx + 8], {0}', 'add {0}, {1}', 'lea rcx, [{0} + 4*rdx + {1}]']
+    expected = assemble([line.format(r, k) for r, k in uses for line in lines])
+    assert got == expected, '{} is not {}'.format(got.hex(), expected.hex())
+    for use in ('put eax, 1', 'put rax, rcx', 'put rax'):
+        try:
+            assemble(body + [use])
+        except ValueError:
+            continue
+        raise AssertionError('{} is taken'.format(use))
+
+
+# lines, the lines peephole makes of them, the xor clears the flags
+# longer than the window of Peephole
+LoopBody = ['add eax, ecx'] + ['mov {}, eax'.format(r) for r in ('edx', 'esi', 'edi', 'r8d', 'r9d', 'r10d', 'r11d')]
+
+PeepholeCases = [
+    # dropcmp
+    (['add rbx, 1', 'cmp rbx, 0', 'jz >1', '1:', 'xor eax, eax'],
+     ['add rbx, 1', 'jz >1', '1:', 'xor eax, eax']),
+    (['add rbx, 1', 'cmp rbx, 0', 'jz >1', '1:', 'ret'],
+     ['add rbx, 1', 'cmp rbx, 0', 'jz >1', '1:', 'ret']),
+    (['and ecx, 7', 'test ecx, ecx', 'xor eax, eax'],
+     ['and ecx, 7', 'xor eax, eax']),
+    (['sub rbx, 1', 'cmp rbx, 0', 'jb >1', '1:', 'xor eax, eax'],
+     ['sub rbx, 1', 'cmp rbx, 0', 'jb >1', '1:', 'xor eax, eax']),
+    (['add rbx, 1', 'cmp rcx, 0', 'xor eax, eax'],
+     ['add rbx, 1', 'cmp rcx, 0', 'xor eax, eax']),
+    # a loop head, the target of jz out of the window
+    (['1:', 'sub ecx, 1', 'cmp ecx, 0', 'jz >2'] + LoopBody + ['jmp <1', '2:', 'xor eax, eax', 'ret'],
+     ['1:', 'sub ecx, 1', 'jz >2'] + LoopBody + ['jmp <1', '2:', 'xor eax, eax', 'ret']),
+    (['1:', 'sub ecx, 1', 'cmp ecx, 0', 'jz >2'] + LoopBody + ['jmp <1', '2:', 'ret'],
+     ['1:', 'sub ecx, 1', 'cmp ecx, 0', 'jz >2'] + LoopBody + ['jmp <1', '2:', 'ret']),
+    (['1:', 'sub ecx, 1', 'cmp ecx, 0', 'jz done'] + LoopBody + ['jmp <1', 'done:', 'xor eax, eax', 'ret'],
+     ['1:', 'sub ecx, 1', 'jz done'] + LoopBody + ['jmp <1', 'done:', 'xor eax, eax', 'ret']),
+    # merge
+    (['add rbx, 3', 'sub rbx, 1', 'xor eax, eax'],
+     ['add rbx, 2', 'xor eax, eax']),
+    (['add rbx, 3', 'sub rbx, 3', 'xor eax, eax'],
+     ['xor eax, eax']),
+    (['add byte [rbx+4], 3', 'sub byte [rbx + 4], 1', 'xor eax, eax'],
+     ['add byte [rbx+4], 2', 'xor eax, eax']),
+    (['addb [rbx+4], 1', 'subb [rbx+4], 3', 'xor eax, eax'],
+     ['subb [rbx+4], 2', 'xor eax, eax']),
+    (['add eax, -2', 'sub eax, 3', 'xor ecx, ecx'],
+     ['sub eax, 5', 'xor ecx, ecx']),
+    (['add rbx, 1', 'add rcx, 1', 'xor eax, eax'],
+     ['add rbx, 1', 'add rcx, 1', 'xor eax, eax']),
+    (['add byte [rbx], 1', 'add byte [rbx+1], 1', 'xor eax, eax'],
+     ['add byte [rbx], 1', 'add byte [rbx+1], 1', 'xor eax, eax']),
+    # xorzero
+    (['mov rcx, 0', 'xor eax, eax'],
+     ['xor ecx, ecx', 'xor eax, eax']),
+    (['mov r9, 0', 'mov al, 0', 'xor edx, edx'],
+     ['xor r9d, r9d', 'xor al, al', 'xor edx, edx']),
+    (['cmp rax, rbx', 'mov rcx, 0', 'jz >1', '1:', 'ret'],
+     ['cmp rax, rbx', 'mov rcx, 0', 'jz >1', '1:', 'ret']),
+    ]
+
+
+def check_peephole():
+    bad = []
+    for lines, expected in PeepholeCases:
+        for kw in Configs[:-1]:
+            got = assemble(lines, peephole=True, **kw)
+            if got != assemble(expected):
+                bad.append('{} {}: {} is {}, not {}'.format(kw, lines, expected, got.hex(),
+                        assemble(expected).hex()))
+    assert not bad, '\n'.join(bad)
+
+
+def pasrun(source, mode, name, *args):
+    # the machine code assembled by the function name of the .pas source
+    # translated by pyasm in mode, called with args
+    module = {'__name__': 'pas'}
+    exec(pyasm.translatetext(source, mode), module)
+    pas = asm.AS()
+    if mode == 'actions':
+        module['_dasm'].asm = pas
+    text = io.StringIO()
+    with contextlib.redirect_stdout(text):
+        module[name](*args)
+        if mode == 'emit':
+            module['_emitter'].flush()
+    for line in text.getvalue().split('\n'):
+        pas.doline(line)
+    pas.finish()
+    return bytes(pas.resultbin)
+
+
+# lines with a hole v, the values the actions mode patches in as the
+# print mode encodes them, and values both reject
+HoleCases = [
+    ('mov eax, {v}', (-1, -(1 << 31), 0x80000000, 0xffffffff), (1 << 32,)),
+    ('mov rax, {v}', (-(1 << 31) - 1, 0x80000000, 0xffffffff, 1 << 32, 1 << 40, -(1 << 40)), (1 << 64,)),
+    ('mov al, {v}', (-1, -128, 0x80, 0xff), (-129, 0x100)),
+    ('mov ax, {v}', (-1, 0x8000, 0xffff), (0x10000,)),
+    ('movl [rbx], {v}', (-1, 0x80000000, 0xffffffff), (1 << 32,)),
+    ('movb [rbx+8], {v}', (-1, 0xff), (0x100,)),
+    ('add rax, {v}', (-1, -(1 << 31), 0x7fffffff), (0x80000000,)),
+    ('push {v}', (-(1 << 31), 0x7fffffff), (0x80000000,)),
+    ('add byte [rbx + {v}], 1', (0, 1, 127, 128, 0x7fffffff), (0x80000000,)),
+    ('lea rcx, [rbp - {v}]', (0, 128, 129, 1 << 31), ((1 << 31) + 1,)),
+    ('mov eax, [r12 + rax*4 + 8 - {v}]', (8, 0, 137, (1 << 31) + 8), ((1 << 31) + 9,)),
+    ('mov eax, [rip + {v}]', (0, 200, 0x7fffffff), (1 << 31,)),
+    ('mov qword [rsp + {v}], 5', (0, 8, 1000), ()),
+    ]
+
+
+def check_holes():
+    bad = []
+    for line, values, rejected in HoleCases:
+        source = 'def f(v):\n    $' + line + '\n'
+        for v in values:
+            got, expected = (pasrun(source, mode, 'f', v) for mode in ('actions', 'print'))
+            if got != expected:
+                bad.append('{} v={}: {}, not {}'.format(line, v, got.hex(), expected.hex()))
+        for v in rejected:
+            for mode in ('actions', 'print'):
+                try:
+                    pasrun(source, mode, 'f', v)
+                except (ValueError, struct.error):
+                    continue
+                bad.append('{} {} v={} taken'.format(mode, line, v))
+    assert not bad, '\n'.join(bad)
+
+
+# brainfuck programs, their input and the loops translate must reduce
+BrainfuckCases = [
+    ('++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>>.<-.<.+++.------.'
+     '--------.>>+.>++.', b'', {}),
+    ('+++++[-]>++++++[>+++++++<-]>.<<+++[->+>>++<<<]>>>.', b'', {'clear': 1, 'multiply': 2}),
+    ('++++++[->+>+<<]>>[-<<+>>]<<.>.', b'', {'copy': 2}),
+    ('>+>+>+[<]>.>>>>>+<<<[>]<.', b'', {'scan': 2}),
+    (',[.,]', b'abc', {}),
+    ('>>>++<<+>-<<+>+[>>+++++[<+++>-]<<-]>.>.>.', b'', {'multiply': 1}),
+    ]
+
+
+def brainfuck(program, data):
+    # the output of a plain interpreter running program on data
+    match, stack = {}, []
+    for i, c in enumerate(program):
+        if c == '[':
+            stack.append(i)
+        elif c == ']':
+            j = stack.pop()
+            match[i], match[j] = j, i
+    tape, p, i, out = [0] * 30000, 0, 0, bytearray()
+    data = iter(data)
+    while i < len(program):
+        c = program[i]
+        if c in '+-':
+            tape[p] = (tape[p] + (1 if c == '+' else -1)) & 255
+        elif c in '<>':
+            p += 1 if c == '>' else -1
+        elif c == '.':
+            out.append(tape[p])
+        elif c == ',':
+            tape[p] = next(data, 0)
+        elif c == '[' and tape[p] == 0 or c == ']' and tape[p] != 0:
+            i = match[i]
+        i += 1
+    return bytes(out)
+
+
+def check_brainfuck():
+    # brainfuck.pas in every mode of pyasm against the interpreter, the
+    # loops folded or not, on a guarded tape or not
+    with open(os.path.join(os.path.dirname(T), 'brainfuck.pas')) as f:
+        source = f.read()
+    bad = []
+    for mode in ('print', 'emit', 'actions'):
+        bf = {'__name__': 'brainfuck'}
+        code = pyasm.translatetext(source, mode)
+        exec(code, bf)
+        if mode == 'actions':
+            # the labels, branches, macros and holes are put, only the
+            # directives of prelude are left as text
+            texts = [f.split('(', 1)[0] for f in code.split('\ndef ')[1:] if '_dasm.text(' in f]
+            if texts != ['prelude']:
+                bad.append('_dasm.text in {}'.format(texts))
+        for program, data, loops in BrainfuckCases:
+            expected = brainfuck(program, data)
+            for fold in (False, True):
+                for guard in (False, True):
+                    stdin, stdout = sys.stdin, sys.stdout
+                    sys.stdin = io.TextIOWrapper(io.BytesIO(data))
+                    sys.stdout = io.TextIOWrapper(io.BytesIO())
+                    try:
+                        reduced = bf['run'](program, fold, guard)
+                        sys.stdout.flush()
+                        got = sys.stdout.buffer.getvalue()
+                    finally:
+                        sys.stdin, sys.stdout = stdin, stdout
+                    if got != expected:
+                        bad.append('{} fold={} guard={} {}: {!r}, not {!r}'.format(mode, fold, guard,
+                                program, got, expected))
+                    if fold and any(reduced[k] != n for k, n in loops.items()):
+                        bad.append('{} {}: reduced {}, not {}'.format(mode, program, reduced, loops))
+    assert not bad, '\n'.join(bad)
+
+
+
+def check_importhook():
+    # a .pas module imported twice is translated once. the cache in
+    # __pycache__ is stamped with pyasm.py, as.py and the source, a
+    # changed source or translator is translated again, a touched source
+    # is found by its sha256
+    name = 'pashook'
+    translations = []
+    translatetext = pyasm.translatetext
+    def counted(text, mode='print'):
+        translations.append(mode)
+        return translatetext(text, mode)
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, name + '.pas')
+        def write(value, mtime):
+            with open(path, 'w') as f:
+                f.write('VALUE = {}\n\ndef f():\n    $ mov eax, {{VALUE}}\n'.format(value))
+            os.utime(path, ns=(mtime, mtime))
+        def load():
+            sys.modules.pop(name, None)
+            importlib.invalidate_caches()
+            return importlib.import_module(name).VALUE
+
+        mtime = os.stat(d).st_mtime_ns
+        write(1, mtime)
+        hook = pyasm.install('actions')
+        sys.path.insert(0, d)
+        dont_write = sys.dont_write_bytecode
+        pyasm.translatetext, sys.dont_write_bytecode = counted, False
+        try:
+            assert load() == 1 and translations == ['actions'], translations
+            with open(importlib.util.cache_from_source(path + '.actions.py'), 'rb') as f:
+                fields = pyasm.PasLoader.header.unpack_from(f.read())
+            with open(path, 'rb') as f:
+                source = f.read()
+            stamp = (os.stat(pyasm.__file__).st_mtime_ns, os.stat(asm.__file__).st_mtime_ns,
+                    mtime, len(source), hashlib.sha256(source).digest())
+            assert fields[0] == importlib.util.MAGIC_NUMBER and fields[1:] == stamp, fields
+            assert load() == 1 and len(translations) == 1, 'not cached'
+
+            os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+            assert load() == 1 and len(translations) == 1, 'touched, translated again'
+            write(2, mtime + 2 * 10**9)
+            assert load() == 2 and len(translations) == 2, 'changed, not translated'
+
+            translator = pyasm.PasLoader.translator
+            pyasm.PasLoader.translator = lambda self: tuple(n + 1 for n in translator(self))
+            try:
+                assert load() == 2 and len(translations) == 3, 'new translator, not translated'
+            finally:
+                pyasm.PasLoader.translator = translator
+        finally:
+            pyasm.translatetext, sys.dont_write_bytecode = translatetext, dont_write
+            sys.path.remove(d)
+            sys.path_hooks.remove(hook)
+            sys.path_importer_cache.clear()
+            sys.modules.pop(name, None)
+
+
+def main(names):
+    checks = {name[6:]: f for name, f in globals().items() if name.startswith('check_')}
+    failures = 0
+    for name in names or checks:
+        try:
+            checks[name]()
+        except Exception:
+            failures += 1
+            print('FAIL', name)
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print('ok', name)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,27 @@
+# the scanner of pyasm.translatetext, t/scan.result is the translation
+# in print mode. markers in a comment: $ mov eax, 1 and $$$ and ' and "
+s1 = '$ mov eax, 1'
+s2 = "$$$ not assembly $$$"
+s3 = 'it\'s $ still a string'
+s4 = "a \"quoted\" $ and a \\"
+s5 = '''a triple-quoted string
+$ mov eax, 2
+$$$
+with ' and " and \''' inside
+'''
+s6 = """another one, "$$$" # not a comment
+ends here"""
+
+def f(n):
+    $ mov eax, {n} # a comment with $$$ and {n} and '
+    $ mov ecx, {len('}')}
+    $ .define hash, '#{'
+    $$$
+    # a comment in the block with $ and {
+    mov edx, {n +
+              1}
+    .define dollars, "$$$ in a string"
+    @{n}:
+    $$$
+    $ add eax, {{'a': n}['a']}
+    return s1 + s2 + s3 + s4 + s5 + s6 # $ ret
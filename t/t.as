@@ -114,3 +114,138 @@ adc rbx, [rbp+32]            # 48135D20
 adc rdx, [r15+32]            # 49135720
 adc rax, [r15+r12+32]        # 4B13442720
 adc rdx, [r15*8+r12+32]      # 4B1354FC20
+push rbx
+.macro pushrbx
+push rbx
+.endmacro
+nop                          # 90
+pushrbx                      # 53
+.type pair
+.int64 first
+.int64 second
+.endtype
+.macro loadsecond
+mov rax, [rbx:pair.second]
+.endmacro
+loadsecond                   # 488B4308
+.type pair
+.int64 second
+.endtype
+loadsecond                   # 488B03
+mov rax, [rbx:pair.second]   # 488B03
+mov eax, -1                  # B8FFFFFFFF
+mov eax, 0xffffffff          # B8FFFFFFFF
+mov r9d, -5                  # 41B9FBFFFFFF
+mov ax, -1                   # 66B8FFFF
+mov r10w, -300               # 6641BAD4FE
+mov al, -1                   # B0FF
+mov al, 255                  # B0FF
+mov rax, -1                  # 48C7C0FFFFFFFF
+mov rax, -0x80000001         # 48B8FFFFFF7FFFFFFFFF
+mov r11, -0x123456789        # 49BB7798BADCFEFFFFFF
+movb [rbx], -1               # C603FF
+movw [rbx+4], -2             # 66C74304FEFF
+movd [rbx], -3               # C703FDFFFFFF
+movl [r12], 0xfffffffd       # 41C70424FDFFFFFF
+movq [rbx], -3               # 48C703FDFFFFFF
+mov byte [rbx], -1           # C603FF
+mov rbx, rax                 # 4889C3
+mov [rbx+8], ecx             # 894B08
+mov r8l, [rsp]               # 448A0424
+movzx eax, byte [rbx]        # 0FB603
+movzx ax, byte [rbx+1]       # 660FB64301
+movzx r9, byte [r12]         # 4D0FB60C24
+movzx ecx, word [rsp+2]      # 0FB74C2402
+movzx rdx, word [rbx]        # 480FB713
+movzxb eax, [rbx]            # 0FB603
+movzxw r10d, [rbx]           # 440FB713
+movzx eax, cl                # 0FB6C1
+movzx ax, dl                 # 660FB6C2
+movzx r11, sil               # 4C0FB6DE
+movzx esi, r8l               # 410FB6F0
+movzx eax, bx                # 0FB7C3
+movzx r9, r10w               # 4D0FB7CA
+imul eax, ecx                # 0FAFC1
+imul r9, [rbx+8]             # 4C0FAF4B08
+imul ax, word [rbx]          # 660FAF03
+imul ecx, eax, 3             # 6BC803
+imul ecx, eax, -3            # 6BC8FD
+imul ecx, eax, 1000          # 69C8E8030000
+imul rdx, r12, -1000         # 4969D418FCFFFF
+imul r10w, r11w, 7           # 66456BD307
+imul eax, dword [rbx], 5     # 6B0305
+imul rax, [rbx+8], 300       # 486943082C010000
+shl eax, 1                   # D1E0
+shl eax, cl                  # D3E0
+shl eax, 3                   # C1E003
+shlb [rbx], 1                # D023
+add byte [rbx], 1            # 800301
+addb [rbx], 1                # 800301
+add qword [rbx], 1           # 48830301
+add word [rbx], 0x1234       # 6681033412
+inc byte [rbx]               # FE03
+lea rax, [rbx+rcx*2+8]       # 488D444B08
+cmovz eax, ecx               # 0F44C1
+setnz al                     # 0F95C0
+push rbx                     # 53
+push r12                     # 4154
+push -1                      # 6AFF
+pop r12                      # 415C
+ret                          # C3
+ret 16                       # C21000
+.define tmp, rcx
+.define base, r12
+.define bump, add
+mov tmp, base                # 4C89E1
+bump tmp, 8                  # 4883C108
+mov eax, [base+tmp*4+16]     # 418B448C10
+.macro load2, dst, src, off
+mov dst, [src+off]
+add dst, [src+off+8]
+.endmacro
+load2 rax, rbx, 16           # 488B431048034318
+load2 tmp, base, 0           # 498B0C2449034C2408
+.macro twice, op, reg
+op reg, 1
+op reg, 1
+.endmacro
+twice add, rdx               # 4883C2014883C201
+twice shl, tmp               # 48D1E148D1E1
+.define nothing, .nop
+nothing 1
+.macro save
+push base
+push tmp
+.endmacro
+.define tmp, rsi
+# the body of save took tmp as it was defined then
+save                         # 415451
+mov tmp, base                # 4C89E6
+.type vec
+.int32 x, y
+.endtype
+.type body:pack
+.byte tag
+vec pos, vel
+.int64 mass
+.endtype
+mov eax, [rdi:body.pos.y]    # 8B4705
+mov [rdi:body.vel.x], eax    # 894709
+mov rax, [rdi:body.mass]     # 488B4711
+lea rsi, [rdi:body.vel]      # 488D7709
+mov rax, rdi:body.mass       # 488B4711
+.type rec
+.byte tag
+vec pos
+.int64 n
+.endtype
+mov eax, [rdi:rec.pos.y]     # 8B4708
+mov rax, [rdi:rec.n]         # 488B4710
+movb [rbx:rec.tag], 1        # C60301
+mov eax, [r12:rec.pos]       # 418B442404
+.type vec
+.int64 x, y
+.endtype
+mov rax, [rdi:vec.y]         # 488B4708
+# rec keeps the vec it was defined with
+mov eax, [rdi:rec.pos.y]     # 8B4708